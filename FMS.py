@@ -13,17 +13,20 @@ import src.basis.bundle as bundle
 import src.dynamics.timings as timings
 import src.dynamics.initialize as initialize
 import src.dynamics.step as step
+import src.dynamics.surface as surface
 
 
-def init():
+def init(comm=None):
     """Initializes the FMSpy inputs.
 
     This must be separate from main so that an error which occurs
-    before the input file is created will be written to stdout.
+    before the input file is created will be written to stdout. If
+    comm is given, a parallel run uses it instead of COMM_WORLD (e.g.
+    the group of ranks running a member of an ensemble).
     """
     # initialize MPI communicator
     if glbl.mpi['parallel']:
-        glbl.mpi['comm']  = MPI.COMM_WORLD
+        glbl.mpi['comm']  = MPI.COMM_WORLD if comm is None else comm
         glbl.mpi['rank']  = glbl.mpi['comm'].Get_rank()
         glbl.mpi['nproc'] = glbl.mpi['comm'].Get_size()
     else:
@@ -71,6 +74,9 @@ def main():
             # update the fms output files, as well as checkpoint, if necessary
             master.update_logs()
 
+    # stop the pes workers, if running
+    surface.close_pool()
+
     # clean up, stop the global timer and write logs
     fileio.cleanup_end()
 
@@ -0,0 +1,27 @@
+"""
+Benchmarks of the Bundle routines called at every time step.
+"""
+from . import synthetic
+
+
+class Bundle:
+    """Amplitude propagation, copy and log output of a bundle of n_traj
+    trajectories."""
+    params      = [synthetic.n_traj_list]
+    param_names = ['n_traj']
+
+    def setup(self, n_traj):
+        synthetic.setup_input()
+        self.master = synthetic.make_bundle(n_traj)
+
+    def teardown(self, n_traj):
+        synthetic.cleanup()
+
+    def time_update_amplitudes(self, n_traj):
+        self.master.update_amplitudes(0.5, update_ham=False)
+
+    def time_copy(self, n_traj):
+        self.master.copy()
+
+    def time_update_logs(self, n_traj):
+        self.master.update_logs()
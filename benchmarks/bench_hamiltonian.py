@@ -0,0 +1,35 @@
+"""
+Benchmarks of the construction of the Hamiltonian, for each integral
+module. The matrices are built from scratch, without the matrix cache.
+"""
+from . import synthetic
+import src.fmsio.glbl as glbl
+import src.basis.hamiltonian as fms_ham
+
+
+class Hamiltonian:
+    """hamiltonian.hamiltonian for a bundle of n_traj trajectories."""
+    params      = [synthetic.integral_list, synthetic.n_traj_list]
+    param_names = ['integrals', 'n_traj']
+    timeout     = 300
+
+    def setup(self, integrals, n_traj):
+        synthetic.setup_input(integrals=integrals)
+        if glbl.integrals is None or \
+                glbl.integrals.__name__ != 'src.integrals.' + integrals:
+            raise NotImplementedError('cannot import ' + integrals)
+        try:
+            self.master = synthetic.make_bundle(n_traj)
+            self.time_hamiltonian(integrals, n_traj)
+        except Exception as err:
+            raise NotImplementedError(integrals + ' failed: ' + repr(err))
+
+    def teardown(self, integrals, n_traj):
+        synthetic.cleanup()
+
+    def time_hamiltonian(self, integrals, n_traj):
+        if glbl.integrals.require_centroids:
+            fms_ham.hamiltonian(self.master.traj, self.master.alive,
+                                cent_list=self.master.cent)
+        else:
+            fms_ham.hamiltonian(self.master.traj, self.master.alive)
@@ -0,0 +1,73 @@
+"""
+Benchmarks of the nuclear_gaussian integral kernels between two
+trajectories, for the Python module and the compiled Cython module
+(built with 'python setup.py build_ext --inplace'). The compiled
+benchmarks are skipped if the module is not built.
+"""
+import os
+import importlib
+import importlib.util
+import numpy as np
+from . import synthetic
+
+# the Python source, loaded even if the compiled module shadows it
+source = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'src', 'integrals', 'nuclear_gaussian.py')
+
+
+def load_kernels(impl):
+    """Returns the Python ('python') or compiled ('cython') nuclear_gaussian
+    module."""
+    if impl == 'python':
+        spec   = importlib.util.spec_from_file_location('nuclear_gaussian_py', source)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    module = importlib.import_module('src.integrals.nuclear_gaussian')
+    if module.__file__.endswith('.py'):
+        raise NotImplementedError('nuclear_gaussian is not compiled')
+    return module
+
+
+class NuclearGaussian:
+    """Overlap and derivative integrals between two gaussians of ndim
+    dimensions."""
+    params      = [['python', 'cython'], [synthetic.ndim, 16, 64]]
+    param_names = ['impl', 'ndim']
+
+    def setup(self, impl, ndim):
+        self.nuc = load_kernels(impl)
+        rng      = np.random.RandomState(0)
+        self.a1  = np.full(ndim, 0.5)
+        self.a2  = np.full(ndim, 0.5)
+        self.x1, self.x2, self.p1, self.p2 = rng.normal(0., 0.5, (4, ndim))
+        self.g1, self.g2 = rng.normal(size=2)
+        self.S   = self.nuc.overlap(self.g1, self.a1, self.x1, self.p1,
+                                    self.g2, self.a2, self.x2, self.p2)
+        # the compiled derivatives do not take the phases
+        if impl == 'python':
+            self.args = (self.S, self.g1, self.a1, self.x1, self.p1,
+                         self.g2, self.a2, self.x2, self.p2)
+        else:
+            self.args = (self.S, self.a1, self.x1, self.p1,
+                         self.a2, self.x2, self.p2)
+
+    def time_overlap(self, impl, ndim):
+        self.nuc.overlap(self.g1, self.a1, self.x1, self.p1,
+                         self.g2, self.a2, self.x2, self.p2)
+
+    def time_deldp(self, impl, ndim):
+        self.nuc.deldp(*self.args)
+
+    def time_deldx(self, impl, ndim):
+        self.nuc.deldx(*self.args)
+
+    def time_deld2x(self, impl, ndim):
+        self.nuc.deld2x(*self.args)
+
+    def time_ordr1_vec(self, impl, ndim):
+        self.nuc.ordr1_vec(self.a1, self.x1, self.p1, self.a2, self.x2, self.p2)
+
+    def time_ordr2_vec(self, impl, ndim):
+        self.nuc.ordr2_vec(self.a1, self.x1, self.p1, self.a2, self.x2, self.p2)
@@ -0,0 +1,32 @@
+"""
+Benchmarks of a time step of each propagator. The surfaces are evaluated
+at every step (the surface cache is disabled).
+"""
+from . import synthetic
+import src.fmsio.glbl as glbl
+
+
+class Propagators:
+    """propagate_bundle for a bundle of n_traj trajectories."""
+    params      = [synthetic.propagator_list, synthetic.n_traj_list]
+    param_names = ['propagator', 'n_traj']
+    timeout     = 600
+
+    def setup(self, propagator, n_traj):
+        synthetic.setup_input(propagator=propagator)
+        if glbl.integrator is None or \
+                glbl.integrator.__name__ != 'src.propagators.' + propagator:
+            raise NotImplementedError('cannot import ' + propagator)
+        try:
+            self.master = synthetic.make_bundle(n_traj)
+            glbl.integrator.propagate_bundle(self.master.copy(),
+                                             glbl.propagate['default_time_step'])
+        except Exception as err:
+            raise NotImplementedError(propagator + ' failed: ' + repr(err))
+
+    def teardown(self, propagator, n_traj):
+        synthetic.cleanup()
+
+    def time_propagate_bundle(self, propagator, n_traj):
+        glbl.integrator.propagate_bundle(self.master,
+                                         glbl.propagate['default_time_step'])
@@ -0,0 +1,29 @@
+"""
+Benchmarks of the evaluation of the vibronic potential energy surfaces.
+"""
+import numpy as np
+from . import synthetic
+import src.fmsio.glbl as glbl
+
+
+class Vibronic:
+    """Surfaces at the positions of n_traj trajectories, one at a time
+    and in a single batch."""
+    params      = [synthetic.n_traj_list]
+    param_names = ['n_traj']
+
+    def setup(self, n_traj):
+        synthetic.setup_input()
+        self.master = synthetic.make_bundle(n_traj)
+        self.geoms  = np.array([traj.x() for traj in self.master.traj])
+        self.labels = [traj.label for traj in self.master.traj]
+
+    def teardown(self, n_traj):
+        synthetic.cleanup()
+
+    def time_evaluate_trajectory(self, n_traj):
+        for traj in self.master.traj:
+            glbl.pes.evaluate_trajectory(traj)
+
+    def time_evaluate_batch(self, n_traj):
+        glbl.pes.evaluate_batch(self.geoms, self.labels)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Runs the benchmark suite without asv and reports the time of each
+benchmark against the number of trajectories.
+
+The benchmarks are the time_* methods of the classes in the bench_*
+modules, written for asv (airspeed velocity): a class lists its
+parameters in params/param_names, and setup() raises NotImplementedError
+to skip a combination. For every benchmark the time per call is given
+for each number of trajectories, with the exponent of the fitted power
+law t ~ N^k. The results can be saved and compared with an earlier run,
+a benchmark slower than the earlier one by more than the threshold is
+reported as a regression (and the exit status is 1).
+
+Run from the main directory with:
+    python benchmarks/scaling.py [--ntraj 4,16,64] [--ndim 4] [--nstates 2]
+                                 [--filter name] [--save out.json]
+                                 [--compare base.json] [--threshold 1.25]
+
+or with asv, using asv.conf.json in the main directory:
+    asv run -E existing --quick
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import importlib
+import itertools
+import numpy as np
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+modules   = ['bench_integrals', 'bench_surface', 'bench_hamiltonian',
+             'bench_bundle', 'bench_propagators']
+
+# minimum time (s) of a timed sample, and number of samples
+min_time = 0.05
+repeat   = 3
+
+
+def parse_args():
+    """Returns the command line options."""
+    parser = argparse.ArgumentParser(description='FMSpy benchmark scaling report')
+    parser.add_argument('--ntraj', default='4,16,64',
+                        help='comma separated numbers of trajectories')
+    parser.add_argument('--ndim', type=int, default=4, help='number of modes')
+    parser.add_argument('--nstates', type=int, default=2, help='number of states')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--save', default=None, help='write the timings to this file')
+    parser.add_argument('--compare', default=None,
+                        help='compare with the timings in this file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown reported as a regression')
+    return parser.parse_args()
+
+
+def time_call(func, args):
+    """Returns the minimum time (s) per call of func(*args), over repeat
+    samples of at least min_time."""
+    func(*args)
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for i in range(number):
+            func(*args)
+        t_sample = time.perf_counter() - t0
+        if t_sample >= min_time or number >= 1000:
+            break
+        number *= 10
+    samples = [t_sample / number]
+    for k in range(repeat - 1):
+        t0 = time.perf_counter()
+        for i in range(number):
+            func(*args)
+        samples.append((time.perf_counter() - t0) / number)
+    return min(samples)
+
+
+def run_class(bench_class, name_filter):
+    """Runs the benchmarks of a class for all the combinations of its
+    parameters. Returns a dict of times (None if skipped or failed) keyed
+    by (benchmark name, parameters)."""
+    results = dict()
+    methods = sorted(name for name in dir(bench_class) if name.startswith('time_'))
+    methods = [name for name in methods
+               if name_filter in bench_class.__name__ + '.' + name]
+    if len(methods) == 0:
+        return results
+    print('running ' + bench_class.__module__ + '.' + bench_class.__name__)
+    sys.stdout.flush()
+
+    params = getattr(bench_class, 'params', [[]])
+    names  = getattr(bench_class, 'param_names', [])
+    for values in itertools.product(*params):
+        label = ', '.join(n + '=' + str(v) for n, v in zip(names, values))
+        bench = bench_class()
+        try:
+            if hasattr(bench, 'setup'):
+                bench.setup(*values)
+        except NotImplementedError as err:
+            print('  skipped {:s}({:s}): {:s}'.format(bench_class.__name__, label, str(err)))
+            for name in methods:
+                results[(bench_class.__name__ + '.' + name, values)] = None
+            continue
+
+        for name in methods:
+            key = (bench_class.__name__ + '.' + name, values)
+            try:
+                results[key] = time_call(getattr(bench, name), values)
+            except Exception as err:
+                print('  failed {:s}({:s}): {:s}'.format(key[0], label, repr(err)))
+                results[key] = None
+        if hasattr(bench, 'teardown'):
+            bench.teardown(*values)
+        sys.stdout.flush()
+
+    return results
+
+
+def report(results, names_n, n_list):
+    """Prints the time per call against the number of trajectories,
+    with the fitted scaling exponent."""
+    ostr = ('benchmark'.ljust(60) + ''.join(('N=' + str(n)).rjust(12) for n in n_list) +
+            'exponent'.rjust(10) + '\n')
+    rows = dict()
+    for (name, values), t_call in results.items():
+        n_ind = names_n.get(name)
+        if n_ind is None:
+            rows.setdefault((name, values), dict())[None] = t_call
+        else:
+            other = values[:n_ind] + values[n_ind+1:]
+            rows.setdefault((name, other), dict())[values[n_ind]] = t_call
+
+    for (name, values), times in rows.items():
+        label = name + ('(' + ', '.join(str(v) for v in values) + ')' if values else '')
+        if None in times:
+            cols = ['{:12.3e}'.format(times[None]) if times[None] is not None
+                    else '-'.rjust(12)]
+            ostr += label.ljust(60) + ''.join(cols) + '\n'
+            continue
+        cols  = []
+        n_fit = []
+        t_fit = []
+        for n in n_list:
+            if times.get(n) is None:
+                cols.append('-'.rjust(12))
+            else:
+                cols.append('{:12.3e}'.format(times[n]))
+                n_fit.append(n)
+                t_fit.append(times[n])
+        if len(n_fit) > 1:
+            expo = '{:10.2f}'.format(np.polyfit(np.log(n_fit), np.log(t_fit), 1)[0])
+        else:
+            expo = '-'.rjust(10)
+        ostr += label.ljust(60) + ''.join(cols) + expo + '\n'
+    print(ostr)
+
+
+def result_name(name, values):
+    """Returns the name of a result in the saved timings."""
+    return name + '(' + ', '.join(str(v) for v in values) + ')'
+
+
+def compare(results, filename, threshold):
+    """Compares the timings with those saved in filename, returns the
+    number of regressions."""
+    with open(filename, 'r') as infile:
+        base = json.load(infile)['timings']
+
+    n_reg = 0
+    ostr  = ('benchmark'.ljust(60) + 'base'.rjust(12) + 'new'.rjust(12) +
+             'ratio'.rjust(10) + '\n')
+    for (name, values), t_call in results.items():
+        key = result_name(name, values)
+        if t_call is None or base.get(key) is None:
+            continue
+        ratio = t_call / base[key]
+        flag  = ''
+        if ratio > threshold:
+            flag   = '  REGRESSION'
+            n_reg += 1
+        ostr += '{:60s}{:12.3e}{:12.3e}{:10.2f}{:s}\n'.format(key, base[key], t_call,
+                                                              ratio, flag)
+    print(ostr)
+    return n_reg
+
+
+def main():
+    args = parse_args()
+
+    # the size of the synthetic bundles is read when the modules are imported
+    os.environ['FMS_BENCH_NTRAJ']   = args.ntraj
+    os.environ['FMS_BENCH_NDIM']    = str(args.ndim)
+    os.environ['FMS_BENCH_NSTATES'] = str(args.nstates)
+    sys.path.insert(0, os.path.dirname(bench_dir))
+    n_list = [int(n) for n in args.ntraj.split(',')]
+
+    results = dict()
+    names_n = dict()
+    for module_name in modules:
+        module = importlib.import_module('benchmarks.' + module_name)
+        for bench_class in list(vars(module).values()):
+            if not isinstance(bench_class, type) or \
+                    bench_class.__module__ != module.__name__:
+                continue
+            class_results = run_class(bench_class, args.filter)
+            names = getattr(bench_class, 'param_names', [])
+            for name, values in class_results:
+                if 'n_traj' in names:
+                    names_n[name] = names.index('n_traj')
+            results.update(class_results)
+
+    print('\ntime per call (s), ndim={:d}, nstates={:d}\n'.format(args.ndim,
+                                                                args.nstates))
+    report(results, names_n, n_list)
+
+    if args.save is not None:
+        with open(args.save, 'w') as outfile:
+            json.dump(dict(ndim    = args.ndim,
+                           nstates = args.nstates,
+                           timings = {result_name(name, values): t_call
+                                      for (name, values), t_call in results.items()}),
+                      outfile, indent=1)
+
+    if args.compare is not None:
+        if compare(results, args.compare, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
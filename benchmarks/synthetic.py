@@ -0,0 +1,150 @@
+"""
+Synthetic bundles for the benchmarks.
+
+The bundles live on a random linear vibronic coupling model with ndim
+modes and nstates states. The operator file, geometry.dat and fms.input
+of the model are written to a scratch directory and read through the
+usual input path, so the benchmarked routines see the same global state
+as in a run. The size of the model and the numbers of trajectories the
+benchmarks are run for are set with the environment variables:
+
+  FMS_BENCH_NDIM    : number of modes (default 4)
+  FMS_BENCH_NSTATES : number of states (default 2)
+  FMS_BENCH_NTRAJ   : comma separated numbers of trajectories (default 4,16,64)
+"""
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import src.fmsio.glbl as glbl
+import src.fmsio.fileio as fileio
+import src.basis.trajectory as trajectory
+import src.basis.bundle as bundle
+import src.dynamics.surface as surface
+
+ndim        = int(os.environ.get('FMS_BENCH_NDIM', '4'))
+nstates     = int(os.environ.get('FMS_BENCH_NSTATES', '2'))
+n_traj_list = [int(n) for n in os.environ.get('FMS_BENCH_NTRAJ', '4,16,64').split(',')]
+
+# integral modules and propagators benchmarked
+integral_list   = ['bra_ket_averaged', 'saddle_point', 'collocation',
+                   'vibronic_diabatic', 'crude_adiabatic_saddle_point',
+                   'crude_adiabatic_vibronic_2state']
+propagator_list = ['velocity_verlet', 'runge_kutta4', 'rkf45', 'bulirsch_stoer']
+
+# scratch directory of the current setup, and the directory we came from
+work_dir = None
+home_dir = None
+
+
+def write_operator(fname, freqs, rng):
+    """Writes a linear vibronic coupling operator: harmonic modes with
+    frequencies freqs (au), random state energies, linear on-diagonal
+    and linear off-diagonal couplings."""
+    nmode = len(freqs)
+    with open(fname, 'w') as opfile:
+        opfile.write('PARAMETER-SECTION\n')
+        for i in range(nmode):
+            opfile.write('w{:d} = {:.8f}\n'.format(i+1, freqs[i]))
+        opfile.write('end-parameter-section\n\n')
+
+        opfile.write('HAMILTONIAN-SECTION\n')
+        opfile.write('modes | ' + ' | '.join('q' + str(i+1) for i in range(nmode)) + '\n')
+        for s in range(nstates):
+            opfile.write('{:.8f} S{:d}&{:d}\n'.format(0.02 * s, s+1, s+1))
+            for i in range(nmode):
+                opfile.write('0.5*w{:d} {:d}^2 S{:d}&{:d}\n'.format(i+1, i+1, s+1, s+1))
+                opfile.write('{:.8f} {:d}^1 S{:d}&{:d}\n'.format(
+                             0.005 * rng.normal(), i+1, s+1, s+1))
+            for r in range(s):
+                for i in range(nmode):
+                    opfile.write('{:.8f} {:d}^1 S{:d}&{:d}\n'.format(
+                                 0.002 * rng.normal(), i+1, r+1, s+1))
+        opfile.write('end-hamiltonian-section\n\nend-operator\n')
+
+
+def setup_input(integrals='bra_ket_averaged', propagator='velocity_verlet',
+                **keywords):
+    """Writes the input of the synthetic model to a new scratch directory,
+    changes to it and reads the input. Further keywords are given as
+    section=dict(key=value) pairs."""
+    global work_dir, home_dir
+
+    cleanup()
+    rng      = np.random.RandomState(0)
+    freqs    = rng.uniform(0.002, 0.008, ndim)
+    home_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='fms_bench_')
+    os.chdir(work_dir)
+    # read_input_file empties the scratch directory given by TMPDIR
+    os.environ['TMPDIR'] = os.path.join(work_dir, 'scr')
+    os.makedirs(os.environ['TMPDIR'])
+
+    write_operator('bench.op', freqs, rng)
+    with open('geometry.dat', 'w') as geomfile:
+        geomfile.write('{:d}\nsynthetic model\n'.format(ndim))
+        for i in range(ndim):
+            geomfile.write('q{:d} 0.0 0.0\n'.format(i+1))
+
+    sections = dict(
+        interface     = dict(interface='vibronic', opfile='bench.op',
+                             coupling_order=1, pes_cache_mb=0),
+        sampling      = dict(init_state=1, n_init_traj=1, seed=0),
+        propagate     = dict(n_states=nstates, integrals=integrals,
+                             propagator=propagator, default_time_step=1.0,
+                             coupled_time_step=0.5),
+        nuclear_basis = dict(geomfile='geometry.dat', use_atom_lib=False,
+                             freqs='[' + ','.join(str(w) for w in freqs) + ']'),
+        printing      = dict(print_level=1))
+    for section, values in keywords.items():
+        sections.setdefault(section, dict()).update(values)
+    with open('fms.input', 'w') as infile:
+        for section, values in sections.items():
+            infile.write('begin ' + section + '-section\n')
+            for key, val in values.items():
+                infile.write('  {:s} = {:s}\n'.format(key, str(val)))
+            infile.write('end ' + section + '-section\n')
+
+    fileio.read_input_file()
+    fileio.init_fms_output()
+    glbl.pes.init_interface()
+    surface.init_cache()
+
+
+def make_bundle(n_traj, seed=0):
+    """Returns a bundle of n_traj trajectories at random positions and
+    momenta, spread over the states, with the surfaces and matrices
+    evaluated."""
+    rng    = np.random.RandomState(seed)
+    master = bundle.Bundle(nstates)
+    traj_list = []
+    for i in range(n_traj):
+        new_traj = trajectory.Trajectory(nstates, ndim,
+                                         width=glbl.nuclear_basis['widths'],
+                                         mass=glbl.nuclear_basis['masses'])
+        new_traj.update_x(rng.normal(0., 1., ndim))
+        new_traj.update_p(rng.normal(0., 1., ndim))
+        new_traj.state     = i % nstates
+        new_traj.amplitude = (rng.normal() + 1j * rng.normal()) / np.sqrt(n_traj)
+        traj_list.append(new_traj)
+    master.add_trajectories(traj_list)
+
+    surface.update_pes(master)
+    master.update_matrices()
+    return master
+
+
+def cleanup():
+    """Closes the output and removes the scratch directory of the last
+    setup."""
+    global work_dir
+
+    if fileio.output is not None:
+        fileio.output.close()
+        fileio.output = None
+    if work_dir is not None:
+        os.chdir(home_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        work_dir = None
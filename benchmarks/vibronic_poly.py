@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Correctness check and microbenchmark of the compiled polynomial
+evaluator (PolyOperator) of the vibronic interface.
+
+For the example operator files, the diabatic potential matrix and its
+first and second derivatives from PolyOperator.evaluate are compared
+against a direct term-by-term evaluation of the operator at random
+geometries, and the number of geometries evaluated per second by both
+is reported.
+
+Run from the main directory with:
+    python benchmarks/vibronic_poly.py [n_geom]
+"""
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import src.interfaces.vibronic as vibronic
+
+examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples')
+operators = [('butatriene_vibronic', 'butatriene.op', 2),
+             ('pyrazine_vibronic', 'pyrazine4d.op', 2)]
+
+# maximum error relative to the largest element
+tol = 1.e-12
+
+
+def read_operator(example, opfile):
+    """Reads an example operator file, returns the VibHam object."""
+    ham = vibronic.VibHam()
+    vibronic.ham = ham
+    # mode labels lead the lines that follow the mode count in
+    # geometry.dat (comment lines are skipped)
+    with open(os.path.join(examples, example, 'geometry.dat'), 'r') as infile:
+        lines = [line.split() for line in infile
+                 if len(line.split()) > 0 and line.split()[0][0] != '#']
+    nmode = int(lines[0][0])
+    ham.mlbl_total = [words[0].lower() for words in lines[1:nmode+1]]
+    ham.nmode_total  = len(ham.mlbl_total)
+    ham.nmode_active = ham.nmode_total
+    ham.mlbl_active  = ham.mlbl_total
+    ham.rdoperfile(os.path.join(examples, example, opfile))
+    return ham
+
+
+def direct_evaluate(ham, nstates, q):
+    """Evaluates V, dV/dq and d2V/dq2 at a single geometry q by looping
+    over the terms of the operator."""
+    nmode = ham.nmode_total
+    pot   = np.zeros((nstates, nstates))
+    grad  = np.zeros((nmode, nstates, nstates))
+    hess  = np.zeros((nmode, nmode, nstates, nstates))
+    for i in range(ham.nterms):
+        s1, s2 = ham.stalbl[i] - 1
+        m = list(ham.mode[i])
+        o = list(ham.order[i])
+        pot[s1,s2] += ham.coe[i] * np.prod([q[m[k]]**o[k] for k in range(len(m))])
+        for a in range(len(m)):
+            oa     = list(o)
+            oa[a] -= 1
+            grad[m[a],s1,s2] += (ham.coe[i] * o[a] *
+                                 np.prod([q[m[k]]**oa[k] for k in range(len(m)) if oa[k] > 0]))
+            for b in range(len(m)):
+                ob     = list(oa)
+                ob[b] -= 1
+                fac    = o[a] * oa[b]
+                if fac == 0:
+                    continue
+                hess[m[a],m[b],s1,s2] += (ham.coe[i] * fac *
+                        np.prod([q[m[k]]**ob[k] for k in range(len(m)) if ob[k] > 0]))
+
+    # the terms only give the lower triangle
+    for s1 in range(nstates):
+        for s2 in range(s1):
+            pot[s1,s2]        = pot[s2,s1]        = pot[s1,s2] + pot[s2,s1]
+            grad[:,s1,s2]     = grad[:,s2,s1]     = grad[:,s1,s2] + grad[:,s2,s1]
+            hess[:,:,s1,s2]   = hess[:,:,s2,s1]   = hess[:,:,s1,s2] + hess[:,:,s2,s1]
+    return pot, grad, hess
+
+
+def main():
+    n_geom = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rng    = np.random.RandomState(0)
+    passed = True
+
+    print('{:16s}{:>8s}{:>8s}{:>12s}{:>12s}{:>12s}{:>14s}{:>14s}'.format(
+          'operator', 'terms', 'monos', 'err V', 'err dV', 'err d2V',
+          'direct /s', 'compiled /s'))
+    for example, opfile, nstates in operators:
+        ham  = read_operator(example, opfile)
+        poly = vibronic.PolyOperator(ham, nstates)
+        geoms = rng.normal(size=(n_geom, ham.nmode_total))
+
+        # direct evaluation, one geometry at a time
+        n_direct = min(n_geom, 200)
+        t0 = time.perf_counter()
+        ref = [direct_evaluate(ham, nstates, q) for q in geoms[:n_direct]]
+        t_direct = time.perf_counter() - t0
+
+        # compiled evaluation of the whole stack
+        t0 = time.perf_counter()
+        vals = poly.evaluate(geoms)
+        t_poly = time.perf_counter() - t0
+
+        errors = []
+        for k in range(3):
+            r = np.array([x[k] for x in ref])
+            errors.append(np.abs(vals[k][:n_direct] - r).max() / max(np.abs(r).max(), 1.))
+        passed = passed and max(errors) < tol
+
+        print('{:16s}{:8d}{:8d}{:12.2e}{:12.2e}{:12.2e}{:14.0f}{:14.0f}'.format(
+              opfile, ham.nterms, len(poly.mono_mode), errors[0], errors[1],
+              errors[2], n_direct / t_direct, n_geom / t_poly))
+
+    if not passed:
+        print('FAILED: compiled evaluation differs from direct evaluation')
+        sys.exit(1)
+    print('passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+"""
+Runs an ensemble of independent FMSpy simulations.
+
+The runs are set up from fms.input, and the files next to it, in the
+current directory. The ensemble-section of the input sets the number of
+runs, their seeds and the geometry files they cycle through. Run k is
+executed in its own directory, ensemble_dir/run.k, with a copy of the
+input files and its own scratch and output directories. As the runs
+finish, their state populations (n.dat) and energies (e.dat) are averaged
+into ensemble_dir/n.dat and ensemble_dir/e.dat, and a line is added to
+ensemble_dir/ensemble.log. Runs that finished in an earlier invocation
+are not run again, those that failed are. The exit status is 1 if any
+run failed.
+
+FMSpy keeps the state of a run in module globals, so each run starts
+from freshly imported modules: FMS and the src modules are removed from
+sys.modules before the run and imported anew.
+
+Without MPI, ensemble_workers processes take the runs from a pool. With
+MPI, COMM_WORLD is split into groups of group_size ranks; each group
+requests the next run from a thread of rank 0 and executes it on its
+own communicator. The averages are then written when all runs are done.
+
+Run from the input directory with:
+    python ensemble.py
+    mpirun -np N python ensemble.py -mpi
+"""
+import os
+import sys
+import time
+import shutil
+import importlib
+import threading
+import multiprocessing
+import numpy as np
+import src.fmsio.glbl as glbl
+import src.fmsio.fileio as fileio
+
+# bundle logs averaged over the runs
+log_names = ['n.dat', 'e.dat']
+# tags of the requests for runs and of the replies (with MPI), and the
+# interval (s) at which rank 0 checks for requests
+request_tag = 1
+reply_tag   = 2
+poll_time   = 0.01
+
+
+#--------------------------------------------------------------------------
+#
+# Setting up the runs
+#
+#--------------------------------------------------------------------------
+def read_settings():
+    """Reads fms.input, returns the ensemble keywords together with
+    the seed, geometry file, pes store and operator file of the template
+    input."""
+    fileio.parse_input('fms.input')
+    settings = dict(glbl.ensemble)
+    settings['seed']      = glbl.sampling['seed']
+    settings['geomfile']  = glbl.nuclear_basis['geomfile']
+    settings['pes_store'] = glbl.interface['pes_store']
+    settings['interface'] = glbl.interface['interface']
+    settings['opfile']    = glbl.interface['opfile']
+
+    if settings['n_runs'] < 1:
+        raise ValueError('n_runs must be at least 1')
+    if 0 < len(settings['seeds']) < settings['n_runs']:
+        raise ValueError('seeds must be given for all ' +
+                         str(settings['n_runs']) + ' runs')
+    if len(settings['geomfiles']) > 0 and settings['geomfile'] == '':
+        raise ValueError('geomfiles requires geomfile to be set')
+    for geom in settings['geomfiles']:
+        if not os.path.isfile(geom):
+            raise FileNotFoundError('Could not open: ' + geom)
+    return settings
+
+
+def run_seed(settings, k):
+    """Returns the seed of run k."""
+    if len(settings['seeds']) > 0:
+        return settings['seeds'][k]
+    return settings['seed'] + k
+
+
+def run_dir(settings, k):
+    """Returns the directory of run k."""
+    return os.path.join(os.getcwd(), settings['ensemble_dir'], 'run.' + str(k))
+
+
+def write_input(lines, filename, overrides):
+    """Writes the input lines to filename, replacing the keywords in
+    overrides, a dict of the new values of each section."""
+    section = None
+    skip    = False
+    with open(filename, 'w') as outfile:
+        for line in lines:
+            words = line.split()
+            if len(words) > 1 and words[0] == 'begin' and words[1].endswith('-section'):
+                section = words[1].replace('-section', '')
+            elif len(words) > 1 and words[0] == 'end' and section in overrides:
+                for key, val in overrides[section].items():
+                    outfile.write('  ' + key + ' = ' + str(val) + '\n')
+                section = None
+            elif section in overrides:
+                if '=' in line:
+                    skip = line.split('=', 1)[0].strip() in overrides[section]
+                # continuation lines of a replaced keyword are skipped too
+                if skip:
+                    continue
+            outfile.write(line)
+
+        present = [line.split()[1].replace('-section', '') for line in lines
+                   if len(line.split()) > 1 and line.split()[0] == 'begin']
+        for section in overrides:
+            if section not in present and len(overrides[section]) > 0:
+                outfile.write('begin ' + section + '-section\n')
+                for key, val in overrides[section].items():
+                    outfile.write('  ' + key + ' = ' + str(val) + '\n')
+                outfile.write('end ' + section + '-section\n')
+
+
+def setup_runs(settings):
+    """Creates the directory of every run that has not finished yet, with
+    a copy of the input files and the seed (and geometry) of the run."""
+    home = os.getcwd()
+    with open('fms.input', 'r') as infile:
+        lines = infile.readlines()
+    inputs = [fname for fname in os.listdir(home)
+              if os.path.isfile(fname) and fname != 'fms.input']
+
+    overrides = dict(sampling=dict(), interface=dict())
+    # the runs share the store of surfaces of the input directory
+    if settings['pes_store'] != '':
+        overrides['interface']['pes_store'] = os.path.join(home, settings['pes_store'])
+    # and the operator file, so that they map the same compiled Hamiltonian
+    if settings['interface'] == 'vibronic':
+        overrides['interface']['opfile'] = os.path.join(home, settings['opfile'])
+
+    for k in range(settings['n_runs']):
+        rdir = run_dir(settings, k)
+        if run_status(rdir) == 'done':
+            continue
+        if os.path.exists(rdir):
+            shutil.rmtree(rdir)
+        os.makedirs(rdir)
+        for fname in inputs:
+            shutil.copy(fname, rdir)
+        if len(settings['geomfiles']) > 0:
+            geom = settings['geomfiles'][k % len(settings['geomfiles'])]
+            shutil.copy(geom, os.path.join(rdir, settings['geomfile']))
+        overrides['sampling']['seed'] = run_seed(settings, k)
+        write_input(lines, os.path.join(rdir, 'fms.input'), overrides)
+
+
+def run_status(rdir):
+    """Returns the status of the run in rdir: 'done', 'failed' or None
+    if it has not been run."""
+    try:
+        with open(os.path.join(rdir, 'status'), 'r') as infile:
+            return infile.read().strip()
+    except IOError:
+        return None
+
+
+#--------------------------------------------------------------------------
+#
+# Executing the runs
+#
+#--------------------------------------------------------------------------
+def fresh_fms():
+    """Returns the FMS module, imported with fresh copies of all the
+    src modules."""
+    for name in list(sys.modules):
+        if name == 'FMS' or name == 'src' or name.startswith('src.'):
+            del sys.modules[name]
+    return importlib.import_module('FMS')
+
+
+def run_member(task, comm=None, task_win=None):
+    """Executes a run, task holds its index k, its directory and the
+    base of the scratch directories (None for a scratch directory in the
+    run directory). The run uses the ranks of communicator comm, and the
+    window task_win of the counter of pes tasks, if given. Returns k, the
+    status and the wall time of the run."""
+    k, rdir, scr_base = task
+    t_start = time.time()
+    home    = os.getcwd()
+    rank    = 0 if comm is None else comm.Get_rank()
+
+    # every run has a scratch directory of its own
+    scr_path = os.path.join(scr_base if scr_base is not None else rdir, 'run.' + str(k))
+    os.makedirs(scr_path, exist_ok=True)
+    os.environ['TMPDIR'] = scr_path
+    os.chdir(rdir)
+
+    status = 'done'
+    fms    = fresh_fms()
+    fms.glbl.mpi['parallel'] = comm is not None and comm.Get_size() > 1
+    fms.glbl.mpi['task_win'] = task_win
+    # a failed run must not abort the runs of the other groups
+    fms.fileio.abort_on_error = False
+    try:
+        fms.init(comm)
+        fms.main()
+    except Exception:
+        status = 'failed'
+        try:
+            fms.fileio.cleanup_exc(*sys.exc_info())
+        except Exception:
+            pass
+    finally:
+        os.chdir(home)
+
+    # the ranks of the group agree on the status of the run, so that they
+    # all go on to the next run together
+    if fms.glbl.mpi['parallel']:
+        import mpi4py.MPI as MPI
+        if comm.allreduce(int(status == 'failed'), op=MPI.MAX):
+            status = 'failed'
+
+    if rank == 0:
+        with open(os.path.join(rdir, 'status'), 'w') as outfile:
+            outfile.write(status + '\n')
+        shutil.rmtree(scr_path, ignore_errors=True)
+    return k, status, time.time() - t_start
+
+
+def finished_runs(settings, tasks):
+    """Returns the runs finished in earlier invocations, i.e. those that
+    are done and not in the list of tasks."""
+    pending = [task[0] for task in tasks]
+    return [k for k in range(settings['n_runs'])
+            if k not in pending and run_status(run_dir(settings, k)) == 'done']
+
+
+def log_run(settings, k, status, wall):
+    """Adds the result of run k to the ensemble log."""
+    with open(os.path.join(settings['ensemble_dir'], 'ensemble.log'), 'a') as logfile:
+        logfile.write('run {:6d}   seed {:8d}   {:8s}{:12.2f} s\n'.format(
+                      k, run_seed(settings, k), status, wall))
+
+
+def run_pool(settings, tasks):
+    """Executes the runs on a pool of ensemble_workers processes,
+    averaging the logs as the runs finish. Returns the number of failed
+    runs."""
+    average = Average()
+    for k in finished_runs(settings, tasks):
+        average.add(run_dir(settings, k))
+
+    n_workers = min(settings['ensemble_workers'], len(tasks))
+    if n_workers > 1:
+        pool    = multiprocessing.get_context('fork').Pool(n_workers)
+        results = pool.imap_unordered(run_member, tasks)
+    else:
+        pool    = None
+        results = map(run_member, tasks)
+
+    n_failed = 0
+    for k, status, wall in results:
+        log_run(settings, k, status, wall)
+        if status == 'done':
+            average.add(run_dir(settings, k))
+            average.write(settings['ensemble_dir'])
+        else:
+            n_failed += 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    average.write(settings['ensemble_dir'])
+    return n_failed
+
+
+def serve_runs(disp, n_tasks, n_groups):
+    """Hands out the indices of the runs to the roots of the groups, on
+    request, over communicator disp. Runs in a thread of rank 0. An index
+    of n_tasks or more tells a group that all runs are taken, the thread
+    returns once every group has been told."""
+    import mpi4py.MPI as MPI
+
+    i_task = 0
+    n_left = n_groups
+    status = MPI.Status()
+    while n_left > 0:
+        # poll, so that the thread does not take a core from the run of
+        # rank 0 while it waits
+        while not disp.Iprobe(source=MPI.ANY_SOURCE, tag=request_tag,
+                              status=status):
+            time.sleep(poll_time)
+        source = status.Get_source()
+        disp.recv(source=source, tag=request_tag)
+        disp.send(i_task, dest=source, tag=reply_tag)
+        if i_task >= n_tasks:
+            n_left -= 1
+        i_task += 1
+
+
+def run_mpi(settings, tasks):
+    """Executes the runs on groups of group_size MPI ranks. The averages
+    are gathered and written once all runs are done. Returns the number
+    of failed runs."""
+    import mpi4py.MPI as MPI
+
+    world    = MPI.COMM_WORLD
+    rank     = world.Get_rank()
+    if world.Get_size() % settings['group_size'] != 0:
+        raise ValueError('number of ranks must be a multiple of group_size')
+    comm     = world.Split(rank // settings['group_size'], rank)
+    n_groups = world.Get_size() // settings['group_size']
+
+    # counter of the pes tasks of each group, held by its root. The
+    # windows are allocated before any run starts, one group at a time:
+    # windows allocated at the same time by several groups (or while
+    # another window is in use) fail with some MPI libraries.
+    size     = np.dtype(np.int64).itemsize
+    task_win = None
+    for group in range(n_groups):
+        if rank // settings['group_size'] == group:
+            task_win = MPI.Win.Allocate(size if comm.Get_rank() == 0 else 0,
+                                        disp_unit=size, comm=comm)
+        world.Barrier()
+
+    # with several groups, the runs are handed out by a thread of rank 0,
+    # on a communicator of its own
+    disp     = world.Dup()
+    server   = None
+    if n_groups > 1 and rank == 0:
+        if MPI.Query_thread() != MPI.THREAD_MULTIPLE:
+            raise ValueError('several groups require an MPI library '+
+                             'supporting MPI_THREAD_MULTIPLE')
+        server = threading.Thread(target=serve_runs,
+                                  args=(disp, len(tasks), n_groups))
+        server.start()
+
+    average  = Average()
+    n_failed = 0
+    i_next   = 0
+    while True:
+        i_task = None
+        if comm.Get_rank() == 0:
+            if n_groups > 1:
+                i_task = disp.sendrecv(None, dest=0, sendtag=request_tag,
+                                       source=0, recvtag=reply_tag)
+            else:
+                i_task = i_next
+                i_next += 1
+        i_task = comm.bcast(i_task, root=0)
+        if i_task >= len(tasks):
+            break
+        k, status, wall = run_member(tasks[i_task], comm, task_win)
+        if comm.Get_rank() == 0:
+            log_run(settings, k, status, wall)
+            if status == 'done':
+                average.add(run_dir(settings, k))
+            else:
+                n_failed += 1
+
+    if server is not None:
+        server.join()
+    world.Barrier()
+    task_win.Free()
+    disp.Free()
+
+    # rank 0 also holds the runs finished in earlier invocations
+    if rank == 0:
+        for k in finished_runs(settings, tasks):
+            average.add(run_dir(settings, k))
+    averages = world.gather(average if comm.Get_rank() == 0 else None, root=0)
+    if rank == 0:
+        for other in averages[1:]:
+            if other is not None:
+                average.merge(other)
+        average.write(settings['ensemble_dir'])
+    return world.allreduce(n_failed, op=MPI.SUM)
+
+
+#--------------------------------------------------------------------------
+#
+# Ensemble averages
+#
+#--------------------------------------------------------------------------
+class Average:
+    """Running sums of the bundle logs of the finished runs. The rows of
+    the runs are matched by time; runs that end early only contribute to
+    the times they reached."""
+    def __init__(self):
+        # column names, and count and sum of the rows at each time, of each log
+        self.columns = dict()
+        self.sums    = dict()
+
+    def add(self, rdir):
+        """Adds the logs of the run in directory rdir."""
+        for name in log_names:
+            log = read_log(os.path.join(rdir, 'output'), name)
+            if log is None:
+                continue
+            columns, rows = log
+            self.columns.setdefault(name, columns)
+            sums = self.sums.setdefault(name, dict())
+            for row in rows:
+                key = round(row[0], 4)
+                if key in sums:
+                    sums[key][0] += 1
+                    sums[key][1] += row[1:]
+                else:
+                    sums[key] = [1, row[1:].copy()]
+
+    def merge(self, other):
+        """Adds the sums of another Average object."""
+        for name, other_sums in other.sums.items():
+            self.columns.setdefault(name, other.columns[name])
+            sums = self.sums.setdefault(name, dict())
+            for key, (count, total) in other_sums.items():
+                if key in sums:
+                    sums[key][0] += count
+                    sums[key][1] += total
+                else:
+                    sums[key] = [count, total.copy()]
+
+    def write(self, path):
+        """Writes the averages of each log to directory path, with the
+        number of runs averaged at each time."""
+        for name, sums in self.sums.items():
+            fname = os.path.join(path, name)
+            with open(fname + '.tmp', 'w') as outfile:
+                outfile.write('Time'.rjust(12) +
+                              ''.join(col.rjust(16) for col in self.columns[name][1:]) +
+                              'Runs'.rjust(8) + '\n')
+                for key in sorted(sums):
+                    count, total = sums[key]
+                    outfile.write('{:12.4f}'.format(key) +
+                                  ''.join('{:16.10f}'.format(val) for val in total / count) +
+                                  '{:8d}'.format(count) + '\n')
+            # replace the averages at once, they may be read while running
+            os.replace(fname + '.tmp', fname)
+
+
+def read_log(odir, name):
+    """Returns the column names and rows of bundle log 'name' from the
+    output directory odir, None if the run did not write it."""
+    if os.path.isfile(os.path.join(odir, name)):
+        with open(os.path.join(odir, name), 'r') as infile:
+            columns = infile.readline().split()
+        rows = np.loadtxt(os.path.join(odir, name), skiprows=1, ndmin=2)
+        return columns, rows
+
+    if os.path.isfile(os.path.join(odir, 'output.h5')):
+        import h5py
+        group = 'bundle/' + name[:-4]
+        with h5py.File(os.path.join(odir, 'output.h5'), 'r') as h5file:
+            if group not in h5file:
+                return None
+            columns = ['Time']
+            data    = [h5file[group + '/time'][:]]
+            for dset in sorted(h5file[group]):
+                if dset == 'time':
+                    continue
+                values = h5file[group + '/' + dset][:].reshape(len(data[0]), -1)
+                columns.extend([dset] if values.shape[1] == 1 else
+                               [dset + '.' + str(i) for i in range(values.shape[1])])
+                data.append(values)
+        return columns, np.column_stack(data)
+
+    return None
+
+
+#--------------------------------------------------------------------------
+#
+# Main routine
+#
+#--------------------------------------------------------------------------
+def main(use_mpi):
+    """Sets up and executes the runs of the ensemble. Returns the number
+    of failed runs."""
+    settings = read_settings()
+    scr_base = os.environ.get('TMPDIR')
+
+    rank = 0
+    if use_mpi:
+        import mpi4py.MPI as MPI
+        rank = MPI.COMM_WORLD.Get_rank()
+    if rank == 0:
+        os.makedirs(settings['ensemble_dir'], exist_ok=True)
+        setup_runs(settings)
+    if use_mpi:
+        MPI.COMM_WORLD.Barrier()
+
+    tasks = [(k, run_dir(settings, k), scr_base) for k in range(settings['n_runs'])
+             if run_status(run_dir(settings, k)) != 'done']
+    if use_mpi:
+        return run_mpi(settings, tasks)
+    return run_pool(settings, tasks)
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main('-mpi' in sys.argv) > 0 else 0)
@@ -0,0 +1,132 @@
+"""
+Trajectory and centroid data stacked into arrays for the batched
+integral routines.
+
+A block is built from a list of trajectories (or an array of centroids)
+and gathers each quantity into an array the first time it is requested,
+e.g. block.x has shape (n, dim). take() returns a new block indexed by
+an integer array, so that
+
+    bra = block.take(np.arange(n)[:, np.newaxis])
+    ket = block.take(np.arange(n)[np.newaxis, :])
+
+gives bra and ket arrays of shape (n, 1, dim) and (1, n, dim) that
+broadcast to the full (n, n) set of pairs, while take(i_list) and
+take(j_list) give a flat list of (i, j) pairs.
+"""
+import numpy as np
+import src.fmsio.glbl as glbl
+
+
+class DataBlock:
+    """Base class for the lazily gathered trajectory/centroid blocks."""
+    gather = dict()
+
+    def __init__(self, objs):
+        # objects the data is gathered from
+        self.objs   = objs
+        # block this one was taken from, and the index used to do so
+        self.parent = None
+        self.index  = None
+
+    def __getattr__(self, name):
+        """Gathers (and stores) a quantity the first time it is used."""
+        if name not in type(self).gather:
+            raise AttributeError(name)
+        if self.parent is None:
+            value = type(self).gather[name](self.objs)
+        else:
+            value = getattr(self.parent, name)[self.index]
+        setattr(self, name, value)
+        return value
+
+    def take(self, index):
+        """Returns a new block indexed by the integer array index."""
+        new_block        = type(self)(self.objs)
+        new_block.parent = self
+        new_block.index  = index
+        return new_block
+
+    def state_elem(self, name, s1, s2=None):
+        """Returns quantity 'name' for the state (or pair of states) given
+        for each element of the block.
+
+        The state index (indices) run over the trailing axis (axes) of the
+        quantity, s1/s2 must have one entry for every element of the block.
+        """
+        value = getattr(self, name)
+        if s2 is None:
+            s1  = np.asarray(s1)
+            ind = s1.reshape(s1.shape + (1,)*(value.ndim - s1.ndim))
+            return np.take_along_axis(value, ind, axis=-1)[..., 0]
+
+        s1, s2 = np.broadcast_arrays(s1, s2)
+        shape  = s1.shape + (1,)*(value.ndim - s1.ndim)
+        value  = np.take_along_axis(value, s1.reshape(shape), axis=-2)
+        value  = np.take_along_axis(value, s2.reshape(shape), axis=-1)
+        return value[..., 0, 0]
+
+
+def _traj_array(func, dtype=float):
+    """Returns a function stacking func(traj) over a list of trajectories."""
+    return lambda traj_list: np.array([func(traj) for traj in traj_list],
+                                      dtype=dtype)
+
+
+def _scalar_coup(pes_data):
+    """Returns the scalar coupling matrix, zero if the interface does
+    not provide one."""
+    if 'scalar_coup' in pes_data.data_keys:
+        return pes_data.scalar_coup
+    return np.zeros((pes_data.n_states, pes_data.n_states))
+
+
+class TrajBlock(DataBlock):
+    """Stacked data for a list of trajectories."""
+    gather = dict(
+        label       = _traj_array(lambda t: t.label, dtype=object),
+        state       = _traj_array(lambda t: t.state, dtype=int),
+        phase       = _traj_array(lambda t: t.phase()),
+        widths      = _traj_array(lambda t: t.widths()),
+        x           = _traj_array(lambda t: t.x()),
+        p           = _traj_array(lambda t: t.p()),
+        velocity    = _traj_array(lambda t: t.velocity()),
+        force       = _traj_array(lambda t: t.force()),
+        phase_dot   = _traj_array(lambda t: t.phase_dot()),
+        potential   = _traj_array(lambda t: t.pes_data.potential +
+                                            glbl.propagate['pot_shift']),
+        deriv       = _traj_array(lambda t: t.pes_data.deriv),
+        hessian     = _traj_array(lambda t: t.hessian(t.state)),
+        scalar_coup = _traj_array(lambda t: _scalar_coup(t.pes_data))
+                 )
+
+
+def _cent_array(func):
+    """Returns a function stacking func(centroid) over an object array
+    of centroids. Empty (None) entries are returned as zeros."""
+    def stack(cent_array):
+        cent_list = cent_array.ravel()
+        ref       = next((func(cent) for cent in cent_list
+                          if cent is not None), None)
+        if ref is None:
+            return np.zeros(cent_array.shape)
+        value = np.zeros((len(cent_list),) + np.shape(ref))
+        for i, cent in enumerate(cent_list):
+            if cent is not None:
+                value[i] = func(cent)
+        return value.reshape(cent_array.shape + np.shape(ref))
+    return stack
+
+
+class CentBlock(DataBlock):
+    """Stacked data for an object array of centroids (None where a
+    centroid is not required)."""
+    gather = dict(
+        potential   = _cent_array(lambda c: c.pes_data.potential +
+                                            glbl.propagate['pot_shift']),
+        deriv       = _cent_array(lambda c: c.pes_data.deriv),
+        scalar_coup = _cent_array(lambda c: _scalar_coup(c.pes_data))
+                 )
+
+    def __init__(self, objs):
+        super().__init__(np.asarray(objs, dtype=object))
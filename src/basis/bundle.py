@@ -8,9 +8,14 @@ import scipy.linalg as sp_linalg
 from src.dynamics import timings
 from src.fmsio import glbl as glbl
 from src.fmsio import fileio as fileio
+from src.fmsio import checkpoint as checkpoint
 from src.basis import trajectory as trajectory
+from src.basis import bundlestate as bundlestate
+from src.basis import observables as observables
 from src.basis import centroid as centroid
 from src.basis import hamiltonian as fms_ham
+from src.basis import phasespace as phasespace
+from src.utils import linalg as fms_linalg
 
 
 class Bundle:
@@ -23,6 +28,9 @@ class Bundle:
         self.nstates   = int(nstates)
         self.traj      = []
         self.cent      = []
+        # arrays holding the data of the trajectories, row i belongs to
+        # self.traj[i]. Created when the first trajectory is added
+        self.store     = None
         self.alive     = []
         self.active    = []
         self.T         = np.zeros((0, 0), dtype=complex)
@@ -32,6 +40,12 @@ class Bundle:
         self.Sdot      = np.zeros((0, 0), dtype=complex)
         self.Heff      = np.zeros((0, 0), dtype=complex)
         self.traj_ovrlp= np.zeros((0, 0), dtype=complex)
+        # matrix elements between all trajectories, indexed by label
+        self.ham_cache = fms_ham.MatrixCache()
+        # factorization of the overlap matrix used to form Heff
+        self.s_inverse = fms_linalg.OverlapInverse()
+        # phase space index of the trajectories
+        self.ps_index  = phasespace.PhaseSpaceIndex()
 #        try:
 #            self.integrals=__import__('src.integrals.'+
 #                                       self.integral_type,fromlist=['a'])
@@ -50,7 +64,9 @@ class Bundle:
         new_bundle.time   = copy.copy(self.time)
         new_bundle.nalive = copy.copy(self.nalive)
         new_bundle.ndead  = copy.copy(self.ndead)
+        new_bundle.nactive = copy.copy(self.nactive)
         new_bundle.alive  = copy.deepcopy(self.alive)
+        new_bundle.active = copy.deepcopy(self.active)
         new_bundle.T      = copy.deepcopy(self.T)
         new_bundle.V      = copy.deepcopy(self.V)
         new_bundle.S      = copy.deepcopy(self.S)
@@ -58,10 +74,17 @@ class Bundle:
         new_bundle.Sdot   = copy.deepcopy(self.Sdot)
         new_bundle.Heff   = copy.deepcopy(self.Heff)
         new_bundle.traj_ovrlp = copy.deepcopy(self.traj_ovrlp)
-
-        # copy the trajectory array
+        new_bundle.ham_cache  = self.ham_cache.copy()
+        new_bundle.s_inverse  = self.s_inverse.copy()
+        # the index is never modified in place, it can be shared
+        new_bundle.ps_index   = self.ps_index
+
+        # copy the trajectory data, and create new trajectories
+        # referring to it
+        if self.store is not None:
+            new_bundle.store = self.store.copy()
         for i in range(self.n_traj()):
-            traj_i = self.traj[i].copy()
+            traj_i = self.traj[i].copy(store=new_bundle.store)
             new_bundle.traj.append(traj_i)
 
         # copy the centroid matrix
@@ -75,6 +98,80 @@ class Bundle:
 
         return new_bundle
 
+    @timings.timed
+    def snapshot(self):
+        """Returns a copy of the bundle from which a rejected time step
+        can be rolled back with restore().
+
+        Only the trajectory data is copied. The pes data, centroids,
+        matrices and phase space index are shared with this bundle: a
+        time step replaces them rather than modifying them, so the
+        snapshot keeps the old ones (copy-on-write). The matrix cache
+        and overlap inverse are not part of the snapshot, they detect
+        the changed trajectories themselves.
+        """
+        snap = Bundle(self.nstates)
+        snap.time       = self.time
+        snap.nalive     = self.nalive
+        snap.ndead      = self.ndead
+        snap.nactive    = self.nactive
+        snap.alive      = list(self.alive)
+        snap.active     = list(self.active)
+        snap.T          = self.T
+        snap.V          = self.V
+        snap.S          = self.S
+        snap.Snuc       = self.Snuc
+        snap.Sdot       = self.Sdot
+        snap.Heff       = self.Heff
+        snap.traj_ovrlp = self.traj_ovrlp
+        snap.ps_index   = self.ps_index
+
+        if self.store is not None:
+            snap.store = self.store.copy()
+        snap.traj = [traj.snapshot(store=snap.store) for traj in self.traj]
+        snap.cent = [[None if cent is None else cent.snapshot()
+                      for cent in cent_row] for cent_row in self.cent]
+        return snap
+
+    @timings.timed
+    def restore(self, snap):
+        """Resets the bundle to a snapshot taken with snapshot()."""
+        self.time       = snap.time
+        self.nalive     = snap.nalive
+        self.ndead      = snap.ndead
+        self.nactive    = snap.nactive
+        self.alive      = list(snap.alive)
+        self.active     = list(snap.active)
+        self.T          = snap.T
+        self.V          = snap.V
+        self.S          = snap.S
+        self.Snuc       = snap.Snuc
+        self.Sdot       = snap.Sdot
+        self.Heff       = snap.Heff
+        self.traj_ovrlp = snap.traj_ovrlp
+        self.ps_index   = snap.ps_index
+
+        # trajectories added since the snapshot are dropped
+        n_traj = len(snap.traj)
+        if snap.store is not None:
+            self.store.restore(snap.store)
+        del self.traj[n_traj:]
+        for traj, traj0 in zip(self.traj, snap.traj):
+            traj.pes_data = traj0.pes_data
+
+        # centroids are restored in place, as cent[i][j] and cent[j][i]
+        # may be the same object
+        del self.cent[len(snap.cent):]
+        for cent_row, cent_row0 in zip(self.cent, snap.cent):
+            del cent_row[len(cent_row0):]
+            for j in range(len(cent_row0)):
+                if cent_row0[j] is None:
+                    cent_row[j] = None
+                elif cent_row[j] is None:
+                    cent_row[j] = cent_row0[j].copy()
+                else:
+                    cent_row[j].restore(cent_row0[j])
+
     def n_traj(self):
         """Returns total number of trajectories."""
         return self.nalive + self.ndead
@@ -82,6 +179,7 @@ class Bundle:
     @timings.timed
     def add_trajectory(self, new_traj):
         """Adds a trajectory to the bundle."""
+        self.store_trajectory(new_traj)
         self.nalive         += 1
         self.nactive        += 1
         new_traj.alive       = True
@@ -90,20 +188,16 @@ class Bundle:
         self.alive.append(new_traj.label)
         self.active.append(new_traj.label)
         self.traj.append(new_traj)
-        self.T       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.V       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.S       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Snuc    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Sdot    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Heff    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.traj_ovrlp = np.zeros((self.nalive, self.nalive), dtype=complex)
+        self.select_matrices()
 #        if self.integrals.require_centroids:
         if glbl.integrals.require_centroids:
             self.create_centroids()
+        self.update_index()
 
     def add_trajectories(self, traj_list):
         """Adds a set of trajectories to the bundle."""
         for new_traj in traj_list:
+            self.store_trajectory(new_traj)
             self.nalive         += 1
             self.nactive        += 1
             new_traj.alive       = True
@@ -113,16 +207,11 @@ class Bundle:
             self.active.append(new_traj.label)
             self.traj.append(new_traj)
 
-        self.T       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.V       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.S       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Snuc    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Sdot    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Heff    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.traj_ovrlp = np.zeros((self.nalive, self.nalive), dtype=complex)
+        self.select_matrices()
 #        if self.integrals.require_centroids:
         if glbl.integrals.require_centroids:
             self.create_centroids()
+        self.update_index()
 
     @timings.timed
     def kill_trajectory(self, label):
@@ -138,17 +227,12 @@ class Bundle:
         # Remove the trajectory from the list of active trajectories
         # iff matching pursuit is not being used
         if not glbl.propagate['matching_pursuit']:
-            self.active.remove(tid)
-            self.traj[tid].active = False
+            self.active.remove(label)
+            self.traj[label].active = False
             self.nactive = self.nactive - 1
-        # Reset arrays
-        self.T       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.V       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.S       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Snuc    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Sdot    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Heff    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.traj_ovrlp = np.zeros((self.nalive, self.nalive), dtype=complex)
+        # Select the remaining matrix elements
+        self.select_matrices()
+        self.update_index()
 
     @timings.timed
     def revive_trajectory(self, label):
@@ -158,18 +242,14 @@ class Bundle:
         self.traj[label].alive = True
 
         # Add the trajectory to the list of living trajectories
-        self.alive.insert(label,label)
+        self.alive.append(label)
+        self.alive.sort()
 
         self.nalive          = self.nalive + 1
         self.ndead           = self.ndead - 1
 
-        self.T       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.V       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.S       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Snuc    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Sdot    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Heff    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.traj_ovrlp = np.zeros((self.nalive, self.nalive), dtype=complex)
+        self.select_matrices()
+        self.update_index()
 
     @timings.timed
     def update_amplitudes(self, dt, update_ham=True, H=None, Ct=None):
@@ -193,21 +273,10 @@ class Bundle:
         else:
             old_amp = Ct
 
-        new_amp = np.zeros(self.nalive, dtype=complex)
+        # exp(-i H dt) C(t), by the method set by amp_propagator
+        new_amp = fms_linalg.expm_vec(Hmat, old_amp, dt)
 
-        B = -1j * Hmat * dt
-
-        if self.nalive < 150:
-            # Eigen-decomposition
-            umat = sp_linalg.expm2(B)
-        else:
-            # Pade approximation
-            umat = sp_linalg.expm(B)
-
-        new_amp = np.dot(umat, old_amp)
-
-        for i in range(len(self.alive)):
-            self.traj[self.alive[i]].update_amplitude(new_amp[i])
+        self.set_amplitudes(new_amp)
 
     @timings.timed
     def centroid_required(self, traj_i, traj_j):
@@ -218,15 +287,19 @@ class Bundle:
 #        if not self.integrals.require_centroids:
         if not glbl.integrals.require_centroids:
             return False
-        else:
+        elif glbl.propagate['snuc_thresh'] <= 0.:
             return True
+        # centroids are kept for overlaps down to half the threshold, so
+        # that every pair that is not screened in the hamiltonian has one
+        snuc = glbl.integrals.s_integral(traj_i, traj_j, nuc_only=True)
+        return abs(snuc) >= 0.5 * glbl.propagate['snuc_thresh']
 
     @timings.timed
     def renormalize(self):
         """Renormalizes the amplitudes of the trajectories in the bundle."""
         norm_factor = 1. / np.sqrt(self.norm())
-        for i in range(self.n_traj()):
-            self.traj[i].update_amplitude(self.traj[i].amplitude * norm_factor)
+        if self.store is not None:
+            self.store.amplitude[:self.n_traj()] *= norm_factor
 
     def prune(self):
         """Kills trajectories that are dead."""
@@ -236,56 +309,33 @@ class Bundle:
 
     def amplitudes(self):
         """Returns amplitudes of the trajectories."""
-        return np.array([self.traj[self.alive[i]].amplitude
-                         for i in range(len(self.alive))], dtype=complex)
+        if self.store is None:
+            return np.zeros(0, dtype=complex)
+        return self.store.amplitude[self.alive]
 
     def set_amplitudes(self, amps):
         """Sets the value of the amplitudes."""
-        for i in range(self.nalive):
-            self.traj[self.alive[i]].amplitude = amps[i]
+        if self.store is not None:
+            self.store.amplitude[self.alive] = amps
 
     def mulliken_pop(self, label):
         """Returns the Mulliken-like population."""
-        mulliken = 0.
-
         if not self.traj[label].alive:
-            return mulliken
-        i = self.alive.index(label)
-        for j in range(len(self.alive)):
-            jj = self.alive[j]
-            mulliken += abs(self.traj_ovrlp[i,j] *
-                            self.traj[label].amplitude.conjugate() *
-                            self.traj[jj].amplitude)
-        return mulliken
+            return 0.
+        return observables.mulliken(self.amplitudes(),
+                                    self.traj_ovrlp)[self.alive.index(label)]
 
     @timings.timed
     def norm(self):
         """Returns the norm of the wavefunction """
-        return np.dot(np.dot(np.conj(self.amplitudes()),
-                      self.S),self.amplitudes()).real
+        return observables.norm(self.amplitudes(), self.S)
 
     @timings.timed
     def pop(self):
         """Returns the populations on each of the states."""
-        pop    = np.zeros(self.nstates, dtype=complex)
-        nalive = len(self.alive)
-
-        # live contribution
-        for i in range(nalive):
-            ii = self.alive[i]
-            state = self.traj[ii].state
-            for j in range(nalive):
-                jj = self.alive[j]
-                if self.traj[jj].state != state:
-                    continue
-                popij = (self.traj_ovrlp[i,j]  *
-                         self.traj[jj].amplitude *
-                         self.traj[ii].amplitude.conjugate())
-                pop[state] += popij
-
-        pop /= sum(pop)
-
-        return pop.real
+        amps, states = observables.state_arrays(self)
+        return observables.populations(amps, states, self.traj_ovrlp,
+                                       self.nstates)
 
     @timings.timed
     def pot_classical(self):
@@ -293,18 +343,14 @@ class Bundle:
 
         Currently only includes energy from alive trajectories
         """
-        nalive  = len(self.alive)
-        pot_vec = np.array([self.traj[self.alive[i]].potential()
-                            for i in range(nalive)])
-        return sum(pot_vec)/nalive
+        return observables.classical_energies(self)[0]
 
     @timings.timed
     def pot_quantum(self):
         """Returns the QM (coupled) potential energy of the bundle.
         Currently includes <live|live> (not <dead|dead>,etc,) contributions...
         """
-        return np.dot(np.dot(np.conj(self.amplitudes()),
-                             self.V), self.amplitudes()).real
+        return observables.quantum_energies(self.amplitudes(), self.T, self.V)[0]
         #Sinv = sp_linalg.pinv(self.S)
         #return np.dot(np.dot(np.conj(self.amplitudes()),
         #                     np.dot(Sinv,self.V)),self.amplitudes()).real
@@ -312,28 +358,23 @@ class Bundle:
     @timings.timed
     def kin_classical(self):
         """Returns the classical kinetic energy of the bundle."""
-        nalive   = len(self.alive)
-        kecoef   = glbl.pes.kecoeff
-        ke_vec   = np.array([np.dot(self.traj[self.alive[i]].p()**2, kecoef)
-                           for i in range(nalive)])
-        return sum(ke_vec)/nalive
+        return observables.classical_energies(self)[1]
 
     @timings.timed
     def kin_quantum(self):
         """Returns the QM (coupled) kinetic energy of the bundle."""
-        return np.dot(np.dot(np.conj(self.amplitudes()),
-                             self.T), self.amplitudes()).real
+        return observables.quantum_energies(self.amplitudes(), self.T, self.V)[1]
         #Sinv = sp_linalg.pinv(self.S)
         #return np.dot(np.dot(np.conj(self.amplitudes()),
         #                     np.dot(Sinv,self.T)),self.amplitudes()).real
 
     def tot_classical(self):
         """Returns the total classical energy of the bundle."""
-        return self.pot_classical() + self.kin_classical()
+        return sum(observables.classical_energies(self))
 
     def tot_quantum(self):
         """Returns the total QM (coupled) energy of the bundle."""
-        return self.pot_quantum() + self.kin_quantum()
+        return sum(observables.quantum_energies(self.amplitudes(), self.T, self.V))
 
     def overlap(self, other):
         """Returns the overlap integral of the bundle with another
@@ -353,9 +394,11 @@ class Bundle:
 
     def overlap_traj(self, traj):
         """Returns the overlap of the bundle with a trajectory (assumes the
-        amplitude on the trial trajectory is (1.,0.)"""
+        amplitude on the trial trajectory is (1.,0.). Trajectories with a
+        nuclear overlap below fpzero are neglected."""
         ovrlp = 0j
-        for i in range(self.nalive+self.ndead):
+        for i in self.ps_index.query(traj, glbl.constants['fpzero'],
+                                     alive_only=False):
             ovrlp += (glbl.integrals.traj_overlap(traj,self.traj[i]) *
                       self.traj[i].amplitude)
 #            ovrlp += (self.integrals.traj_overlap(traj,self.traj[i]) *
@@ -367,6 +410,14 @@ class Bundle:
     # Private methods/functions (called only within the class)
     #
     #----------------------------------------------------------------------
+    def store_trajectory(self, new_traj):
+        """Moves the data of a new trajectory into the store of the
+        bundle."""
+        if self.store is None:
+            self.store = bundlestate.BundleState(new_traj.nstates,
+                                                 new_traj.dim)
+        new_traj.move_to(self.store)
+
     @timings.timed
     def create_centroids(self):
         """Increases the centroid 'matrix' to account for new basis functions.
@@ -433,12 +484,34 @@ class Bundle:
         if glbl.integrals.require_centroids:
             (self.traj_ovrlp, self.T, self.V, self.S, self.Snuc, self.Sdot,
              self.Heff) = fms_ham.hamiltonian(self.traj, self.alive,
-                                              cent_list=self.cent)
+                                              cent_list=self.cent,
+                                              cache=self.ham_cache,
+                                              sinv=self.s_inverse)
         else:
 #            (self.traj_ovrlp, self.T, self.V, self.S, self.Snuc, self.Sdot,
 #             self.Heff) = fms_ham.hamiltonian(self.integrals, self.traj, self.alive)
             (self.traj_ovrlp, self.T, self.V, self.S, self.Snuc, self.Sdot,
-             self.Heff) = fms_ham.hamiltonian(self.traj, self.alive)
+             self.Heff) = fms_ham.hamiltonian(self.traj, self.alive,
+                                              cache=self.ham_cache,
+                                              sinv=self.s_inverse)
+
+    @timings.timed
+    def update_index(self):
+        """Rebuilds the phase space index of the trajectories. Needs to be
+        called whenever the trajectories have moved."""
+        self.ps_index = phasespace.PhaseSpaceIndex(self.traj)
+
+    def select_matrices(self):
+        """Selects the matrices of the living trajectories from the cache
+        after the basis has changed.
+
+        Matrix elements involving new trajectories are zero, and Heff is
+        zero, until the next call to update_matrices.
+        """
+        self.ham_cache.reserve(self.n_traj())
+        (self.traj_ovrlp, self.T, self.V, self.S, self.Snuc,
+         self.Sdot) = fms_ham.sparse_matrices(self.ham_cache.select(self.alive))
+        self.Heff = np.zeros((self.nalive, self.nalive), dtype=complex)
 
 
     #------------------------------------------------------------------------
@@ -577,17 +650,18 @@ class Bundle:
                         fileio.print_traj_row(self.traj[i].label, 6, data)
 
         # now dump bundle information ####################################
+        obs = observables.evaluate(self)
 
         # state populations
         data = [self.time]
-        data.extend(self.pop().tolist())
-        data.append(self.norm())
+        data.extend(obs['pop'].tolist())
+        data.append(obs['norm'])
         fileio.print_bund_row(0, data)
 
         # bundle energy
         data = [self.time,
-                self.pot_quantum(), self.kin_quantum(), self.tot_quantum(),
-                self.pot_classical(), self.kin_classical(), self.tot_classical()]
+                obs['pot_quantum'], obs['kin_quantum'], obs['tot_quantum'],
+                obs['pot_classical'], obs['kin_classical'], obs['tot_classical']]
         fileio.print_bund_row(1, data)
 
         # bundle matrices
@@ -603,8 +677,11 @@ class Bundle:
             fileio.print_bund_mat(self.time, 'heff.dat', self.Heff)
             fileio.print_bund_mat(self.time, 'sdot.dat', self.Sdot)
 
-        # dump full bundle to an checkpoint file
+        # append the full bundle to the checkpoint file, and export the
+        # last step as text if requested
         if glbl.printing['print_chkpt']:
+            checkpoint.write_frame(self, fileio.scr_path + '/checkpoint.dat')
+        if glbl.printing['print_chkpt_text']:
             self.write_bundle(fileio.scr_path + '/last_step.dat','w')
 
         # wavepacket autocorrelation function
@@ -613,6 +690,11 @@ class Bundle:
             data = [self.time, auto.real, auto.imag, abs(auto)]
             fileio.print_bund_row(8, data)
 
+        # the logs are written out along with the checkpoint, so that they
+        # are complete up to the step a run is restarted from
+        if glbl.printing['print_chkpt'] or glbl.printing['print_chkpt_text']:
+            fileio.flush_logs()
+
     @timings.timed
     def write_bundle(self, filename, mode):
         """Dumps the bundle to file 'filename'.
@@ -637,11 +719,12 @@ class Bundle:
             self.traj[0].widths().tofile(chkpt, ' ', '%.4f')
             chkpt.write('\ncoordinate masses --\n')
             self.traj[0].masses().tofile(chkpt, ' ', '%.4f')
+            chkpt.write('\n')
 
             # first write out the live trajectories. The function
             # write_trajectory can only write to a pre-existing file stream
             for i in range(len(self.traj)):
-                chkpt.write('\n-------- trajectory {:4d} --------\n'.format(i))
+                chkpt.write('-------- trajectory {:4d} --------\n'.format(i))
                 self.traj[i].write_trajectory(chkpt)
         chkpt.close()
 
@@ -656,10 +739,10 @@ class Bundle:
         # to the requested time
         if t_restart != -1:
             t_found = False
-            last_pos = chkpt.tell()
             for line in chkpt:
                 if 'current time' in line:
-                    if float(line[0]) == t_restart:
+                    # times are written with two decimals
+                    if abs(float(line.split()[0]) - t_restart) < 0.005:
                         t_found = True
                         break
         # else, we're reading from a last_step file -- and we want to skip
@@ -667,13 +750,14 @@ class Bundle:
         else:
             t_found = True
             chkpt.readline()
+            line = chkpt.readline()
 
         if not t_found:
             raise NameError('Could not find time=' + str(t_restart) +
                             ' in ' + str(chkpt.name))
 
         # read common bundle information
-        self.time    = float(chkpt.readline().split()[0])
+        self.time    = float(line.split()[0])
         nalive  = int(chkpt.readline().split()[0])
         ndead   = int(chkpt.readline().split()[0])
         self.nstates = int(chkpt.readline().split()[0])
@@ -701,11 +785,6 @@ class Bundle:
             self.add_trajectory(t_read)
 
         # create the bundle matrices
-        self.T       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.V       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.S       = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Sdot    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.Heff    = np.zeros((self.nalive, self.nalive), dtype=complex)
-        self.traj_ovrlp = np.zeros((self.nalive, self.nalive), dtype=complex)
+        self.select_matrices()
         # once bundle is read, close the stream
         chkpt.close()
@@ -0,0 +1,94 @@
+"""
+The BundleState object: contiguous storage of the trajectory data.
+
+The positions, momenta, phases, amplitudes, etc. of a set of
+trajectories are held in arrays with one row per trajectory, e.g.
+store.x has shape (capacity, dim). A Trajectory refers to a row of a
+store, so that quantities over the whole bundle can be operated on as
+arrays, and a bundle is copied by copying a handful of arrays.
+"""
+import numpy as np
+
+
+class BundleState:
+    """Class constructor for the BundleState object."""
+    def __init__(self, nstates, dim, capacity=1):
+        # number of states and dimensionality of the trajectories
+        self.nstates  = int(nstates)
+        self.dim      = int(dim)
+        # number of rows in use, and number of rows allocated
+        self.n_rows   = 0
+        self.capacity = 0
+        for name, (dtype, shape, init) in self.columns().items():
+            setattr(self, name, np.zeros((0,) + shape, dtype=dtype))
+        self.reserve(capacity)
+
+    def columns(self):
+        """Returns the data type, shape and initial value of each
+        column of the store."""
+        return {'x'         : (float,   (self.dim,),     0.),
+                'p'         : (float,   (self.dim,),     0.),
+                'width'     : (float,   (self.dim,),     0.),
+                'mass'      : (float,   (self.dim,),     0.),
+                'phase'     : (float,   (),              0.),
+                'amplitude' : (complex, (),              0j),
+                'state'     : (int,     (),              0),
+                'alive'     : (bool,    (),              True),
+                'active'    : (bool,    (),              True),
+                'deadtime'  : (float,   (),              -1.),
+                'last_spawn': (float,   (self.nstates,), 0.),
+                'exit_time' : (float,   (self.nstates,), 0.),
+                'potential' : (float,   (self.nstates,), 0.),
+                'stamp'     : (int,     (),              0)}
+
+    def copy(self):
+        """Copys a BundleState object with new references. Only the rows
+        in use are copied."""
+        new_store = BundleState(self.nstates, self.dim, capacity=0)
+        new_store.restore(self)
+        return new_store
+
+    def restore(self, store):
+        """Overwrites the data with that of store, which must have the
+        same shape."""
+        if store.nstates != self.nstates or store.dim != self.dim:
+            raise ValueError('Cannot restore from a store of different ' +
+                             'shape in BundleState.restore')
+        self.reserve(store.n_rows)
+        for name in self.columns():
+            getattr(self, name)[:store.n_rows] = getattr(store, name)[:store.n_rows]
+        self.n_rows = store.n_rows
+
+    def reserve(self, n_rows):
+        """Makes sure the store can hold n_rows rows. The capacity is at
+        least doubled, so that rows are added in amortized constant time."""
+        if n_rows <= self.capacity:
+            return
+        new_cap = max(n_rows, 2 * self.capacity)
+        for name, (dtype, shape, init) in self.columns().items():
+            new_col = np.full((new_cap,) + shape, init, dtype=dtype)
+            new_col[:self.n_rows] = getattr(self, name)[:self.n_rows]
+            setattr(self, name, new_col)
+        self.capacity = new_cap
+
+    def add_row(self, store=None, row=None):
+        """Adds a row to the store and returns its index. If store is
+        given, the data is copied from row 'row' of store, otherwise the
+        row holds the initial values."""
+        self.reserve(self.n_rows + 1)
+        new_row = self.n_rows
+        if store is None:
+            for name, (dtype, shape, init) in self.columns().items():
+                getattr(self, name)[new_row] = init
+        else:
+            self.set_row(new_row, store, row)
+        self.n_rows += 1
+        return new_row
+
+    def set_row(self, row, store, store_row):
+        """Copies row 'store_row' of store into row 'row'."""
+        if store.nstates != self.nstates or store.dim != self.dim:
+            raise ValueError('Cannot copy a row between stores of ' +
+                             'different shape in BundleState.set_row')
+        for name in self.columns():
+            getattr(self, name)[row] = getattr(store, name)[store_row]
@@ -59,7 +59,6 @@ class Centroid:
         # data structure to hold the data from the interface
         self.pes_data  = None
 
-    @timings.timed
     def copy(self):
         """Copys a Centroid object with new references."""
         new_cent = Centroid(nstates=self.nstates, pstates=self.pstates,
@@ -70,6 +69,24 @@ class Centroid:
             new_cent.pes_data = self.pes_data.copy()
         return new_cent
 
+    def snapshot(self):
+        """Returns a copy of the centroid that shares its position,
+        momentum and pes data with this one. These are replaced, never
+        modified, when the centroid moves."""
+        new_cent = Centroid(nstates=self.nstates, pstates=self.pstates,
+                            dim=self.dim, width=self.width,label=self.label)
+        new_cent.parent   = self.parent
+        new_cent.pos      = self.pos
+        new_cent.mom      = self.mom
+        new_cent.pes_data = self.pes_data
+        return new_cent
+
+    def restore(self, snap):
+        """Resets the centroid to a snapshot taken with snapshot()."""
+        self.pos      = snap.pos
+        self.mom      = snap.mom
+        self.pes_data = snap.pes_data
+
     #----------------------------------------------------------------------
     #
     # Functions for setting basic pes information from centroid
@@ -114,30 +131,32 @@ class Centroid:
     # Functions to update information about the potential energy surface
     #
     #--------------------------------------------------------------------
+    def check_geom(self, caller):
+        """Warns if the pes data was not computed at the current position.
+        Only done if debug_checks is set."""
+        if (glbl.printing['debug_checks'] and
+                np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']):
+            print('WARNING: centroid.' + caller + '() called, ' +
+                  'but pes_geom != centroid.x(). ID=' + str(self.label))
+
     def energy(self, state):
         """Returns the potential energies.
 
         Add the energy shift right here. If not current, recompute them.
         """
-        if np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']:
-            print('WARNING: centroid.energy() called, ' +
-                  'but pes_geom != centroid.x(). ID=' + str(self.label))
+        self.check_geom('energy')
         return self.pes_data.potential[state] + glbl.propagate['pot_shift']
 
     def derivative(self, state_i, state_j):
         """Returns either a gradient or derivative coupling depending
            on the states in pstates.
         """
-        if np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']:
-            print('WARNING: trajectory.derivative() called, ' +
-                  'but pes_geom != trajectory.x(). ID=' + str(self.label))
+        self.check_geom('derivative')
         return self.pes_data.deriv[:,state_i, state_j]
 
     def scalar_coup(self, state_i, state_j):
         """Returns the scalar coupling."""
-        if np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']:
-            print('WARNING: trajectory.scalar_coup() called, ' +
-                  'but pes_geom != trajectory.x(). ID=' + str(self.label))
+        self.check_geom('scalar_coup')
         if 'scalar_coup' in self.pes_data.data_keys:
             return self.pes_data.scalar_coup[state_i, state_j]
         return 0.
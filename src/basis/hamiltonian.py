@@ -16,10 +16,13 @@ As a matter of course, this function also builds:
 import sys
 import numpy as np
 import scipy.linalg as sp_linalg
+import scipy.sparse as sp_sparse
+import mpi4py.MPI as MPI
 import src.dynamics.timings as timings
 import src.fmsio.glbl as glbl
-import src.fmsio.fileio as fileio
 import src.utils.linalg as fms_linalg
+import src.basis.phasespace as phasespace
+from src.basis.block import TrajBlock, CentBlock
 
 def ut_ind(index):
     """Gets the (i,j) index of an upper triangular matrix from the
@@ -34,9 +37,148 @@ def sq_ind(index, n):
     sequential matrix index 'index'"""
     return index // n, index % n
 
+def mpi_block(n_elem):
+    """Returns the range [start, end) of the sequential matrix indices
+    evaluated by this process. The indices are split in contiguous blocks
+    over the MPI ranks."""
+    if not glbl.mpi['parallel']:
+        return 0, n_elem
+    rank  = glbl.mpi['rank']
+    nproc = glbl.mpi['nproc']
+    return n_elem * rank // nproc, n_elem * (rank+1) // nproc
+
+def mpi_sum(mats):
+    """Sums the partial matrices computed by each MPI rank, returns the
+    complete matrices on all ranks."""
+    if not glbl.mpi['parallel']:
+        return mats
+    total = np.array(mats, dtype=complex)
+    glbl.mpi['comm'].Allreduce(MPI.IN_PLACE, [total, MPI.DOUBLE_COMPLEX],
+                               op=MPI.SUM)
+    return tuple(total)
+
+@timings.timed
+def hamiltonian(traj_list, traj_alive, cent_list=None, cache=None,
+                sinv=None):
+    """Builds the Hamiltonian matrix from a list of trajectories.
+
+    If a MatrixCache is given, only the rows and columns of trajectories
+    that changed since the last call are recomputed. If an OverlapInverse
+    is given and sinv_method is not 'pinv', it is updated and used to
+    apply S^-1 when forming Heff.
+
+    The nuclear and electronic parts of Sdot are no longer written to
+    sdot_nuc and sdot_ele in the scratch directory: the integral modules
+    do not separate them (sdot_integral ignores nuc_only and e_only, when
+    it accepts them), so both files held Sdot, which is written to
+    sdot.dat with print_matrices.
+    """
+
+    if cache is not None:
+        cache.update(traj_list, traj_alive, cent_list)
+        (t_ovrlp, T, V, S, Snuc, Sdot) = cache.select(traj_alive)
+    elif hasattr(glbl.integrals, 'batch_integrals'):
+        (t_ovrlp, T, V, S, Snuc, Sdot) = batch_matrices(traj_list, traj_alive,
+                                                        cent_list)
+    else:
+        (t_ovrlp, T, V, S, Snuc, Sdot) = loop_matrices(traj_list, traj_alive,
+                                                       cent_list)
+
+    # Hamiltonian matrix in non-orthogonal basis
+    H = T + V
+
+    # S^-1 and Heff are computed on rank 0 only, and broadcast
+    if glbl.mpi['rank'] != 0:
+        Heff = np.zeros(H.shape, dtype=complex)
+    elif sinv is not None and glbl.propagate['sinv_method'] != 'pinv':
+        # update the factorization of S and apply S^-1 to H - iSdot
+        sinv.update(S, traj_alive, hermitian=glbl.integrals.hermitian)
+        Heff = sinv.solve(H - 1j * Sdot)
+    else:
+        if glbl.integrals.hermitian:
+            # compute the S^-1, needed to compute Heff
+            timings.start('linalg.pinvh')
+            Sinv = sp_linalg.pinvh(S)
+#            Sinv, cond = fms_linalg.pseudo_inverse2(S)
+            timings.stop('linalg.pinvh')
+        else:
+            # compute the S^-1, needed to compute Heff
+            timings.start('hamiltonian.pseudo_inverse')
+            Sinv, cond = fms_linalg.pseudo_inverse(S)
+            timings.stop('hamiltonian.pseudo_inverse')
+
+        Heff = np.dot( Sinv, H - 1j * Sdot )
+
+    if glbl.mpi['parallel']:
+        Heff = np.ascontiguousarray(Heff, dtype=complex)
+        glbl.mpi['comm'].Bcast([Heff, MPI.DOUBLE_COMPLEX], root=0)
+
+    (t_ovrlp, T, V, S, Snuc, Sdot) = sparse_matrices((t_ovrlp, T, V, S,
+                                                      Snuc, Sdot))
+
+    return t_ovrlp, T, V, S, Snuc, Sdot, Heff
+
 @timings.timed
-def hamiltonian(traj_list, traj_alive, cent_list=None):
-    """Builds the Hamiltonian matrix from a list of trajectories."""
+def batch_matrices(traj_list, traj_alive, cent_list=None):
+    """Evaluates all matrix elements between the living trajectories at
+    once using the batch_integrals routine of the integral module.
+
+    If the integrals are hermitian, only the upper triangle is evaluated
+    and the lower triangle is set from it, except for Sdot (which is not
+    hermitian in general).
+    """
+    n_alive = len(traj_alive)
+    block   = TrajBlock([traj_list[i] for i in traj_alive])
+    if glbl.integrals.hermitian:
+        i_ind, j_ind = np.triu_indices(n_alive)
+    else:
+        i_ind, j_ind = np.indices((n_alive, n_alive)).reshape(2, -1)
+
+    if glbl.integrals.require_centroids:
+        cent = CentBlock([cent_list[traj_alive[i]][traj_alive[j]]
+                          for i, j in zip(i_ind, j_ind)])
+    else:
+        cent = None
+
+    values = batch_pairs(block, i_ind, j_ind, cent=cent)
+    mats   = tuple(np.zeros((n_alive, n_alive), dtype=complex)
+                   for i in range(6))
+    for mat, value in zip(mats, values):
+        mat[i_ind, j_ind] = value
+
+    if glbl.integrals.hermitian:
+        off = i_ind != j_ind
+        for mat, value in zip(mats[:5], values[:5]):
+            mat[j_ind[off], i_ind[off]] = value[off].conjugate()
+        mats[5][j_ind[off], i_ind[off]] = values[6][off]
+
+    return mats
+
+def batch_pairs(block, i_ind, j_ind, cent=None, Snuc=None):
+    """Returns the t_ovrlp, T, V, S, Snuc and Sdot elements of the pairs
+    (i_ind[k], j_ind[k]) of trajectories in block, followed by the Sdot
+    elements of the reversed pairs (j_ind[k], i_ind[k]).
+
+    The reversed Sdot is only evaluated if the integrals are hermitian (it
+    is zero otherwise): the other matrices of the reversed pairs are then
+    the conjugates of those of the pairs.
+    """
+    bra    = block.take(i_ind)
+    ket    = block.take(j_ind)
+    values = glbl.integrals.batch_integrals(bra, ket, cent=cent, Snuc=Snuc)
+    if glbl.integrals.hermitian:
+        Sdot_rev = glbl.integrals.batch_sdot(ket, bra,
+                                             Snuc=values[4].conjugate())
+    else:
+        Sdot_rev = np.zeros(len(i_ind), dtype=complex)
+    return tuple(values) + (Sdot_rev,)
+
+def loop_matrices(traj_list, traj_alive, cent_list=None):
+    """Evaluates the matrix elements one pair of trajectories at a time.
+
+    If running in parallel, each MPI rank evaluates a block of the
+    sequential (upper triangle) matrix indices.
+    """
 
     n_alive = len(traj_alive)
     if glbl.integrals.hermitian:
@@ -46,18 +188,14 @@ def hamiltonian(traj_list, traj_alive, cent_list=None):
 
     T       = np.zeros((n_alive, n_alive), dtype=complex)
     V       = np.zeros((n_alive, n_alive), dtype=complex)
-    H       = np.zeros((n_alive, n_alive), dtype=complex)
     S       = np.zeros((n_alive, n_alive), dtype=complex)
     Snuc    = np.zeros((n_alive, n_alive), dtype=complex)
-    Sinv    = np.zeros((n_alive, n_alive), dtype=complex)
     Sdot    = np.zeros((n_alive, n_alive), dtype=complex)
-    Heff    = np.zeros((n_alive, n_alive), dtype=complex)
     t_ovrlp = np.zeros((n_alive, n_alive), dtype=complex)
-    Sdnuc   = np.zeros((n_alive, n_alive), dtype=complex)
-    Sdele   = np.zeros((n_alive, n_alive), dtype=complex)
 
     # now evaluate the hamiltonian matrix
-    for ij in range(n_elem):
+    ij_start, ij_end = mpi_block(n_elem)
+    for ij in range(ij_start, ij_end):
         if glbl.integrals.hermitian:
             i, j = ut_ind(ij)
         else:
@@ -79,10 +217,6 @@ def hamiltonian(traj_list, traj_alive, cent_list=None):
         # time-derivative of the overlap matrix (not hermitian in general)
         Sdot[i,j] = glbl.integrals.sdot_integral(traj_list[ii], 
                                        traj_list[jj], Snuc=Snuc[i,j])
-        Sdnuc[i,j] = glbl.integrals.sdot_integral(traj_list[ii],
-                                       traj_list[jj], Snuc=Snuc[i,j],nuc_only=True)
-        Sdele[i,j] = glbl.integrals.sdot_integral(traj_list[ii],
-                                       traj_list[jj], Snuc=Snuc[i,j],e_only=True)
 
         # kinetic energy matrix
         T[i,j]    = glbl.integrals.ke_integral(traj_list[ii], 
@@ -96,9 +230,6 @@ def hamiltonian(traj_list, traj_alive, cent_list=None):
             V[i,j] = glbl.integrals.v_integral(traj_list[ii], 
                                      traj_list[jj], Snuc=Snuc[i,j])
 
-        # Hamiltonian matrix in non-orthogonal basis
-        H[i,j] = T[i,j] + V[i,j]
-
         # if hermitian matrix, set (j,i) indices
         if glbl.integrals.hermitian and i!=j:
             Snuc[j,i]    = Snuc[i,j].conjugate()
@@ -106,30 +237,203 @@ def hamiltonian(traj_list, traj_alive, cent_list=None):
             t_ovrlp[j,i] = t_ovrlp[i,j].conjugate()
             Sdot[j,i]    = glbl.integrals.sdot_integral(traj_list[jj],
                                               traj_list[ii], Snuc=Snuc[j,i])
-            Sdnuc[j,i] = glbl.integrals.sdot_integral(traj_list[jj],
-                                       traj_list[ii], Snuc=Snuc[j,i],nuc_only=True)
-            Sdele[j,i] = glbl.integrals.sdot_integral(traj_list[jj],
-                                       traj_list[ii], Snuc=Snuc[j,i],e_only=True)
 
             T[j,i]       = T[i,j].conjugate()
             V[j,i]       = V[i,j].conjugate()
-            H[j,i]       = H[i,j].conjugate()
 
-    if glbl.integrals.hermitian:
-        # compute the S^-1, needed to compute Heff
-        timings.start('linalg.pinvh')
-        Sinv = sp_linalg.pinvh(S)
-#        Sinv, cond = fms_linalg.pseudo_inverse2(S)
-        timings.stop('linalg.pinvh')
-    else:
-        # compute the S^-1, needed to compute Heff
-        timings.start('hamiltonian.pseudo_inverse')
-        Sinv, cond = fms_linalg.pseudo_inverse(S)
-        timings.stop('hamiltonian.pseudo_inverse')
+    return mpi_sum((t_ovrlp, T, V, S, Snuc, Sdot))
 
-    Heff = np.dot( Sinv, H - 1j * Sdot )
-    
-    fileio.print_bund_mat(0., 'sdot_nuc', Sdnuc)
-    fileio.print_bund_mat(0., 'sdot_ele', Sdele)
+def pair_matrices(traj_list, traj_alive, i_ind, j_ind, cent_list=None):
+    """Evaluates the matrix elements for the list of pairs (i_ind[k],
+    j_ind[k]), where i_ind and j_ind index the list of living
+    trajectories. Returns one array per matrix holding the element for
+    each pair, followed by the Sdot elements of the reversed pairs (see
+    batch_pairs).
 
-    return t_ovrlp, T, V, S, Snuc, Sdot, Heff
+    If running in parallel, each MPI rank evaluates a contiguous block of
+    the pairs.
+    """
+    if not glbl.mpi['parallel']:
+        return pair_integrals(traj_list, traj_alive, i_ind, j_ind, cent_list)
+
+    k_start, k_end = mpi_block(len(i_ind))
+    mats = np.zeros((7, len(i_ind)), dtype=complex)
+    if k_end > k_start:
+        mats[:, k_start:k_end] = pair_integrals(traj_list, traj_alive,
+                                                i_ind[k_start:k_end],
+                                                j_ind[k_start:k_end],
+                                                cent_list)
+    return mpi_sum(mats)
+
+def pair_integrals(traj_list, traj_alive, i_ind, j_ind, cent_list=None):
+    """Evaluates the integrals for the pairs (i_ind[k], j_ind[k]).
+
+    If snuc_thresh is set, the nuclear overlap is computed first for the
+    pairs that are close enough in phase space, and the remaining
+    integrals are only evaluated for pairs with |Snuc| >= snuc_thresh,
+    all other elements are zero. If the integrals are hermitian, Sdot of
+    the reversed pairs (j_ind[k], i_ind[k]) is returned as well.
+    """
+    n_pair = len(i_ind)
+    thresh = glbl.propagate['snuc_thresh']
+    mats   = tuple(np.zeros(n_pair, dtype=complex) for i in range(7))
+
+    if hasattr(glbl.integrals, 'batch_integrals'):
+        block = TrajBlock([traj_list[i] for i in traj_alive])
+        Snuc  = None
+        keep  = np.arange(n_pair)
+        if thresh > 0.:
+            n_alive        = len(traj_alive)
+            near_i, near_j = phasespace.overlap_pairs(block.widths, block.x,
+                                                      block.p, thresh)
+            keep = keep[np.isin(i_ind * n_alive + j_ind,
+                                near_i * n_alive + near_j)]
+            Snuc = glbl.integrals.batch_nuc_overlap(block.take(i_ind[keep]),
+                                                    block.take(j_ind[keep]))
+            big  = (np.abs(Snuc) >= thresh) | (i_ind[keep] == j_ind[keep])
+            keep = keep[big]
+            Snuc = Snuc[big]
+        if glbl.integrals.require_centroids:
+            cent = CentBlock([cent_list[traj_alive[i_ind[k]]][traj_alive[j_ind[k]]]
+                              for k in keep])
+        else:
+            cent = None
+        values = batch_pairs(block, i_ind[keep], j_ind[keep], cent=cent,
+                             Snuc=Snuc)
+        for mat, value in zip(mats, values):
+            mat[keep] = value
+        return mats
+
+    (t_ovrlp, T, V, S, Snuc, Sdot, Sdot_rev) = mats
+    for k in range(n_pair):
+        traj_i = traj_list[traj_alive[i_ind[k]]]
+        traj_j = traj_list[traj_alive[j_ind[k]]]
+
+        Snuc[k]    = glbl.integrals.s_integral(traj_i, traj_j, nuc_only=True)
+        if abs(Snuc[k]) < thresh and i_ind[k] != j_ind[k]:
+            Snuc[k] = 0.
+            continue
+        t_ovrlp[k] = glbl.integrals.traj_overlap(traj_i, traj_j, Snuc=Snuc[k])
+        S[k]       = glbl.integrals.s_integral(traj_i, traj_j, Snuc=Snuc[k])
+        Sdot[k]    = glbl.integrals.sdot_integral(traj_i, traj_j, Snuc=Snuc[k])
+        if glbl.integrals.hermitian:
+            Sdot_rev[k] = glbl.integrals.sdot_integral(traj_j, traj_i,
+                                                  Snuc=Snuc[k].conjugate())
+        T[k]       = glbl.integrals.ke_integral(traj_i, traj_j, Snuc=Snuc[k])
+        if glbl.integrals.require_centroids:
+            V[k] = glbl.integrals.v_integral(traj_i, traj_j,
+                           centroid=cent_list[traj_i.label][traj_j.label],
+                           Snuc=Snuc[k])
+        else:
+            V[k] = glbl.integrals.v_integral(traj_i, traj_j, Snuc=Snuc[k])
+
+    return mats
+
+def sparse_matrices(mats):
+    """Returns the matrices in compressed sparse row format if the overlap
+    screening is turned on (snuc_thresh > 0)."""
+    if glbl.propagate['snuc_thresh'] <= 0.:
+        return mats
+    return tuple(sp_sparse.csr_matrix(mat) for mat in mats)
+
+class MatrixCache:
+    """Matrix elements between all the trajectories (alive or dead) that
+    have been part of a bundle, indexed by trajectory label.
+
+    The buffers grow by doubling their size as trajectories are added.
+    The stamp and state of each trajectory are stored when its matrix
+    elements are evaluated: a trajectory whose stamp or state has since
+    changed is dirty, and only the rows and columns of dirty (or newly
+    added) trajectories are recomputed by update().
+    """
+    names = ('t_ovrlp', 'T', 'V', 'S', 'Snuc', 'Sdot')
+
+    def __init__(self):
+        self.mats  = {name: np.zeros((0, 0), dtype=complex)
+                      for name in self.names}
+        # pairs of trajectories whose matrix elements are current
+        self.valid = np.zeros((0, 0), dtype=bool)
+        # stamp and state of the trajectories when last evaluated
+        self.stamp = np.zeros(0, dtype=int)
+        self.state = np.zeros(0, dtype=int)
+
+    def copy(self):
+        """Copys a MatrixCache object with new references."""
+        new_cache       = MatrixCache()
+        new_cache.mats  = {name: mat.copy() for name, mat in self.mats.items()}
+        new_cache.valid = self.valid.copy()
+        new_cache.stamp = self.stamp.copy()
+        new_cache.state = self.state.copy()
+        return new_cache
+
+    def capacity(self):
+        """Returns the number of trajectories the buffers can hold."""
+        return len(self.stamp)
+
+    def reserve(self, n_traj):
+        """Makes sure the buffers can hold n_traj trajectories."""
+        n_old = self.capacity()
+        if n_traj <= n_old:
+            return
+
+        n_new = max(n_traj, 2 * n_old)
+        for name in self.names:
+            mat = np.zeros((n_new, n_new), dtype=complex)
+            mat[:n_old, :n_old] = self.mats[name]
+            self.mats[name] = mat
+        valid = np.zeros((n_new, n_new), dtype=bool)
+        valid[:n_old, :n_old] = self.valid
+        self.valid = valid
+        self.stamp = np.append(self.stamp, np.full(n_new - n_old, -1))
+        self.state = np.append(self.state, np.full(n_new - n_old, -1))
+
+    def select(self, traj_alive):
+        """Returns the t_ovrlp, T, V, S, Snuc and Sdot matrices between the
+        living trajectories. Elements that are not current are zero."""
+        index = np.ix_(traj_alive, traj_alive)
+        valid = self.valid[index]
+        return tuple(np.where(valid, self.mats[name][index], 0j)
+                     for name in self.names)
+
+    @timings.timed
+    def update(self, traj_list, traj_alive, cent_list=None):
+        """Recomputes the matrix elements involving dirty trajectories."""
+        self.reserve(len(traj_list))
+        labels = np.array(traj_alive, dtype=int)
+        stamp  = np.array([traj_list[i].stamp for i in traj_alive], dtype=int)
+        state  = np.array([traj_list[i].state for i in traj_alive], dtype=int)
+
+        # invalidate the rows/columns of trajectories that have changed
+        dirty = labels[(stamp != self.stamp[labels]) |
+                       (state != self.state[labels])]
+        self.valid[dirty, :] = False
+        self.valid[:, dirty] = False
+
+        # recompute the pairs that are not current. If the integrals are
+        # hermitian, only the upper triangle is evaluated
+        i_ind, j_ind = np.nonzero(~self.valid[np.ix_(labels, labels)])
+        if glbl.integrals.hermitian:
+            upper = i_ind <= j_ind
+            i_ind = i_ind[upper]
+            j_ind = j_ind[upper]
+        if len(i_ind) == 0:
+            return
+        values = pair_matrices(traj_list, traj_alive, i_ind, j_ind, cent_list)
+
+        i_lbl = labels[i_ind]
+        j_lbl = labels[j_ind]
+        for name, value in zip(self.names, values):
+            self.mats[name][i_lbl, j_lbl] = value
+        self.valid[i_lbl, j_lbl] = True
+
+        # if hermitian matrix, set the lower triangle from the upper one
+        # (Sdot is not hermitian in general, it is evaluated separately)
+        if glbl.integrals.hermitian:
+            off = i_lbl != j_lbl
+            for name, value in zip(self.names[:5], values[:5]):
+                self.mats[name][j_lbl[off], i_lbl[off]] = value[off].conjugate()
+            self.mats['Sdot'][j_lbl[off], i_lbl[off]] = values[6][off]
+            self.valid[j_lbl, i_lbl] = True
+
+        self.stamp[labels] = stamp
+        self.state[labels] = state
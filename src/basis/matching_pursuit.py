@@ -89,7 +89,7 @@ def select_basfunc(residual):
     indx = -1
     maxovrlp = 0.
     for i in range(residual.nalive + residual.ndead):
-        ovrlp = residual.traj[i].overlap_bundle(residual)
+        ovrlp = residual.overlap_traj(residual.traj[i])
         if abs(ovrlp) > abs(maxovrlp) and i not in selected:
             maxovrlp = ovrlp
             indx = i
@@ -119,7 +119,7 @@ def coeff_basfunc(residual,master):
         for j in range(nbas):
             jindx = selected[j]
             coe += (sinv[i,j] *
-                    residual.traj[jindx].overlap_bundle(master))
+                    master.overlap_traj(residual.traj[jindx]))
         coeff[i] = coe
 
 
@@ -0,0 +1,96 @@
+"""
+Observables of a bundle: state populations, norm, quantum and classical
+energies and Mulliken populations.
+
+The observables are computed from arrays: the amplitudes, states,
+momenta and potential energies of the living trajectories, read from
+the store of the bundle, and the matrices of the bundle (traj_ovrlp,
+S, T and V, dense or sparse). evaluate() returns all of them in a single
+pass, the functions below it work on the arrays directly.
+"""
+import numpy as np
+import scipy.sparse as sp_sparse
+import src.fmsio.glbl as glbl
+import src.dynamics.timings as timings
+
+
+@timings.timed
+def evaluate(master, mulliken_pop=False):
+    """Returns a dict of the observables of the bundle master: the state
+    populations 'pop', the norm, the quantum and classical potential,
+    kinetic and total energies ('pot_quantum', 'kin_classical', ...) and,
+    if mulliken_pop is set, the Mulliken populations of the living
+    trajectories, 'mulliken'."""
+    amps, states = state_arrays(master)
+
+    obs = dict(pop  = populations(amps, states, master.traj_ovrlp, master.nstates),
+               norm = norm(amps, master.S))
+    obs['pot_quantum'], obs['kin_quantum'] = quantum_energies(amps, master.T,
+                                                              master.V)
+    obs['pot_classical'], obs['kin_classical'] = classical_energies(master)
+    obs['tot_quantum']   = obs['pot_quantum'] + obs['kin_quantum']
+    obs['tot_classical'] = obs['pot_classical'] + obs['kin_classical']
+    if mulliken_pop:
+        obs['mulliken'] = mulliken(amps, master.traj_ovrlp)
+    return obs
+
+
+def state_arrays(master):
+    """Returns the amplitudes and the states of the living trajectories."""
+    if master.store is None:
+        return np.zeros(0, dtype=complex), np.zeros(0, dtype=int)
+    return master.store.amplitude[master.alive], master.store.state[master.alive]
+
+
+def populations(amps, states, ovrlp, nstates):
+    """Returns the populations on each of the states, normalized to one.
+
+    The amplitudes on each state are the columns of a masked amplitude
+    matrix, so that the populations take a single product with the
+    trajectory overlap matrix ovrlp.
+    """
+    amp_st = np.where(states[:, np.newaxis] == np.arange(nstates),
+                      amps[:, np.newaxis], 0j)
+    pop    = np.einsum('is,is->s', amp_st.conj(), ovrlp.dot(amp_st))
+    pop   /= sum(pop)
+    return pop.real
+
+
+def norm(amps, S):
+    """Returns the norm of the wavefunction with overlap matrix S."""
+    return np.vdot(amps, S.dot(amps)).real
+
+
+def quantum_energies(amps, T, V):
+    """Returns the QM (coupled) potential and kinetic energies. Only
+    includes <live|live> contributions."""
+    return np.vdot(amps, V.dot(amps)).real, np.vdot(amps, T.dot(amps)).real
+
+
+def classical_energies(master):
+    """Returns the classical potential and kinetic energies, averaged over
+    the living trajectories."""
+    nalive = len(master.alive)
+    if nalive == 0:
+        return 0., 0.
+    pot, kin = traj_energies(master, master.alive)
+    return sum(pot) / nalive, sum(kin) / nalive
+
+
+def traj_energies(master, rows):
+    """Returns the classical potential and kinetic energies of the
+    trajectories in rows."""
+    pot = (master.store.potential[rows, master.store.state[rows]] +
+           glbl.propagate['pot_shift'])
+    kin = np.dot(master.store.p[rows]**2, glbl.pes.kecoeff)
+    return pot, kin
+
+
+def mulliken(amps, ovrlp):
+    """Returns the Mulliken-like populations of the living trajectories,
+    sum_j |ovrlp_ij c_i^* c_j|."""
+    if sp_sparse.issparse(ovrlp):
+        coo = ovrlp.tocoo()
+        return np.bincount(coo.row, np.abs(coo.data * amps.conj()[coo.row] *
+                                           amps[coo.col]), minlength=len(amps))
+    return np.abs(ovrlp * np.outer(amps.conj(), amps)).sum(axis=1)
@@ -0,0 +1,146 @@
+"""
+A spatial index (KD-tree) over the phase space centers of the
+trajectories of a bundle.
+
+For two frozen gaussians with the same widths a, the magnitude of the
+nuclear overlap depends only on the distance between the points
+
+    z = (sqrt(a/2) * x, p / sqrt(8a))
+
+as |S| = exp(-|z1 - z2|^2). All trajectories with |S| >= tau of a given
+point therefore lie within a ball of radius sqrt(-ln tau) around it,
+which the KD-tree finds without visiting every trajectory. If the basis
+is not gaussian, or the widths are not the same for every trajectory,
+the index returns every trajectory as a candidate.
+"""
+import numpy as np
+import scipy.spatial as sp_spatial
+import src.fmsio.glbl as glbl
+
+# relative padding of the search radius, so that pairs right at the
+# threshold are not lost to round-off
+radius_pad = 1.e-8
+
+
+def phase_coords(widths, x, p):
+    """Returns the width-scaled phase space coordinates of gaussians
+    centered at (x, p). The last axis runs over the degrees of freedom."""
+    return np.concatenate((np.sqrt(0.5 * widths) * x,
+                           p / np.sqrt(8. * widths)), axis=-1)
+
+
+def overlap_radius(min_overlap):
+    """Returns the phase space distance corresponding to an overlap
+    of min_overlap."""
+    if min_overlap <= 0.:
+        return np.inf
+    return np.sqrt(max(-np.log(min(min_overlap, 1.)), 0.)) * (1. + radius_pad)
+
+
+def uniform_widths(widths):
+    """Returns True if the index applies to gaussians with these widths,
+    i.e. the basis is gaussian and all the widths are the same."""
+    if glbl.integrals is None or glbl.integrals.basis != 'gaussian':
+        return False
+    return len(widths) == 0 or np.all(widths == widths[0])
+
+
+def overlap_pairs(widths, x, p, min_overlap):
+    """Returns the indices (i, j) of all ordered pairs of gaussians,
+    including i == j, whose overlap may be >= min_overlap."""
+    n_traj = len(x)
+    if not uniform_widths(widths) or min_overlap <= 0.:
+        i_ind, j_ind = np.nonzero(np.ones((n_traj, n_traj), dtype=bool))
+        return i_ind, j_ind
+
+    tree  = sp_spatial.cKDTree(phase_coords(widths, x, p))
+    pairs = tree.query_pairs(overlap_radius(min_overlap), output_type='ndarray')
+    diag  = np.arange(n_traj)
+    i_ind = np.concatenate((pairs[:, 0], pairs[:, 1], diag))
+    j_ind = np.concatenate((pairs[:, 1], pairs[:, 0], diag))
+    return i_ind, j_ind
+
+
+class PhaseSpaceIndex:
+    """KD-trees (one per electronic state) over the phase space centers
+    of a list of trajectories."""
+    def __init__(self, traj_list=None):
+        # labels of the trajectories on each state, and their trees
+        self.labels = dict()
+        self.trees  = dict()
+        self.alive  = dict()
+        self.width  = None
+        # if False, queries return every trajectory
+        self.exact  = False
+        if traj_list is not None:
+            self.build(traj_list)
+
+    def build(self, traj_list):
+        """Builds the index from the current positions and momenta of
+        a list of trajectories."""
+        self.labels = dict()
+        self.trees  = dict()
+        self.alive  = dict()
+        if len(traj_list) == 0:
+            self.exact = False
+            return
+
+        widths     = np.array([traj.widths() for traj in traj_list])
+        self.exact = uniform_widths(widths)
+        self.width = widths[0]
+        states     = np.array([traj.state for traj in traj_list], dtype=int)
+        labels     = np.array([traj.label for traj in traj_list], dtype=int)
+        alive      = np.array([traj.alive for traj in traj_list], dtype=bool)
+        if self.exact:
+            coords = phase_coords(widths, np.array([traj.x() for traj in traj_list]),
+                                  np.array([traj.p() for traj in traj_list]))
+
+        for state in np.unique(states):
+            on_state           = states == state
+            self.labels[state] = labels[on_state]
+            self.alive[state]  = alive[on_state]
+            if self.exact:
+                self.trees[state] = sp_spatial.cKDTree(coords[on_state])
+
+    def query(self, traj, min_overlap, state=None, alive_only=True):
+        """Returns the labels of the trajectories (on state, if given)
+        that may have a nuclear overlap >= min_overlap with traj."""
+        states = self.labels.keys() if state is None else [state]
+        exact  = self.exact and np.all(traj.widths() == self.width)
+        found  = []
+        for st in states:
+            if st not in self.labels:
+                continue
+            if exact:
+                z   = phase_coords(traj.widths(), traj.x(), traj.p())
+                ind = np.array(self.trees[st].query_ball_point(
+                               z, overlap_radius(min_overlap)), dtype=int)
+            else:
+                ind = np.arange(len(self.labels[st]))
+            if alive_only:
+                ind = ind[self.alive[st][ind]]
+            found.extend(self.labels[st][ind])
+        return sorted(found)
+
+    def nearest(self, traj, state=None, exclude=None):
+        """Returns the labels of the living trajectories (on state, if
+        given) closest to traj in phase space, i.e. the candidates for
+        the largest nuclear overlap with traj. Trajectory exclude is
+        ignored."""
+        states = self.labels.keys() if state is None else [state]
+        exact  = self.exact and np.all(traj.widths() == self.width)
+        found  = []
+        for st in states:
+            if st not in self.labels:
+                continue
+            ind = np.nonzero(self.alive[st] & (self.labels[st] != exclude))[0]
+            if exact and len(ind) > 0:
+                z = phase_coords(traj.widths(), traj.x(), traj.p())
+                # ask for enough neighbors to skip the dead/excluded ones
+                k = len(self.labels[st]) - len(ind) + 1
+                dist, near = self.trees[st].query(z, k=k)
+                near = np.atleast_1d(near)
+                keep = np.isin(near, ind)
+                ind  = near[keep][:1]
+            found.extend(self.labels[st][ind])
+        return sorted(found)
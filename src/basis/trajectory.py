@@ -2,76 +2,134 @@
 The Trajectory object and its associated functions.
 """
 import sys
-import copy
+import itertools
 import numpy as np
 import src.dynamics.timings as timings
 import src.fmsio.glbl as glbl
+import src.basis.bundlestate as bundlestate
+
+# source of the stamps identifying the state of the trajectory data
+stamp_counter = itertools.count()
+
+def new_stamps(n):
+    """Returns n new stamps, for the rows of trajectory data updated
+    directly in a store."""
+    return np.fromiter(itertools.islice(stamp_counter, n), dtype=int, count=n)
+
+def store_column(name, scalar=None):
+    """Returns a property accessing column 'name' of the row of the
+    trajectory in its store. Scalar quantities are converted by
+    scalar, array quantities are returned as views into the store."""
+    def get_column(self):
+        value = getattr(self.store, name)[self.row]
+        return value if scalar is None else scalar(value)
+
+    def set_column(self, value):
+        getattr(self.store, name)[self.row] = value
+
+    return property(get_column, set_column)
 
 
 class Trajectory:
-    """Class constructor for the Trajectory object."""
+    """Class constructor for the Trajectory object.
+
+    The trajectory data lives in a row of a BundleState. A trajectory
+    that does not belong to a bundle has a store of its own, and is
+    moved into the store of the bundle when it is added to it.
+    """
+    # current position of the trajectory
+    pos        = store_column('x')
+    # current momentum of the trajectory
+    mom        = store_column('p')
+    # widths of gaussians for each dimension
+    width      = store_column('width')
+    # masses associated with each dimension
+    mass       = store_column('mass')
+    # state trajectory exists on
+    state      = store_column('state', int)
+    # whether the trajectory is alive (i.e. contributes to the wavefunction)
+    alive      = store_column('alive', bool)
+    # whether the trajectory is active (i.e. is being propagated)
+    active     = store_column('active', bool)
+    # amplitude of trajectory
+    amplitude  = store_column('amplitude', complex)
+    # phase of the trajectory
+    gamma      = store_column('phase', float)
+    # time from which the death watch begini as
+    deadtime   = store_column('deadtime', float)
+    # time of last spawn
+    last_spawn = store_column('last_spawn')
+    # time trajectory last left coupling region
+    exit_time  = store_column('exit_time')
+    # stamp of the current trajectory data, a new stamp is drawn every
+    # time the position, momentum, phase or pes data are updated
+    stamp      = store_column('stamp', int)
+
     def __init__(self, nstates, dim, width=None, mass=None,
-                 label=0, parent=0):
+                 label=0, parent=0, store=None, row=None):
         # total number of states
         self.nstates = int(nstates)
         # dimensionality of the trajectory
         self.dim     = int(dim)
-        # widths of gaussians for each dimension
-        if width is None:
-            self.width = np.zeros(dim)
-        else:
-            self.width = np.asarray(width)
-        # masses associated with each dimension
-        if mass is None:
-            self.mass = np.zeros(dim)
-        else:
-            self.mass = np.array(mass)
         # unique identifier for trajectory
         self.label        = label
         # trajectory that spawned this one:
         self.parent     = parent
-
-        # current position of the trajectory
-        self.pos        = np.zeros(self.dim)
-        # current momentum of the trajectory
-        self.mom        = np.zeros(self.dim)
-        # state trajectory exists on
-        self.state      = 0
-        # whether the trajectory is alive (i.e. contributes to the wavefunction)
-        self.alive      = True
-        # whether the trajectory is active (i.e. is being propagated)
-        self.active     = True
-        # amplitude of trajectory
-        self.amplitude  = 0j
-        # phase of the trajectory
-        self.gamma      = 0.
-        # time from which the death watch begini as
-        self.deadtime   = -1.
-        # time of last spawn
-        self.last_spawn = np.zeros(self.nstates)
-        # time trajectory last left coupling region
-        self.exit_time  = np.zeros(self.nstates)
         # data structure to hold the pes data from the interface
         self.pes_data  = None
 
-    @timings.timed
-    def copy(self):
-        """Copys a Trajectory object with new references."""
-        new_traj = Trajectory(self.nstates, self.dim, self.width, self.mass,
-                              self.label, self.parent)
-        new_traj.state      = copy.copy(self.state)
-        new_traj.alive      = copy.copy(self.alive)
-        new_traj.amplitude  = copy.copy(self.amplitude)
-        new_traj.gamma      = copy.copy(self.gamma)
-        new_traj.deadtime   = copy.copy(self.deadtime)
-        new_traj.pos        = copy.deepcopy(self.pos)
-        new_traj.mom        = copy.deepcopy(self.mom)
-        new_traj.last_spawn = copy.deepcopy(self.last_spawn)
-        new_traj.exit_time  = copy.deepcopy(self.exit_time)
+        # if a store is given, the trajectory refers to an existing row
+        if store is not None:
+            self.store = store
+            self.row   = row
+            return
+
+        self.store = bundlestate.BundleState(self.nstates, self.dim)
+        self.row   = self.store.add_row()
+        if width is not None:
+            self.width = width
+        if mass is not None:
+            self.mass = mass
+        self.stamp = next(stamp_counter)
+
+    def copy(self, store=None):
+        """Copys a Trajectory object with new references.
+
+        If store is given, it must be a copy of the store of this
+        trajectory, and the new trajectory refers to the same row in it.
+        """
+        new_traj = self.snapshot(store=store)
         if self.pes_data is not None:
             new_traj.pes_data = self.pes_data.copy()
         return new_traj
 
+    def snapshot(self, store=None):
+        """Returns a copy of the trajectory that shares the pes data with
+        this one, in order to roll back a step with restore().
+
+        The pes data is replaced, never modified, when the trajectory
+        moves, so it does not need to be copied.
+        """
+        if store is None:
+            store = bundlestate.BundleState(self.nstates, self.dim)
+            row   = store.add_row(self.store, self.row)
+        else:
+            row   = self.row
+        new_traj = Trajectory(self.nstates, self.dim, label=self.label,
+                              parent=self.parent, store=store, row=row)
+        new_traj.pes_data = self.pes_data
+        return new_traj
+
+    def restore(self, snap):
+        """Resets the trajectory to a snapshot taken with snapshot()."""
+        self.store.set_row(self.row, snap.store, snap.row)
+        self.pes_data = snap.pes_data
+
+    def move_to(self, store):
+        """Moves the trajectory data to a new row of store."""
+        self.row   = store.add_row(self.store, self.row)
+        self.store = store
+
     #-------------------------------------------------------------------
     #
     # Trajectory status functions
@@ -89,16 +147,19 @@ class Trajectory:
     def update_x(self, pos):
         """Updates the position of the trajectory.
         """
-        self.pos = np.array(pos)
+        self.pos   = pos
+        self.stamp = next(stamp_counter)
 
     def update_p(self, mom):
         """Updates the momentum of the trajectory.
         """
-        self.mom = np.array(mom)
+        self.mom   = mom
+        self.stamp = next(stamp_counter)
 
     def update_phase(self, phase):
         """Updates the nuclear phase."""
         self.gamma = 0.5 * np.dot(self.x(), self.p())
+        self.stamp = next(stamp_counter)
 #        self.gamma = phase
 #        if abs(self.gamma) > 2*np.pi:
 #            self.gamma = self.gamma % 2*np.pi
@@ -109,7 +170,15 @@ class Trajectory:
 
     def update_pes_info(self, pes_info):
         """Updates information about the potential energy surface."""
+        # re-evaluating the surface at the same geometry does not change
+        # the trajectory data
+        if (self.pes_data is None or
+                not np.array_equal(self.pes_data.geom, pes_info.geom)):
+            self.stamp = next(stamp_counter)
         self.pes_data = pes_info.copy()
+        # the potentials are kept in the store as well, for the checks
+        # over the whole bundle
+        self.store.potential[self.row] = pes_info.potential
 
     #-----------------------------------------------------------------------
     #
@@ -117,12 +186,14 @@ class Trajectory:
     #
     #-----------------------------------------------------------------------
     def x(self):
-        """Returns the position of the trajectory as an array."""
-        return self.pos
+        """Returns the position of the trajectory as an array. This is
+        a copy, it does not change when the trajectory is moved."""
+        return self.pos.copy()
 
     def p(self):
-        """Returns the momentum of the trajectory as an array."""
-        return self.mom
+        """Returns the momentum of the trajectory as an array. This is
+        a copy, it does not change when the trajectory is moved."""
+        return self.mom.copy()
 
     def phase(self):
         """Returns the phase of the trajectory."""
@@ -142,15 +213,21 @@ class Trajectory:
     # Functions to update information about the potential energy surface
     #
     #--------------------------------------------------------------------
+    def check_geom(self, caller, tol=1.):
+        """Warns if the pes data was not computed at the current position.
+        Only done if debug_checks is set."""
+        if (glbl.printing['debug_checks'] and
+                np.linalg.norm(self.pes_data.geom - self.pos) > tol*glbl.constants['fpzero']):
+            print('WARNING: trajectory.' + caller + '() called, ' +
+                  'but pes_geom != trajectory.x(). ID=' + str(self.label)+
+                  '\ntraj.x()='+str(self.x())+"\npes_geom="+str(self.pes_data.geom))
+
     def energy(self, state):
         """Returns the potential energies.
 
         Add the energy shift right here. If not current, recompute them.
         """
-        if np.linalg.norm(self.pes_data.geom - self.x()) > 10.*glbl.constants['fpzero']:
-            print('WARNING: trajectory.energy() called, ' +
-                  'but pes_geom != trajectory.x(). ID=' + str(self.label)+
-                  '\ntraj.x()='+str(self.x())+"\npes_geom="+str(self.pes_data.geom))
+        self.check_geom('energy', tol=10.)
         return self.pes_data.potential[state] + glbl.propagate['pot_shift']
 
     def derivative(self, state_i, state_j):
@@ -158,28 +235,19 @@ class Trajectory:
 
         Bra state assumed to be the current state.
         """
-        if np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']:
-            print('WARNING: trajectory.derivative() called, ' +
-                  'but pes_geom != trajectory.x(). ID=' + str(self.label)+
-                  '\ntraj.x()='+str(self.x())+"\npes_geom="+str(self.pes_data.geom))
+        self.check_geom('derivative')
         return self.pes_data.deriv[:, state_i, state_j]
 
     def hessian(self, state_i):
         """Returns the hessian of the potential on state state_i
         """
-        if np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']:
-            print('WARNING: trajectory.derivative() called, ' +
-                  'but pes_geom != trajectory.x(). ID=' + str(self.label)+
-                  '\ntraj.x()='+str(self.x())+"\npes_geom="+str(self.pes_data.geom))
+        self.check_geom('hessian')
         return self.pes_data.deriv2[:, :, state_i]
 
     def coupling(self, state_i, state_j):
         """Returns the coupling between surfaces state_i and state_j
         """
-        if np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']:
-            print('WARNING: trajectory.derivative() called, ' +
-                  'but pes_geom != trajectory.x(). ID=' + str(self.label)+
-                  '\ntraj.x()='+str(self.x())+"\npes_geom="+str(self.pes_data.geom))
+        self.check_geom('coupling')
         return self.pes_data.coupling[:, state_i, state_j]
 
     def scalar_coup(self, state_i, state_j):
@@ -187,10 +255,7 @@ class Trajectory:
            block (self.state,c_state)."""
         if 'scalar_coup' not in self.pes_data.data_keys:
             return 0.
-        if np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']:
-            print('WARNING: trajectory.scalar_coup() called, ' +
-                  'but pes_geom != trajectory.x(). ID=' + str(self.label)+
-                  '\ntraj.x()='+str(self.x())+"\npes_geom="+str(self.pes_data.geom))
+        self.check_geom('scalar_coup')
         return self.pes_data.scalar_coup[state_i, state_j]
 
     def nact(self, state_i, state_j):
@@ -198,10 +263,7 @@ class Trajectory:
            block (self.state,c_state)."""
         if 'nac' not in self.pes_data.data_keys:
             return 0.
-        if np.linalg.norm(self.pes_data.geom - self.x()) > glbl.constants['fpzero']:
-            print('WARNING: trajectory.nact() called, ' +
-                  'but pes_geom != trajectory.x(). ID=' + str(self.label)+
-                  '\ntraj.x()='+str(self.x())+"\npes_geom="+str(self.pes_data.geom))
+        self.check_geom('nact')
         return self.pes_data.nac[:,state_i, state_j]
 
 
@@ -297,6 +359,7 @@ class Trajectory:
         # Writes out gradient
         chkpt.write('\n# gradient state = {:4d}\n'.format(self.state))
         self.derivative(self.state,self.state).tofile(chkpt, ' ', '%16.10e')
+        chkpt.write('\n')
 
         # write out the coupling
         for i in range(self.nstates):
@@ -312,7 +375,7 @@ class Trajectory:
         This assumes the trajectory invoking this function has been
         initially correctly and can hold all the information.
         """
-        self.alive     = bool(chkpt.readline().split()[0])
+        self.alive     = chkpt.readline().split()[0] == 'True'
         self.nstates   = int(chkpt.readline().split()[0])
         self.label     = int(chkpt.readline().split()[0])
         self.state     = int(chkpt.readline().split()[0])
@@ -329,6 +392,7 @@ class Trajectory:
         # potential energy -- nstates
         chkpt.readline()
         self.pes_data.potential = np.fromstring(chkpt.readline(), sep=' ', dtype=float)
+        self.store.potential[self.row] = self.pes_data.potential
         # exit coupling region
         chkpt.readline()
         self.exit_time = np.fromstring(chkpt.readline(), sep=' ', dtype=float)
@@ -6,6 +6,7 @@ import numpy as np
 import scipy.linalg as sp_linalg
 import src.fmsio.glbl as glbl
 import src.fmsio.fileio as fileio
+import src.fmsio.checkpoint as checkpoint
 import src.basis.trajectory as trajectory
 import src.basis.bundle as bundle
 import src.dynamics.surface as surface
@@ -22,6 +23,10 @@ def init_bundle(master):
     # the PES. There are some details here that trajectories
     # will want to know about
     glbl.pes.init_interface()
+    # start the pes workers, if requested. They are forked after the
+    # interface is initialized
+    surface.init_pool()
+    surface.init_cache()
 
     # now load the initial trajectories into the bundle
     if glbl.sampling['restart']:
@@ -47,8 +52,10 @@ def init_bundle(master):
     surface.update_pes(master)
     # compute the hamiltonian matrix...
     master.update_matrices()
-    # so that we may appropriately renormalize to unity
-    master.renormalize()
+    # so that we may appropriately renormalize to unity. A restart
+    # continues with the amplitudes of the checkpoint
+    if not glbl.sampling['restart']:
+        master.renormalize()
 
     # this is the bundle at time t=0.  Save in order to compute auto
     # correlation function
@@ -70,13 +77,18 @@ def init_bundle(master):
 #
 #----------------------------------------------------------------------------
 def init_restart(master):
-    """Initializes a restart."""
-    if glbl.sampling['restart_time'] == -1.:
-        fname = fileio.home_path+'/last_step.dat'
-    else:
-        fname = fileio.home_path+'/checkpoint.dat'
-
-    master.read_bundle(fname, glbl.sampling['restart_time'])
+    """Initializes a restart from the checkpoint file, at restart_time
+    (at the last step written if restart_time = -1)."""
+    fname = fileio.home_path+'/checkpoint.dat'
+
+    obj_list, surf_list = checkpoint.read_bundle(master, fname,
+                                                 glbl.sampling['restart_time'])
+
+    # the surfaces read need not be evaluated again
+    for pes_calc in surf_list:
+        if hasattr(glbl.pes, 'cache_surface'):
+            glbl.pes.cache_surface(pes_calc)
+    surface.cache_store(obj_list, surf_list)
 
 
 def set_initial_state(master):
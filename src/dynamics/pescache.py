@@ -0,0 +1,250 @@
+"""
+The PESCache and PESStore objects: caches of potential energy surfaces.
+
+Surfaces are keyed by the kind of basis function they were computed for
+(a trajectory on a given state, or a centroid between given states) and
+by the geometry, quantized in units of fpzero. A surface is therefore
+found for any trajectory (centroid) at the same geometry, whatever its
+label, unless the interface keeps data of its own for each label (e.g.
+the phase of the adiabatic states, see cache_surface): the surface then
+depends on the history of the label, and the label is part of the key.
+Once the surfaces held take more than the allowed size, the
+least recently used ones are discarded.
+
+The PESCache holds surfaces in memory for the current run. The PESStore
+keeps them on disk, in an sqlite database, so that they can be reused
+by later runs (restarts, other members of an ensemble) with the same
+interface input.
+"""
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import collections
+import numpy as np
+import src.fmsio.glbl as glbl
+import src.dynamics.timings as timings
+import src.basis.centroid as centroid
+
+
+def surface_key(obj):
+    """Returns the cache key of the surface at trajectory/centroid obj."""
+    if type(obj) is centroid.Centroid:
+        kind = ('centroid',) + tuple(sorted(obj.pstates))
+    else:
+        kind = ('trajectory', obj.state)
+    if hasattr(glbl.pes, 'cache_surface'):
+        kind = kind + (obj.label,)
+    grid = np.round(np.asarray(obj.x(), dtype=float) / glbl.constants['fpzero'])
+    return kind + (grid.astype(np.int64).tobytes(),)
+
+
+def surface_size(surf):
+    """Returns the number of bytes taken by the arrays of a surface."""
+    return sum(val.nbytes for val in vars(surf).values()
+               if isinstance(val, np.ndarray))
+
+
+class PESCache:
+    """Class constructor for the PESCache object. max_size is the memory
+    (in bytes) the cached surfaces may take, the cache is disabled if
+    max_size <= 0."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size     = 0
+        self.entries  = collections.OrderedDict()
+
+    def lookup(self, obj):
+        """Returns the cached surface at the geometry of obj, or None."""
+        if self.max_size <= 0:
+            return None
+
+        key  = surface_key(obj)
+        surf = self.entries.get(key)
+        if (surf is None or np.linalg.norm(surf.geom - obj.x()) >
+                                                glbl.constants['fpzero']):
+            timings.count('pes_cache.misses')
+            return None
+
+        self.entries.move_to_end(key)
+        timings.count('pes_cache.hits')
+        return surf
+
+    def store(self, obj, surf):
+        """Adds the surface computed at obj to the cache, discarding the
+        least recently used surfaces if the cache is full."""
+        if self.max_size <= 0:
+            return
+
+        key = surface_key(obj)
+        if key in self.entries:
+            self.size -= surface_size(self.entries.pop(key))
+        self.entries[key] = surf
+        self.size        += surface_size(surf)
+
+        while self.size > self.max_size and len(self.entries) > 0:
+            key, old_surf = self.entries.popitem(last=False)
+            self.size    -= surface_size(old_surf)
+            timings.count('pes_cache.evictions')
+
+
+class PESStore:
+    """Class constructor for the PESStore object. path is the sqlite
+    database file, max_size the size (in bytes) the stored surfaces may
+    take.
+
+    Surfaces are only found by runs with the same interface input (see
+    input_hash). Each operation opens the database in its own
+    transaction, sqlite locks the file so that several processes can
+    share the store.
+    """
+    def __init__(self, path, max_size):
+        self.path     = path
+        self.max_size = max_size
+        self.prefix   = glbl.interface['interface'] + ':' + input_hash()
+
+        with self.connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS surfaces (key TEXT PRIMARY KEY, ' +
+                       'header BLOB, data BLOB, size INTEGER, used REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS surfaces_used ON surfaces (used)')
+
+    def connect(self):
+        """Returns a connection to the database. Waits for other
+        processes to release the database if it is locked."""
+        return Connection(self.path)
+
+    def key(self, obj):
+        """Returns the database key of the surface at obj."""
+        return hashlib.sha1(pickle.dumps((self.prefix,) + surface_key(obj))).hexdigest()
+
+    def lookup(self, obj_list):
+        """Returns the stored surfaces at the geometries of the
+        trajectories/centroids in obj_list, None where not stored."""
+        results = []
+        with self.connect() as db:
+            for obj in obj_list:
+                key = self.key(obj)
+                row = db.execute('SELECT header, data FROM surfaces WHERE key=?',
+                                 (key,)).fetchone()
+                surf = None
+                if row is not None:
+                    surf = unpack_surfaces(np.frombuffer(row[1], dtype=np.uint8),
+                                           [row[0]], [0], [obj.label])[0]
+                    if np.linalg.norm(surf.geom - obj.x()) > glbl.constants['fpzero']:
+                        surf = None
+                if surf is None:
+                    timings.count('pes_store.misses')
+                else:
+                    timings.count('pes_store.hits')
+                    db.execute('UPDATE surfaces SET used=? WHERE key=?',
+                               (time.time(), key))
+                results.append(surf)
+        return results
+
+    def store(self, obj_list, surf_list):
+        """Adds the surfaces computed at the trajectories/centroids in
+        obj_list to the store, discarding the least recently used
+        surfaces if the store is full."""
+        with self.connect() as db:
+            for obj, surf in zip(obj_list, surf_list):
+                buf, headers, hdr_ind = pack_surfaces([surf])
+                db.execute('INSERT OR REPLACE INTO surfaces VALUES (?,?,?,?,?)',
+                           (self.key(obj), headers[0], buf.tobytes(), len(buf),
+                            time.time()))
+
+            size = db.execute('SELECT TOTAL(size) FROM surfaces').fetchone()[0]
+            if size > self.max_size:
+                for key, surf_size in db.execute('SELECT key, size FROM surfaces ' +
+                                                 'ORDER BY used').fetchall():
+                    if size <= self.max_size:
+                        break
+                    db.execute('DELETE FROM surfaces WHERE key=?', (key,))
+                    size -= surf_size
+                    timings.count('pes_store.evictions')
+
+
+class Connection:
+    """An sqlite connection used as a context manager: the statements
+    are run in a single (write-locked) transaction, which is committed
+    on exit (rolled back if an exception occurs)."""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=600., isolation_level=None)
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.execute('COMMIT')
+        else:
+            self.db.execute('ROLLBACK')
+        self.db.close()
+        return False
+
+
+def input_hash():
+    """Returns a hash of the input that determines the surfaces: the
+    interface keywords, the number of states, the surface representation,
+    the coordinates and the files listed by the interface's input_files()."""
+    # the operator file is hashed by content (with input_files), not by
+    # path, so that runs reading it from another directory share surfaces
+    ignore = ['pes_cache_mb', 'pes_store', 'pes_store_mb', 'op_cache', 'opfile']
+    sha = hashlib.sha1()
+    sha.update(repr([(key, glbl.interface[key]) for key in sorted(glbl.interface)
+                     if key not in ignore]).encode())
+    sha.update(repr([glbl.propagate['n_states'], glbl.variables['surface_rep'],
+                     glbl.nuclear_basis['labels'],
+                     glbl.nuclear_basis['freqs']]).encode())
+    if hasattr(glbl.pes, 'input_files'):
+        for fname in sorted(glbl.pes.input_files()):
+            sha.update(os.path.basename(fname).encode())
+            with open(fname, 'rb') as infile:
+                sha.update(infile.read())
+    return sha.hexdigest()
+
+
+def pack_surfaces(surf_list):
+    """Packs the arrays of a list of Surface objects into a byte buffer.
+
+    Returns the buffer, a list of the distinct headers (the class, the
+    other attributes and the layout of the arrays of a surface, pickled)
+    and the index of the header of each surface. The tag is left out: it
+    is the label the surface was evaluated for.
+    """
+    headers = []
+    hdr_ind = []
+    data    = []
+    for pes_calc in surf_list:
+        arrays = sorted([(name, val) for name, val in vars(pes_calc).items()
+                         if isinstance(val, np.ndarray)], key=lambda x: x[0])
+        attrs  = {name:val for name, val in vars(pes_calc).items()
+                  if name != 'tag' and not isinstance(val, np.ndarray)}
+        layout = [(name, val.dtype.str, val.shape) for name, val in arrays]
+        header = pickle.dumps((type(pes_calc), attrs, layout))
+        if header not in headers:
+            headers.append(header)
+        hdr_ind.append(headers.index(header))
+        data.extend([np.ascontiguousarray(val).tobytes() for name, val in arrays])
+
+    return np.frombuffer(b''.join(data), dtype=np.uint8), headers, hdr_ind
+
+
+def unpack_surfaces(buf, headers, hdr_ind, tags):
+    """Rebuilds the Surface objects packed by pack_surfaces."""
+    surf_list = []
+    offset    = 0
+    for k, tag in zip(hdr_ind, tags):
+        surf_type, attrs, layout = pickle.loads(headers[k])
+        pes_calc = surf_type.__new__(surf_type)
+        pes_calc.__dict__.update(attrs)
+        pes_calc.tag = tag
+        for name, dtype, shape in layout:
+            val = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)),
+                                offset=offset).reshape(shape).copy()
+            offset += val.nbytes
+            setattr(pes_calc, name, val)
+        surf_list.append(pes_calc)
+
+    return surf_list
@@ -7,6 +7,7 @@ import src.fmsio.glbl as glbl
 import src.fmsio.fileio as fileio
 import src.basis.bundle as bundle
 import src.basis.trajectory as trajectory
+import src.basis.observables as observables
 import src.dynamics.surface as surface
 import src.basis.matching_pursuit as mp
 
@@ -37,11 +38,7 @@ def fms_step_bundle(master, dt):
 
     while not step_complete(master.time, end_time, dt):
         # save the bundle from previous step in case step rejected
-        #try:
-        #    del master0
-        #except NameError:
-        #    pass
-        master0 = master.copy()
+        master0 = master.snapshot()
 
         # propagate each trajectory in the bundle
         time_step = min(time_step, end_time-master.time)
@@ -49,6 +46,8 @@ def fms_step_bundle(master, dt):
         master.update_amplitudes(0.5*dt, update_ham=False)
         # the propagators update the potential energy surface as need be.
         glbl.integrator.propagate_bundle(master, time_step)
+        # the trajectories have moved, update the phase space index
+        master.update_index()
         # propagate amplitudes for 1/2 time step using x1
         master.update_amplitudes(0.5*dt)
 
@@ -98,8 +97,7 @@ def fms_step_bundle(master, dt):
                 raise ValueError('Bundle minimum step exceeded.')
 
             # reset the beginning of the time step and go to beginning of loop
-            #del master
-            master = master0.copy()
+            master.restore(master0)
 
     return master
 
@@ -117,8 +115,8 @@ def fms_step_trajectory(traj, init_time, dt):
     min_time_step = abs(dt / 2.**5)
 
     while not step_complete(current_time, end_time, time_step):
-        # save the bundle from previous step in case step rejected
-        traj0 = traj.copy()
+        # save the trajectory from previous step in case step rejected
+        traj0 = traj.snapshot()
 
         # propagate single trajectory
         glbl.integrator.propagate_trajectory(traj, time_step)
@@ -144,7 +142,7 @@ def fms_step_trajectory(traj, init_time, dt):
                 raise ValueError('Trajectory minimum step exceeded.')
 
             # reset the beginning of the time step and go to beginning of loop
-            traj = traj0.copy()
+            traj.restore(traj0)
 
 
 #-----------------------------------------------------------------------------
@@ -168,27 +166,22 @@ def check_step_bundle(master0, master, time_step):
     if glbl.spawn.in_coupled_regime(master) and time_step == glbl.propagate['default_time_step']:
         return False, ' require coupling time step, current step = {:8.4f}'.format(time_step)
     # ...or if there's a numerical error in the simulation:
-    #  norm conservation
-    dpop = abs(sum(master0.pop()) - sum(master.pop()))
-    if dpop > glbl.propagate['pop_jump_toler']:
-        return False, ' jump in bundle population, delta[pop] = {:8.4f}'.format(dpop)
-    # this is largely what the above check is checking -- but is more direct. I would say 
-    # we should remove the above check...
-    dnorm = master.norm()
+    #  norm conservation (the populations are normalized, their sum
+    # cannot jump, so a jump in population shows up in the norm only)
+    dnorm = observables.norm(master.amplitudes(), master.S)
     if abs(dnorm-1.) > glbl.propagate['norm_thresh']:
         return False, 'Wfn norm threshold exceeded, |norm|-1. = {:8.4f}'.format(dnorm-1.)
 
     #  ... or energy conservation (only need to check traj which exist in
     # master0. If spawned, will be last entry(ies) in master
-    for i in range(master0.n_traj()):
-        if master0.traj[i].alive:
-            energy_old = (master0.traj[i].potential() +
-                          master0.traj[i].kinetic())
-            energy_new = (master.traj[i].potential() +
-                          master.traj[i].kinetic())
-            dener = abs(energy_old - energy_new)
-            if dener > glbl.propagate['energy_jump_toler']:
-                return False, ' jump in trajectory energy, label = {:4d}, delta[ener] = {:10.6f}'.format(i, dener)
+    if len(master0.alive) > 0:
+        pot0, kin0 = observables.traj_energies(master0, master0.alive)
+        pot, kin   = observables.traj_energies(master, master0.alive)
+        dener      = np.abs(pot0 + kin0 - pot - kin)
+        jumps      = np.nonzero(dener > glbl.propagate['energy_jump_toler'])[0]
+        if len(jumps) > 0:
+            i = jumps[0]
+            return False, ' jump in trajectory energy, label = {:4d}, delta[ener] = {:10.6f}'.format(master0.alive[i], dener[i])
     return True, ' success'
 
 
@@ -5,16 +5,31 @@ All calls to update the pes are localized here.  This facilitates parallel
 execution of potential evaluations which is essential for ab initio PES.
 """
 from functools import partial
+import os
+import time
+import multiprocessing
+import concurrent.futures
 import numpy as np
+import mpi4py.MPI as MPI
 import src.fmsio.glbl as glbl
+import src.fmsio.fileio as fileio
 import src.basis.trajectory as trajectory
 import src.basis.centroid as centroid
+import src.dynamics.pescache as pescache
 
-pes_cache  = dict()
+# cache of the computed surfaces
+pes_cache  = pescache.PESCache(0)
+# store of the computed surfaces on disk, shared between runs
+pes_store  = None
+# wall time of the last evaluation of each label, used to estimate the cost
+pes_cost   = dict()
+# MPI window holding the task counter (on rank 0)
+task_win   = None
+# pool of worker processes, if pes_workers > 1 and MPI is not in use
+pool       = None
 
 def update_pes(master, update_centroids=None):
     """Updates the potential energy surface."""
-    global pes_cache
     success = True
 
     # this conditional checks to see if we actually need centroids,
@@ -22,85 +37,46 @@ def update_pes(master, update_centroids=None):
     if update_centroids is None or not glbl.integrals.require_centroids:
         update_centroids = glbl.integrals.require_centroids
 
-    if glbl.mpi['parallel']:
-        # update electronic structure
-        exec_list = []
-        n_total = 0 # this ensures traj.0 is on proc 0, etc.
-        for i in range(master.n_traj()):
-            if master.traj[i].active and not cached(master.traj[i].label,
-                                                    master.traj[i].x()):
-                n_total += 1
-                if n_total % glbl.mpi['nproc'] == glbl.mpi['rank']:
-                    exec_list.append(master.traj[i])
-
-        if update_centroids:
-            # update the geometries
-            master.update_centroids()
-            # now update electronic structure in a controled way to allow for
-            # parallelization
-            for i in range(master.n_traj()):
-                for j in range(i):
-                    if master.centroid_required(master.traj[i],master.traj[j]) and not \
-                                           cached(master.cent[i][j].label,
-                                                  master.cent[i][j].x()):
-                        n_total += 1
-                        if n_total % glbl.mpi['nproc'] == glbl.mpi['rank']:
-                            exec_list.append(master.cent[i][j])
-
-        local_results = []
-        for i in range(len(exec_list)):
-            if type(exec_list[i]) is trajectory.Trajectory:
-                pes_calc = glbl.pes.evaluate_trajectory(exec_list[i], master.time)
-            elif type(exec_list[i]) is centroid.Centroid:
-                pes_calc = glbl.pes.evaluate_centroid(exec_list[i], master.time)
-            else:
-                raise TypeError('type='+str(type(exec_list[i]))+
-                                'not recognized')
-            local_results.append(pes_calc)
+    # collect the trajectories..
+    exec_list = [master.traj[i] for i in range(master.n_traj())
+                 if master.traj[i].active]
 
-        global_results = glbl.mpi['comm'].allgather(local_results)
+    # ...and centroids if need be
+    cent_ind = []
+    if update_centroids:
+        # update the geometries
+        master.update_centroids()
+        for i in range(master.n_traj()):
+            for j in range(i):
+            # if centroid not initialized (or not required), skip it
+                if (master.cent[i][j] is not None and
+                        master.centroid_required(master.traj[i],
+                                                 master.traj[j])):
+                    exec_list.append(master.cent[i][j])
+                    cent_ind.append((i, j))
 
-        # update the cache
-        for i in range(glbl.mpi['nproc']):
-            for j in range(len(global_results[i])):
-                pes_cache[global_results[i][j].tag] = global_results[i][j]
+    # take the surfaces from the caches where possible..
+    results   = cache_lookup(exec_list)
+    eval_list = [obj for obj, pes_calc in zip(exec_list, results)
+                 if pes_calc is None]
 
-        # update the bundle:
-        # live trajectories
-        for i in range(master.n_traj()):
-            if master.traj[i].alive:
-                master.traj[i].update_pes_info(pes_cache[master.traj[i].label])
-
-        # and centroids
-        if update_centroids:
-            for i in range(master.n_traj()):
-                for j in range(i):
-                    if master.cent[i][j].label in pes_cache:
-                        master.cent[i][j].update_pes_info(pes_cache[master.cent[i][j].label])
-                        master.cent[j][i] = master.cent[i][j]
-
-    # if parallel overhead not worth the time and effort (eg. pes known in closed form),
-    # simply run over trajectories in serial (in theory, this too could be cythonized,
-    # but unlikely to ever be bottleneck)
+    # ...and evaluate the others. The list of surfaces to evaluate is the
+    # same on all ranks. If the parallel overhead is not worth the time
+    # and effort (eg. pes known in closed form), run over them in serial
+    if glbl.mpi['parallel']:
+        new_results = iter(mpi_evaluate_list(eval_list, master.time))
     else:
-        # iterate over trajectories..
-        for i in range(master.n_traj()):
-            if master.traj[i].active:
-                master.traj[i].update_pes_info(glbl.pes.evaluate_trajectory(
-                                               master.traj[i], master.time))
-
-        # ...and centroids if need be
-        if update_centroids:
-            # update the geometries
-            master.update_centroids()
-            for i in range(master.n_traj()):
-                for j in range(i):
-                # if centroid not initialized, skip it
-                    if master.cent[i][j] is not None:
-                        master.cent[i][j].update_pes_info(
-                                          glbl.pes.evaluate_centroid(
-                                          master.cent[i][j], master.time))
-                        master.cent[j][i] = master.cent[i][j]
+        new_results = iter(evaluate_list(eval_list, master.time))
+    new_ind = [k for k in range(len(exec_list)) if results[k] is None]
+    for k in new_ind:
+        results[k] = next(new_results)
+    cache_store([exec_list[k] for k in new_ind], [results[k] for k in new_ind])
+
+    # update the bundle
+    for obj, pes_calc in zip(exec_list, results):
+        obj.update_pes_info(pes_calc)
+    for i, j in cent_ind:
+        master.cent[j][i] = master.cent[i][j]
 
     return success
 
@@ -110,28 +86,366 @@ def update_pes_traj(traj):
 
     Used during spawning.
     """
-    results = None
+    results = cache_lookup([traj])[0]
 
-    if glbl.mpi['rank'] == 0:
-        results = glbl.pes.evaluate_trajectory(traj)
+    if results is None:
+        if glbl.mpi['rank'] == 0:
+            results = glbl.pes.evaluate_trajectory(traj)
 
-    if glbl.mpi['parallel']:
-        results = glbl.mpi['comm'].bcast(results, root=0)
-        glbl.mpi['comm'].barrier()
+        if glbl.mpi['parallel']:
+            results = glbl.mpi['comm'].bcast(results, root=0)
+            glbl.mpi['comm'].barrier()
+            if glbl.mpi['rank'] != 0 and hasattr(glbl.pes, 'cache_surface'):
+                glbl.pes.cache_surface(results)
+
+        cache_store([traj], [results])
 
     traj.update_pes_info(results)
 
 
-def cached(label, geom):
-    """Returns True if the surface in the cache corresponds to the current
-    trajectory (don't recompute the surface)."""
-    global pes_cache
+def evaluate_list(exec_list, t):
+    """Evaluates the surfaces at a list of trajectories and centroids.
+
+    If the pes workers are running, the list is split into contiguous
+    chunks, one per worker. If the interface provides evaluate_batch,
+    all geometries (of a chunk) are evaluated in a single call.
+    """
+    if pool is not None and len(exec_list) > 1:
+        n_chunk = min(len(exec_list), glbl.mpi['pes_workers'])
+        bounds  = [len(exec_list) * k // n_chunk for k in range(n_chunk+1)]
+        chunks  = [[obj.snapshot() for obj in exec_list[bounds[k]:bounds[k+1]]]
+                   for k in range(n_chunk)]
+        results = pool_map(evaluate_list, [(chunk, t) for chunk in chunks],
+                           [[obj.label for obj in chunk] for chunk in chunks])
+        return [surf for chunk_results in results for surf in chunk_results]
+
+    if hasattr(glbl.pes, 'evaluate_batch'):
+        if len(exec_list) == 0:
+            return []
+        return glbl.pes.evaluate_batch(np.array([obj.x() for obj in exec_list]),
+                                       [obj.label for obj in exec_list], t)
+
+    results = []
+    for obj in exec_list:
+        if type(obj) is trajectory.Trajectory:
+            pes_calc = glbl.pes.evaluate_trajectory(obj, t)
+        elif type(obj) is centroid.Centroid:
+            pes_calc = glbl.pes.evaluate_centroid(obj, t)
+        else:
+            raise TypeError('type='+str(type(obj))+
+                            'not recognized')
+        results.append(pes_calc)
+    return results
+
+
+def init_cache():
+    """Creates the cache of surfaces, holding up to pes_cache_mb MB, and
+    opens the store of surfaces on disk if pes_store is set."""
+    global pes_cache, pes_store
+
+    pes_cache = pescache.PESCache(glbl.interface['pes_cache_mb'] * 2.**20)
+
+    # the store is read and written by rank 0 only
+    if glbl.interface['pes_store'] != '' and glbl.mpi['rank'] == 0:
+        path = os.path.join(fileio.home_path, glbl.interface['pes_store'])
+        pes_store = pescache.PESStore(path, glbl.interface['pes_store_mb'] * 2.**20)
+
+
+def cache_lookup(obj_list):
+    """Returns the surfaces at the trajectories/centroids in obj_list from
+    the cache, or from the store on disk, None where they are not found."""
+    results = [pes_cache.lookup(obj) for obj in obj_list]
+
+    # the store is only open on rank 0, which passes on what it finds
+    miss_ind = [k for k in range(len(obj_list)) if results[k] is None]
+    stored   = None
+    if pes_store is not None and len(miss_ind) > 0:
+        stored = pes_store.lookup([obj_list[k] for k in miss_ind])
+    if glbl.mpi['parallel'] and glbl.interface['pes_store'] != '':
+        stored = glbl.mpi['comm'].bcast(stored, root=0)
+    if stored is not None:
+        for k, pes_calc in zip(miss_ind, stored):
+            if pes_calc is not None:
+                results[k] = pes_calc
+                pes_cache.store(obj_list[k], pes_calc)
+
+    for k in range(len(obj_list)):
+        pes_calc = results[k]
+        if pes_calc is None:
+            continue
+
+        # the surface may have been computed for another label (only
+        # for interfaces without data of their own for each label)
+        if pes_calc.tag != obj_list[k].label:
+            pes_calc     = pes_calc.copy()
+            pes_calc.tag = obj_list[k].label
+            results[k]   = pes_calc
+
+        # the interface would have kept the surface had it computed it
+        if hasattr(glbl.pes, 'cache_surface'):
+            glbl.pes.cache_surface(pes_calc)
+
+    return results
+
+
+def cache_store(obj_list, surf_list):
+    """Adds the surfaces computed at the trajectories/centroids in obj_list
+    to the cache and, if in use, the store on disk."""
+    for obj, pes_calc in zip(obj_list, surf_list):
+        pes_cache.store(obj, pes_calc)
+
+    if pes_store is not None and len(obj_list) > 0:
+        pes_store.store(obj_list, surf_list)
+
+
+#----------------------------------------------------------------------
+#
+# Pool of pes workers
+#
+#----------------------------------------------------------------------
+def init_pool():
+    """Starts the pool of pes workers if pes_workers > 1.
+
+    The workers are forked from the main process, so they inherit the
+    initialized interface. An interface that needs resources of its own
+    in each process (e.g. a work directory) provides init_worker().
+    """
+    global pool
+
+    n_workers = glbl.mpi['pes_workers']
+    if pool is not None or n_workers <= 1 or glbl.mpi['parallel']:
+        return
+
+    context      = multiprocessing.get_context('fork')
+    worker_count = context.Value('i', 0)
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                  mp_context=context,
+                                                  initializer=init_worker,
+                                                  initargs=(worker_count,))
+
+
+def close_pool():
+    """Shuts down the pool of pes workers, and frees the MPI task
+    counter allocated by next_task."""
+    global pool, task_win
+
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+    if task_win is not None:
+        task_win.Free()
+        task_win = None
+
+
+def pool_map(func, task_args, task_labels):
+    """Runs func(*args) on the pes workers for each args in task_args,
+    returns the results in the order of the tasks.
+
+    task_labels gives the labels of the trajectories/centroids each task
+    evaluates the surface for. If the interface keeps data between
+    evaluations in data_cache (e.g. to fix the phase of the adiabatic
+    states), the entries for these labels are sent with the task and
+    the updated entries are put back in the cache in the order of the
+    tasks, so the results do not depend on which worker runs a task.
+    """
+    data_cache = getattr(glbl.pes, 'data_cache', None)
+
+    futures = []
+    for args, labels in zip(task_args, task_labels):
+        entries = dict()
+        if data_cache is not None:
+            entries = {label:data_cache.get(label) for label in labels}
+        futures.append(pool.submit(run_task, func, args, entries))
+
+    results = []
+    for future in futures:
+        result, entries = future.result()
+        if data_cache is not None:
+            for label, entry in entries.items():
+                if entry is None:
+                    data_cache.pop(label, None)
+                else:
+                    data_cache[label] = entry
+        results.append(result)
+
+    return results
+
+
+def init_worker(worker_count):
+    """Sets up a pes worker process."""
+    global pool, pes_cache, pes_store
+
+    # a worker evaluates the surfaces itself, and does not use the caches
+    # of the main process
+    pool      = None
+    pes_cache = pescache.PESCache(0)
+    pes_store = None
+
+    with worker_count.get_lock():
+        worker_id           = worker_count.value
+        worker_count.value += 1
+
+    if hasattr(glbl.pes, 'init_worker'):
+        glbl.pes.init_worker(worker_id)
+
+
+def run_task(func, args, entries):
+    """Runs a task on a pes worker, starting from the data_cache entries
+    of the main process. Returns the result and the updated entries."""
+    data_cache = getattr(glbl.pes, 'data_cache', None)
+
+    if data_cache is not None:
+        data_cache.clear()
+        data_cache.update({label:entry for label, entry in entries.items()
+                           if entry is not None})
+
+    result = func(*args)
+
+    if data_cache is not None:
+        entries = {label:data_cache.get(label) for label in entries}
+
+    return result, entries
+
+
+#----------------------------------------------------------------------
+#
+# MPI work distribution
+#
+#----------------------------------------------------------------------
+def mpi_evaluate_list(exec_list, t):
+    """Evaluates the surfaces at a list of trajectories and centroids over
+    the MPI ranks. Returns the surfaces, in the order of exec_list, on all
+    ranks.
+
+    The tasks are sorted in order of decreasing cost, estimated from the
+    time of the previous evaluation of each label, and handed out in
+    chunks of consecutive tasks (about task_chunks chunks per rank). A
+    rank takes the next chunk as soon as it is done with the previous
+    one, and evaluates all the geometries of a chunk in a single call.
+    Only the new surfaces are exchanged, as packed buffers.
+    """
+    global pes_cost
+
+    comm   = glbl.mpi['comm']
+    nproc  = glbl.mpi['nproc']
+    n_task = len(exec_list)
+    if n_task == 0:
+        return []
+
+    # labels not evaluated before are assumed to take the average time
+    if len(pes_cost) > 0:
+        cost_avg = sum(pes_cost.values()) / len(pes_cost)
+    else:
+        cost_avg = 0.
+    costs = [pes_cost.get(obj.label, cost_avg) for obj in exec_list]
+    order = sorted(range(n_task), key=lambda k: -costs[k])
+
+    # split the sorted tasks into chunks
+    n_chunk = min(n_task, nproc * max(1, glbl.mpi['task_chunks']))
+    bounds  = [n_task * k // n_chunk for k in range(n_chunk+1)]
+
+    local_ind  = []
+    local_surf = []
+    local_time = []
+    for k in next_task(n_chunk):
+        chunk   = order[bounds[k]:bounds[k+1]]
+        t_start = time.time()
+        local_surf.extend(evaluate_list([exec_list[i] for i in chunk], t))
+        t_chunk = time.time() - t_start
+        # share the time of the chunk according to the estimated costs
+        c_chunk = sum(costs[i] for i in chunk)
+        for i in chunk:
+            if c_chunk > 0.:
+                local_time.append(t_chunk * costs[i] / c_chunk)
+            else:
+                local_time.append(t_chunk / len(chunk))
+        local_ind.extend(chunk)
+
+    buf, headers, hdr_ind = pescache.pack_surfaces(local_surf)
+
+    # number of surfaces and bytes from each rank
+    sizes = np.zeros((nproc, 2), dtype=np.int64)
+    comm.Allgather([np.array([len(local_ind), len(buf)], dtype=np.int64),
+                    MPI.INT64_T], [sizes, MPI.INT64_T])
+    n_surf = sizes[:,0]
+    n_byte = sizes[:,1]
+
+    # task and header index, timings and packed surfaces from all ranks
+    ind_all  = np.zeros((n_task, 2), dtype=np.int64)
+    time_all = np.zeros(n_task, dtype=float)
+    buf_all  = np.zeros(n_byte.sum(), dtype=np.uint8)
+    comm.Allgatherv([np.array([local_ind, hdr_ind], dtype=np.int64).T.copy(),
+                     MPI.INT64_T],
+                    [ind_all, (2*n_surf, 2*offsets(n_surf)), MPI.INT64_T])
+    comm.Allgatherv([np.array(local_time, dtype=float), MPI.DOUBLE],
+                    [time_all, (n_surf, offsets(n_surf)), MPI.DOUBLE])
+    comm.Allgatherv([buf, MPI.BYTE],
+                    [buf_all, (n_byte, offsets(n_byte)), MPI.BYTE])
+    headers_all = comm.allgather(headers)
+
+    results = [None for k in range(n_task)]
+    surf_start = offsets(n_surf)
+    byte_start = offsets(n_byte)
+    for rank in range(nproc):
+        rank_ind  = ind_all[surf_start[rank]:surf_start[rank]+n_surf[rank]]
+        rank_surf = pescache.unpack_surfaces(buf_all[byte_start[rank]:
+                                                     byte_start[rank]+n_byte[rank]],
+                                             headers_all[rank], rank_ind[:,1],
+                                             [exec_list[k].label for k in rank_ind[:,0]])
+        for k, pes_calc in zip(rank_ind[:,0], rank_surf):
+            results[k] = pes_calc
+
+    for k, t_eval in zip(ind_all[:,0], time_all):
+        pes_cost[exec_list[k].label] = t_eval
+
+    # the interface keeps data from the surfaces it computes (e.g. to fix
+    # the phase of the adiabatic states): make sure it is the same on
+    # all ranks
+    if hasattr(glbl.pes, 'cache_surface'):
+        for pes_calc in results:
+            glbl.pes.cache_surface(pes_calc)
+
+    return results
+
+
+def next_task(n_task):
+    """Yields the indices of the tasks (chunks) taken by this rank.
+
+    The index of the next task is a counter held by rank 0, which each
+    rank increments when it is done with its previous task. The window
+    of the counter is glbl.mpi['task_win'] if given, otherwise it is
+    allocated on first use.
+    """
+    global task_win
+
+    comm = glbl.mpi['comm']
+    win  = glbl.mpi['task_win']
+    if win is None:
+        if task_win is None:
+            size     = np.dtype(np.int64).itemsize
+            task_win = MPI.Win.Allocate(size if glbl.mpi['rank'] == 0 else 0,
+                                        disp_unit=size, comm=comm)
+        win = task_win
+
+    # reset the counter before any rank takes a task
+    if glbl.mpi['rank'] == 0:
+        win.Lock(0, MPI.LOCK_EXCLUSIVE)
+        win.Put([np.zeros(1, dtype=np.int64), MPI.INT64_T], 0)
+        win.Unlock(0)
+    comm.Barrier()
 
-    if label not in pes_cache:
-        return False
+    one  = np.ones(1, dtype=np.int64)
+    task = np.zeros(1, dtype=np.int64)
+    while True:
+        win.Lock(0, MPI.LOCK_SHARED)
+        win.Fetch_and_op([one, MPI.INT64_T], [task, MPI.INT64_T], 0,
+                         op=MPI.SUM)
+        win.Unlock(0)
+        if task[0] >= n_task:
+            return
+        yield int(task[0])
 
-    dg = np.linalg.norm(geom - pes_cache[label].geom)
-    if dg <= glbl.constants['fpzero']:
-        return True
 
-    return False
+def offsets(counts):
+    """Returns the displacements of blocks of the given sizes."""
+    return np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
@@ -1,149 +1,169 @@
 """
 Timers and timing information for subroutines.
 
-Allows for nested timers. Constructed to ensure no overlap between timers,
-so thereotically sum(timers) = total time
+Timers are nested: the time of a call is attributed to the path of
+timers it was made from (e.g. global/step.fms_step_bundle/Bundle.copy),
+so that the report holds both a flat summary per routine and the call
+tree. The time spent in nested timers is subtracted from the flat
+summary, so that thereotically sum(timers) = total time.
+
+Timing is disabled, at no cost, by setting the environment variable
+FMS_TIMINGS=0: the timed decorator then returns functions unchanged
+and start/stop return immediately.
 """
+import os
 import time
+import json
+import functools
+import src.fmsio.glbl as glbl
 
-
-timer_list = dict()
-active_stack = []
-
-
-class timed:
-    """A wrapper/descriptor for timing functions and methods.
-
-    This takes advantage of the fact that __call__ is called for a
-    wrapped function and __get__ is called for a wrapped class
-    method. Functions are automatically named [module name].[func name]
-    and methods are named [class name].[method name].
-    """
-    def __init__(self, func):
-        self.func = func
-
-    def __call__(self, *args, **kwargs):
-        modname = self.func.__module__.split('.')[-1]
-        return self._run_func(modname + '.' +
-                              self.func.__name__, *args, **kwargs)
-
-    def __get__(self, obj, type=None):
-        def hooked(*args, **kwargs):
-            return self._run_func(obj.__class__.__name__ + '.' +
-                                  self.func.__name__, obj, *args, **kwargs)
-        return hooked
-
-    def _run_func(self, name, *args, **kwargs):
-        start(name)
-        result = self.func(*args, **kwargs)
-        stop(name)
-        return result
+# timing can only be switched off before the timed functions are defined
+enabled = os.environ.get('FMS_TIMINGS', '1') != '0'
 
 
 class Timer:
-    """A Timer object for a process 'name'."""
+    """A Timer object: a node 'name' of the call tree. The wall and
+    cpu times (ns) include the time spent in the children."""
     def __init__(self, name):
-        self.name       = name
-        self.calls      = 0
-        self.wall_time  = 0.
-        self.cpu_time   = 0.
-        self.wall_start = 0.
-        self.cpu_start  = 0.
-        self.wall_kids  = 0.
-        self.cpu_kids   = 0.
-        self.running    = False
-
-    def start_call(self):
-        """Start the wall and CPU times and track latest call."""
-        self.calls     += 1
-        self.running    = True
-        self.wall_start = time.time()
-        self.cpu_start  = time.clock()
-        self.wall_kids  = 0.
-        self.cpu_kids   = 0.
-
-    def stop_call(self, cumulative=False):
-        """Add to wall_time and cpu_time. Returns change in wall and
-        CPU times."""
-        d_wall = time.time()  - self.wall_start
-        d_cpu  = time.clock() - self.cpu_start
-
-        # If cumulative, don't subtract off time spent in nested timers.
-        if cumulative:
-            self.wall_time += d_wall
-            self.cpu_time  += d_cpu
-        else:
-            self.wall_time += d_wall - self.wall_kids
-            self.cpu_time  += d_cpu - self.cpu_kids
-
-        self.running = False
-        return d_wall, d_cpu
+        self.name      = name
+        self.calls     = 0
+        self.wall_time = 0
+        self.cpu_time  = 0
+        self.children  = dict()
+
+    def child(self, name):
+        """Returns the child 'name', creating it if need be."""
+        node = self.children.get(name)
+        if node is None:
+            node = Timer(name)
+            self.children[name] = node
+        return node
+
+    def self_time(self):
+        """Returns the wall and cpu times spent in this timer outside of
+        its children."""
+        return (self.wall_time - sum(kid.wall_time for kid in self.children.values()),
+                self.cpu_time  - sum(kid.cpu_time  for kid in self.children.values()))
+
+    def nodes(self, path=()):
+        """Yields the path and node of every timer below this one."""
+        for kid in self.children.values():
+            kid_path = path + (kid.name,)
+            yield kid_path, kid
+            yield from kid.nodes(kid_path)
+
+    def as_dict(self):
+        """Returns the tree below this timer as nested dicts."""
+        return dict(name      = self.name,
+                    calls     = self.calls,
+                    wall_time = self.wall_time * 1.e-9,
+                    cpu_time  = self.cpu_time * 1.e-9,
+                    children  = [kid.as_dict() for kid in self.children.values()])
+
+
+# root of the call tree, and stack of running timers with their start times
+call_tree    = Timer('root')
+active_stack = []
+counter_list = dict()
 
 
-def start(name):
-    """Starts the timer 'name'.
+def timed(func):
+    """A decorator for timing functions and methods. Functions are named
+    [module name].[func name] and methods [class name].[method name]."""
+    if not enabled:
+        return func
 
-    If 'name' doesn't exist, it is created and added to the list of timers.
-    """
-    global timer_list, active_stack
+    if '.' in func.__qualname__:
+        name = func.__qualname__.split('.<locals>.')[-1]
+    else:
+        name = func.__module__.split('.')[-1] + '.' + func.__qualname__
 
-    # if timer already in list, activate it
-    if name not in timer_list:
-        timer_list[name] = Timer(name)
+    @functools.wraps(func)
+    def timed_func(*args, **kwargs):
+        start(name)
+        depth = len(active_stack)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # timers left running by an exception are stopped here
+            while len(active_stack) > depth:
+                stop(active_stack[-1][0].name)
+            stop(name)
+    return timed_func
 
-    # add the timer to the active stack
-    active_stack.append(timer_list[name])
 
-    if active_stack[-1].running:
-        raise ValueError('START timer:' + str(name) +
-                         ' called while running (could be recursion issue)')
+def start(name):
+    """Starts the timer 'name', as a child of the running timer."""
+    if not enabled:
+        return
 
-    active_stack[-1].start_call()
+    parent = active_stack[-1][0] if len(active_stack) > 0 else call_tree
+    active_stack.append((parent.child(name), time.perf_counter_ns(),
+                         time.process_time_ns()))
 
 
 def stop(name, cumulative=False):
-    """Stops the timer 'name'.
+    """Stops the timer 'name', which must be the last one started.
 
-    Trying to stop an unknown timer raises NameError. If not cumulative,
-    the time of child functions are subtracted from the total run time.
+    The time of the call is added to the timer, the flat summary
+    subtracts the time of the nested timers. cumulative is kept for
+    compatibility: the call tree always holds the total time.
     """
-    global active_stack
+    if not enabled:
+        return
 
-    # for time being, assume, last function added to stack, is the first to
-    # be stopped. If more flexibility is required, we'll address it at that time
-    if active_stack[-1].name != name:
+    if len(active_stack) == 0 or active_stack[-1][0].name != name:
         raise NameError('STOP timer: ' + str(name) +
                         ' called, but timer not at top of active stack.\n')
 
-    d_wall, d_cpu = active_stack[-1].stop_call(cumulative)
+    node, wall_start, cpu_start = active_stack.pop()
+    node.calls     += 1
+    node.wall_time += time.perf_counter_ns() - wall_start
+    node.cpu_time  += time.process_time_ns() - cpu_start
 
-    # pop the child off the stack, then go through the active_stack and update
-    # the child times for each of the parent timers
-    active_stack.pop()
 
-    # add the time for the child to the parent
-    if len(active_stack) > 0:
-        active_stack[-1].wall_kids += d_wall
-        active_stack[-1].cpu_kids  += d_cpu
+def count(name, n=1):
+    """Adds n to the counter 'name' (e.g. cache hits), which is reported
+    with the timings."""
+    counter_list[name] = counter_list.get(name, 0) + n
 
 
-def print_timings():
+def flat_timings():
+    """Returns the calls and the wall and cpu times (s) spent in each
+    routine, summed over the paths it was called from and excluding
+    the time in nested timers."""
+    flat = dict()
+    for path, node in call_tree.nodes():
+        wall, cpu = node.self_time()
+        calls, f_wall, f_cpu = flat.get(node.name, (0, 0., 0.))
+        flat[node.name] = (calls + node.calls, f_wall + wall * 1.e-9,
+                           f_cpu + cpu * 1.e-9)
+    return flat
+
+
+def print_timings(gather=False):
     """Prints out a timing report, sorted from highest wall time to
-    lowest.
+    lowest, followed by the counters and the call tree.
 
     The timer 'global' is stopped automatically and its time is used as
-    the cumulative total time.
+    the cumulative total time. If gather is set, the timings of all MPI
+    ranks are gathered (a collective call) and the spread of the wall
+    times over the ranks is reported as well.
     """
-    global timer_list
+    if not enabled:
+        return '\n timings disabled (FMS_TIMINGS=0)\n\n'
 
     # ensure that the global timer has finished and get the total execution time
-    if timer_list['global'].running:
+    if any(node.name == 'global' for node, wall, cpu in active_stack):
+        while active_stack[-1][0].name != 'global':
+            stop(active_stack[-1][0].name)
         stop('global', cumulative=True)
-    tot_cpu  = timer_list['global'].cpu_time
-    tot_wall = timer_list['global'].wall_time
+    glob     = call_tree.child('global')
+    tot_wall = max(glob.wall_time * 1.e-9, 1.e-9)
+    tot_cpu  = max(glob.cpu_time * 1.e-9, 1.e-9)
 
-    sort_list = sorted(timer_list.items(),
-                       key=lambda unsort: unsort[1].wall_time, reverse=True)
+    flat      = flat_timings()
+    sort_list = sorted(flat.items(), key=lambda unsort: unsort[1][1], reverse=True)
 
     # pass timing information as a string
     ostr =  '\n' + '-'*39 + ' timings summary ' + '-'*39 + ' \n'
@@ -153,12 +173,8 @@ def print_timings():
     ofrm = '{:35s}{:12d}{:16.4f}{:8.2f}{:16.4f}{:8.2f}\n'
     frac_wall = 0.
     frac_cpu  = 0.
-    for sort in sort_list:
-        rout = str(sort[0])
+    for rout, (ncall, wtim, ctim) in sort_list:
         if rout != 'global':
-            ncall = sort[1].calls
-            wtim  = sort[1].wall_time
-            ctim  = sort[1].cpu_time
             ostr += ofrm.format(rout, ncall, wtim, wtim/tot_wall, ctim,
                                 ctim/tot_cpu)
             frac_wall += wtim/tot_wall
@@ -168,4 +184,81 @@ def print_timings():
     ostr += ('**total**'.ljust(47) +
              '{:16.4f}{:8.2f}{:16.4f}{:8.2f}\n\n'.format(tot_wall, frac_wall,
                                                              tot_cpu, frac_cpu))
+
+    if len(counter_list) > 0:
+        ostr += ('counter'.ljust(35) + 'count'.rjust(12) + '\n')
+        for name in sorted(counter_list):
+            ostr += '{:35s}{:12d}\n'.format(name, counter_list[name])
+        ostr += '-'*95 + '\n\n'
+
+    # call tree, leaving out the timers that take less than 0.1% of the time
+    ostr += ('call tree'.ljust(47) + 'calls'.rjust(12) + 'wall time'.rjust(16) +
+             'frac.'.rjust(8) + 'self time'.rjust(12) + '\n')
+    for path, node in glob.nodes(('global',)):
+        if node.wall_time * 1.e-9 < 1.e-3 * tot_wall:
+            continue
+        ostr += '{:47s}{:12d}{:16.4f}{:8.2f}{:12.4f}\n'.format(
+                 '  ' * (len(path) - 1) + node.name, node.calls,
+                 node.wall_time * 1.e-9, node.wall_time * 1.e-9 / tot_wall,
+                 node.self_time()[0] * 1.e-9)
+    ostr += '-'*95 + '\n\n'
+
+    if gather and glbl.mpi['parallel']:
+        ostr += rank_timings(sort_list)
     return ostr
+
+
+def rank_timings(sort_list):
+    """Gathers the flat timings of all MPI ranks and returns a report of
+    the minimum, mean and maximum wall time of each routine."""
+    all_flat = glbl.mpi['comm'].allgather(flat_timings())
+
+    ostr = ('routine ({:d} ranks)'.format(len(all_flat)).ljust(35) +
+            'min wall'.rjust(16) + 'mean wall'.rjust(16) +
+            'max wall'.rjust(16) + '\n')
+    names = [name for name, times in sort_list]
+    names.extend(sorted(set(name for flat in all_flat for name in flat) - set(names)))
+    for name in names:
+        if name == 'global':
+            continue
+        walls = [flat.get(name, (0, 0., 0.))[1] for flat in all_flat]
+        ostr += '{:35s}{:16.4f}{:16.4f}{:16.4f}\n'.format(
+                 name, min(walls), sum(walls) / len(walls), max(walls))
+    ostr += '-'*95 + '\n\n'
+    return ostr
+
+
+def write_json(filename):
+    """Writes the call tree and the counters to a JSON file."""
+    with open(filename, 'w') as outfile:
+        json.dump(dict(rank     = glbl.mpi['rank'],
+                       timers   = [kid.as_dict() for kid in call_tree.children.values()],
+                       counters = counter_list), outfile, indent=1)
+
+
+def write_speedscope(filename):
+    """Writes the call tree to a file in the speedscope format (a sampled
+    profile with one sample, weighted by its self time, per path)."""
+    frames  = []
+    index   = dict()
+    samples = []
+    weights = []
+    for path, node in call_tree.nodes():
+        for name in path:
+            if name not in index:
+                index[name] = len(frames)
+                frames.append(dict(name=name))
+        samples.append([index[name] for name in path])
+        weights.append(node.self_time()[0])
+    total = sum(weights)
+
+    with open(filename, 'w') as outfile:
+        json.dump({'$schema' : 'https://www.speedscope.app/file-format-schema.json',
+                   'shared'  : {'frames' : frames},
+                   'profiles': [{'type'       : 'sampled',
+                                 'name'       : 'rank ' + str(glbl.mpi['rank']),
+                                 'unit'       : 'nanoseconds',
+                                 'startValue' : 0,
+                                 'endValue'   : total,
+                                 'samples'    : samples,
+                                 'weights'    : weights}]}, outfile)
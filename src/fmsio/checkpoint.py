@@ -0,0 +1,153 @@
+"""
+Routines for reading and writing binary checkpoint files.
+
+A checkpoint holds one frame per log step. Each frame is an (uncompressed)
+npz archive with the data of the trajectories, the centroids, their
+potential energy surfaces and the state of the random number generators,
+appended to the checkpoint file. An index file (the checkpoint file name
+with '.idx' appended) holds the time, offset and size of every frame, so
+that any frame is read without scanning the file.
+"""
+import io
+import random
+import numpy as np
+import src.fmsio.glbl as glbl
+import src.basis.trajectory as trajectory
+import src.dynamics.pescache as pescache
+
+# record of the index file
+index_dtype = np.dtype([('time', float), ('offset', np.int64), ('size', np.int64)])
+
+# columns of the trajectory store written to the checkpoint
+columns = ['x', 'p', 'width', 'mass', 'phase', 'amplitude', 'state',
+           'alive', 'active', 'deadtime', 'last_spawn', 'exit_time']
+
+
+def write_frame(master, filename):
+    """Appends a frame with the current state of the bundle to the
+    checkpoint file 'filename'."""
+    n_traj = master.n_traj()
+    frame  = dict(time    = master.time,
+                  nstates = master.nstates,
+                  dim     = master.traj[0].dim,
+                  parent  = np.array([traj.parent for traj in master.traj], dtype=int))
+    for name in columns:
+        frame['traj_' + name] = getattr(master.store, name)[:n_traj]
+
+    # surfaces of the trajectories and (living) centroids
+    traj_ind = [i for i in range(n_traj) if master.traj[i].pes_data is not None]
+    cent_ind = [(i, j) for i in range(len(master.cent)) for j in range(i)
+                if master.cent[i][j] is not None and
+                   master.cent[i][j].pes_data is not None]
+    frame['traj_surf'] = np.array(traj_ind, dtype=int)
+    frame['cent_surf'] = np.array(cent_ind, dtype=int).reshape(-1, 2)
+    surf_list = ([master.traj[i].pes_data for i in traj_ind] +
+                 [master.cent[i][j].pes_data for i, j in cent_ind])
+    buf, headers, hdr_ind = pescache.pack_surfaces(surf_list)
+    frame['surf_data']    = buf
+    frame['surf_hdr_ind'] = np.array(hdr_ind, dtype=int)
+    frame['surf_headers'] = np.frombuffer(b''.join(headers), dtype=np.uint8)
+    frame['surf_hdr_len'] = np.array([len(header) for header in headers], dtype=int)
+
+    # state of the random number generators
+    version, mt_state, gauss_next = random.getstate()
+    frame['py_rng']       = np.array(mt_state, dtype=np.int64)
+    frame['py_rng_gauss'] = np.array([] if gauss_next is None else [gauss_next])
+    np_state = np.random.get_state()
+    frame['np_rng']       = np_state[1]
+    frame['np_rng_pos']   = np.array([np_state[2], np_state[3]], dtype=int)
+    frame['np_rng_gauss'] = np_state[4]
+
+    data = io.BytesIO()
+    np.savez(data, **frame)
+    data = data.getvalue()
+
+    with open(filename, 'ab') as chkpt:
+        offset = chkpt.seek(0, io.SEEK_END)
+        chkpt.write(data)
+    with open(filename + '.idx', 'ab') as index:
+        np.array([(master.time, offset, len(data))], dtype=index_dtype).tofile(index)
+
+
+def read_frame(filename, t_restart):
+    """Returns the frame at time t_restart (the last frame if t_restart
+    is -1) of the checkpoint file 'filename'."""
+    try:
+        index = np.fromfile(filename + '.idx', dtype=index_dtype)
+    except IOError:
+        raise FileNotFoundError('Could not open: ' + filename + '.idx')
+    if len(index) == 0:
+        raise ValueError('No frames in checkpoint file ' + filename)
+
+    if t_restart == -1:
+        k = len(index) - 1
+    else:
+        found = np.nonzero(np.abs(index['time'] - t_restart) <
+                           glbl.constants['fpzero'])[0]
+        if len(found) == 0:
+            raise ValueError('Could not find time=' + str(t_restart) +
+                             ' in ' + filename)
+        # if a time was written more than once, take the last frame
+        k = found[-1]
+
+    with open(filename, 'rb') as chkpt:
+        chkpt.seek(int(index['offset'][k]))
+        data = chkpt.read(int(index['size'][k]))
+    with np.load(io.BytesIO(data)) as frame:
+        return {key: frame[key] for key in frame.files}
+
+
+def read_bundle(master, filename, t_restart):
+    """Loads the bundle at time t_restart (the last frame if t_restart is
+    -1) from the checkpoint file 'filename' into the (empty) bundle master.
+
+    Returns the trajectories and centroids for which the surfaces were
+    read, and the surfaces.
+    """
+    frame = read_frame(filename, t_restart)
+
+    master.time    = float(frame['time'])
+    master.nstates = int(frame['nstates'])
+    dim            = int(frame['dim'])
+
+    traj_list = []
+    for i in range(len(frame['parent'])):
+        new_traj = trajectory.Trajectory(master.nstates, dim,
+                                         parent=int(frame['parent'][i]))
+        for name in columns:
+            getattr(new_traj.store, name)[new_traj.row] = frame['traj_' + name][i]
+        traj_list.append(new_traj)
+
+    # add the trajectories as living ones, then kill the dead ones
+    master.add_trajectories(traj_list)
+    for i in range(len(traj_list)):
+        if not frame['traj_alive'][i]:
+            master.kill_trajectory(i)
+        master.traj[i].active = bool(frame['traj_active'][i])
+    master.active  = [i for i in range(master.n_traj()) if master.traj[i].active]
+    master.nactive = len(master.active)
+    if glbl.integrals.require_centroids:
+        master.update_centroids()
+
+    # surfaces
+    hdr_end = np.cumsum(frame['surf_hdr_len'])
+    headers = [frame['surf_headers'][end-size:end].tobytes()
+               for end, size in zip(hdr_end, frame['surf_hdr_len'])]
+    obj_list = ([master.traj[i] for i in frame['traj_surf']] +
+                [master.cent[i][j] for i, j in frame['cent_surf']])
+    surf_list = pescache.unpack_surfaces(frame['surf_data'], headers,
+                                         frame['surf_hdr_ind'],
+                                         [obj.label for obj in obj_list])
+    for obj, surf in zip(obj_list, surf_list):
+        obj.update_pes_info(surf)
+    for i, j in frame['cent_surf']:
+        master.cent[j][i].update_pes_info(master.cent[i][j].pes_data)
+
+    # random number generators
+    gauss_next = frame['py_rng_gauss']
+    random.setstate((3, tuple(int(val) for val in frame['py_rng']),
+                     float(gauss_next[0]) if len(gauss_next) > 0 else None))
+    np.random.set_state(('MT19937', frame['np_rng'], int(frame['np_rng_pos'][0]),
+                         int(frame['np_rng_pos'][1]), float(frame['np_rng_gauss'])))
+
+    return obj_list, surf_list
@@ -11,6 +11,7 @@ import traceback
 import numpy as np
 import src.dynamics.timings as timings
 import src.fmsio.glbl as glbl
+import src.fmsio.output as fms_output
 import src.basis.atom_lib as atom_lib
 
 
@@ -29,6 +30,16 @@ log_format  = dict()
 tfile_names = dict()
 bfile_names = dict()
 print_level = dict()
+# if not None, log file entries are appended here rather than printed
+log_buffer  = None
+# split of the columns of each log into quantities: (name, number of
+# columns (0 for a scalar), type), columns with name None are skipped
+dump_layout = dict()
+# backend the trajectory and bundle logs are written to
+output      = None
+# abort the other MPI processes on an error (off for the runs of an
+# ensemble, which share COMM_WORLD with the other runs)
+abort_on_error = True
 
 
 def read_input_file():
@@ -55,9 +66,18 @@ def read_input_file():
     #   interface
     #   geometry
     #   printing
+    #   ensemble
+    parse_input('fms.input')
 
-    # Read fms.input. Small enough to gulp the whole thing
-    with open('fms.input', 'r') as infile:
+    # ensure that input is internally consistent
+    validate_input()
+
+
+def parse_input(filename):
+    """Reads the sections of the input file 'filename' into the keyword
+    dictionaries, without checking them."""
+    # Small enough to gulp the whole thing
+    with open(filename, 'r') as infile:
         fms_input = infile.readlines()
 
     # remove comment lines
@@ -79,9 +99,6 @@ def read_input_file():
             section = section.replace('-section','').replace('begin','').strip()
             current_line = parse_section(fms_input, current_line, section)
 
-    # ensure that input is internally consistent
-    validate_input()
-
 
 def parse_section(kword_array, line_start, section):
     """Reads a namelist style input, returns results in dictionary.
@@ -270,6 +287,7 @@ def validate_input():
 def init_fms_output():
     """Initialized all the output format descriptors."""
     global log_format, dump_header, dump_format, tfile_names, bfile_names, print_level
+    global dump_layout, output
 
     ncart = 3         # assumes expectation values of transition/permanent dipoles in
                       # cartesian coordinates
@@ -293,6 +311,10 @@ def init_fms_output():
     dump_format[tkeys[0]] = ('{:12.4f}'+
                              ''.join('{:12.6f}' for i in range(2*ncrd+5))+
                              '\n')
+    dump_layout[tkeys[0]] = [('time', 0, float), ('x', ncrd, float),
+                             ('p', ncrd, float), ('phase', 0, float),
+                             ('amplitude', 0, complex), (None, 0, float),
+                             ('state', 0, int)]
 
     # potential energy
     arr1 = ['{:>16s}'.format('potential.' + str(i)) for i in range(nst)]
@@ -300,6 +322,7 @@ def init_fms_output():
     dump_header[tkeys[1]] = 'Time'.rjust(acc1) + ''.join(arr1) + '\n'
     dump_format[tkeys[1]] = ('{:12.4f}' +
                              ''.join('{:16.10f}' for i in range(nst)) + '\n')
+    dump_layout[tkeys[1]] = [('time', 0, float), ('potential', nst, float)]
 
     # gradients
     arr1 = ['            x' + str(i+1) for i in range(ncrd)]
@@ -308,6 +331,7 @@ def init_fms_output():
     dump_format[tkeys[7]] = ('{0:>12.4f}' +
                              ''.join('{' + str(i) + ':14.8f}'
                                      for i in range(1, ncrd+1)) + '\n')
+    dump_layout[tkeys[7]] = [('time', 0, float), ('gradient', ncrd, float)]
 
     # coupling
     arr1 = ['{:>12s}'.format('coupling.' + str(i)) for i in range(nst)]
@@ -317,6 +341,8 @@ def init_fms_output():
                              ''.join(arr2) + '\n')
     dump_format[tkeys[2]] = ('{:12.4f}' +
                              ''.join('{:12.5f}' for i in range(2*nst)) + '\n')
+    dump_layout[tkeys[2]] = [('time', 0, float), ('coupling', nst, float),
+                             ('coup_dot_vel', nst, float)]
 
     # permanent dipoles
     arr1 = ['{:>12s}'.format('dip_st' + str(i) + '.' + dstr[j])
@@ -326,6 +352,7 @@ def init_fms_output():
     dump_format[tkeys[3]] = ('{:12.4f}' +
                              ''.join('{:12.5f}'
                                      for i in range(nst*ncart)) + '\n')
+    dump_layout[tkeys[3]] = [('time', 0, float), ('dipole', nst*ncart, float)]
 
     # transition dipoles
     arr1 = ['  td_s' + str(j) + '.s' + str(i) + '.' + dstr[k]
@@ -336,6 +363,7 @@ def init_fms_output():
     dump_format[tkeys[4]] = ('{:12.4f}' +
                              ''.join('{:12.5f}'
                                      for i in range(1, ncol)) + '\n')
+    dump_layout[tkeys[4]] = [('time', 0, float), ('tr_dipole', ncol-1, float)]
 
     # second moments
     arr1 = ['   sec_s' + str(i) + '.' + dstr[j] + dstr[j]
@@ -345,6 +373,7 @@ def init_fms_output():
     dump_format[tkeys[5]] = ('{:12.4f}' +
                              ''.join('{:12.5f}'
                                      for i in range(nst*ncart)) + '\n')
+    dump_layout[tkeys[5]] = [('time', 0, float), ('sec_mom', nst*ncart, float)]
 
     # atomic populations
     arr1 = ['    st' + str(i) + '_a' + str(j+1)
@@ -354,6 +383,7 @@ def init_fms_output():
     dump_format[tkeys[6]] = ('{:12.4f}' +
                              ''.join('{:10.5f}'
                                      for i in range(nst*natm)) + '\n')
+    dump_layout[tkeys[6]] = [('time', 0, float), ('atom_pop', nst*natm, float)]
 
     # ----------------- dump formats (bundle files) -----------------
 
@@ -365,6 +395,8 @@ def init_fms_output():
     dump_format[bkeys[0]] = ('{:12.4f}' +
                              ''.join('{:12.6f}' for i in range(nst)) +
                              '{:12.6f}\n')
+    dump_layout[bkeys[0]] = [('time', 0, float), ('population', nst, float),
+                             ('norm', 0, float)]
 
     # the bundle energy
     arr1 = ('   potential(QM)', '     kinetic(QM)', '       total(QM)',
@@ -373,6 +405,10 @@ def init_fms_output():
     dump_header[bkeys[1]] = 'Time'.rjust(acc1) + ''.join(arr1) + '\n'
     dump_format[bkeys[1]] = ('{:12.4f}' +
                              ''.join('{:16.10f}' for i in range(6)) + '\n')
+    dump_layout[bkeys[1]] = [('time', 0, float), ('potential_qm', 0, float),
+                             ('kinetic_qm', 0, float), ('total_qm', 0, float),
+                             ('potential_cl', 0, float), ('kinetic_cl', 0, float),
+                             ('total_cl', 0, float)]
 
     # the spawn log
     lenst = 7
@@ -387,6 +423,13 @@ def init_fms_output():
     dump_format[bkeys[2]] = ('{:12.4f}{:12.4f}{:12.4f}{:7d}{:7d}{:7d}{:7d}' +
                              '{:12.8f}{:12.8f}{:12.8f}{:12.8f}' +
                              '{:16.8f}{:16.8f}\n')
+    dump_layout[bkeys[2]] = [('entry_time', 0, float), ('spawn_time', 0, float),
+                             ('exit_time', 0, float), ('parent', 0, int),
+                             ('parent_state', 0, int), ('child', 0, int),
+                             ('child_state', 0, int), ('kinetic_parent', 0, float),
+                             ('kinetic_child', 0, float), ('potential_parent', 0, float),
+                             ('potential_child', 0, float), ('total_parent', 0, float),
+                             ('total_child', 0, float)]
 
     bfile_names[bkeys[3]] = 's.dat'
     bfile_names[bkeys[4]] = 'sdot.dat'
@@ -400,6 +443,14 @@ def init_fms_output():
     dump_header[bkeys[8]] = 'Time'.rjust(acc1) + ''.join(arr1) + '\n'
     dump_format[bkeys[8]] = ('{:12.4f}' +
                              ''.join('{:16.10f}' for i in range(3)) + '\n')
+    dump_layout[bkeys[8]] = [('time', 0, float), ('auto', 0, complex),
+                             (None, 0, float)]
+
+    # the trajectory and bundle logs are written to the selected backend
+    file_names = dict(tfile_names)
+    file_names.update(bfile_names)
+    output = fms_output.init_output(scr_path, file_names, dump_header,
+                                    dump_format, dump_layout)
 
     # ------------------------- log file formats --------------------------
     with open(home_path+'/fms.log', 'w') as logfile:
@@ -481,17 +532,9 @@ def init_fms_output():
 
 
 def print_traj_row(label, fkey, data):
-    """Appends a row of data, formatted by entry 'fkey' in formats to
-    file 'filename'."""
-    filename = scr_path + '/' + tfile_names[tkeys[fkey]] + '.' + str(label)
-
-    if not os.path.isfile(filename):
-        with open(filename, 'x') as outfile:
-            outfile.write(dump_header[tkeys[fkey]])
-            outfile.write(dump_format[tkeys[fkey]].format(*data))
-    else:
-        with open(filename, 'a') as outfile:
-            outfile.write(dump_format[tkeys[fkey]].format(*data))
+    """Appends a row of data, formatted by entry 'fkey' in formats, to
+    the log of trajectory 'label'."""
+    output.traj_row(tkeys[fkey], label, data)
 
 
 def update_logs(bundle):
@@ -511,33 +554,28 @@ def update_logs(bundle):
 def print_bund_row(fkey, data):
     """Appends a row of data, formatted by entry 'fkey' in formats to
     file 'filename'."""
-    filename = scr_path + '/' + bfile_names[bkeys[fkey]]
-
     if glbl.mpi['rank'] == 0:
-        if not os.path.isfile(filename):
-            with open(filename, 'x') as outfile:
-                outfile.write(dump_header[bkeys[fkey]])
-                outfile.write(dump_format[bkeys[fkey]].format(*data))
-        else:
-            with open(filename, 'a') as outfile:
-                outfile.write(dump_format[bkeys[fkey]].format(*data))
+        output.bund_row(bkeys[fkey], data)
 
 
 def print_bund_mat(time, fname, mat):
     """Prints a matrix to file with a time label."""
-    filename = scr_path + '/' + fname
+    output.bund_mat(time, fname, mat)
+
 
-    with open(filename, 'a') as outfile:
-        outfile.write('{:9.2f}\n'.format(time))
-        outfile.write(np.array2string(mat,
-                      formatter={'complex_kind':lambda x: '{: 15.8e}'.format(x)})+'\n')
+def flush_logs():
+    """Writes out the buffered trajectory and bundle logs."""
+    if output is not None:
+        output.flush()
 
 
 def print_fms_logfile(otype, data):
     """Prints a string to the log file."""
-    global log_format, print_level
+    global log_format, print_level, log_buffer
 
-    if glbl.mpi['rank'] == 0:
+    if log_buffer is not None:
+        log_buffer.append((otype, data))
+    elif glbl.mpi['rank'] == 0:
         if otype not in log_format:
             print('CANNOT WRITE otype=' + str(otype) + '\n')
         elif glbl.printing['print_level'] >= print_level[otype]:
@@ -620,13 +658,29 @@ def cleanup_end():
     # simulation ended
     print_fms_logfile('complete', [])
 
-    # print timing information
+    # print timing information, with the spread over the MPI ranks
     timings.stop('global', cumulative=True)
-    t_table = timings.print_timings()
+    t_table = timings.print_timings(gather=True)
     print_fms_logfile('timings', [t_table])
+    export_timings()
+
+    # copy output files: the ranks share the scratch directory, so the
+    # files are moved by the root once every rank is done writing
+    if glbl.mpi['parallel']:
+        glbl.mpi['comm'].Barrier()
+    if glbl.mpi['rank'] == 0:
+        copy_output()
+    elif output is not None:
+        output.close()
 
-    # copy output files
-    copy_output()
+
+def export_timings():
+    """Writes the call tree of the timers as JSON and in the speedscope
+    format, if requested."""
+    if glbl.printing['timings_export'] and timings.enabled:
+        fname = scr_path + '/timings.' + str(glbl.mpi['rank'])
+        timings.write_json(fname + '.json')
+        timings.write_speedscope(fname + '.speedscope.json')
 
 
 def cleanup_exc(etyp, val, tb):
@@ -636,24 +690,33 @@ def cleanup_exc(etyp, val, tb):
     print_fms_logfile('error', [rm_timer(exception)])
 
     # stop remaining timers
-    for timer in timings.active_stack[:0:-1]:
+    for timer, wall_start, cpu_start in timings.active_stack[:0:-1]:
         timings.stop(timer.name)
 
     # print timing information
     timings.stop('global', cumulative=True)
     t_table = timings.print_timings()
     print_fms_logfile('timings', [t_table])
+    export_timings()
 
-    # copy output files
-    copy_output()
+    # copy output files: if the other processes carry on, the files are
+    # only moved by the root
+    if abort_on_error or glbl.mpi['rank'] == 0:
+        copy_output()
+    elif output is not None:
+        output.close()
 
     # abort other processes if running in parallel
-    if glbl.mpi['parallel']:
+    if glbl.mpi['parallel'] and abort_on_error:
         glbl.mpi['comm'].Abort(1)
 
 
 def copy_output():
     """Copies output files to current working directory."""
+    # write out the buffered logs
+    if output is not None:
+        output.close()
+
     # move trajectory summary files to an output directory in the home area
     odir = home_path + '/output'
     if os.path.exists(odir):
@@ -673,17 +736,23 @@ def copy_output():
         except IOError:
             pass
 
-    # move chkpt file
-    try:
-        shutil.move(scr_path + '/last_step.dat', odir)
-    except IOError:
-        pass
+    # move hdf5 output and chkpt files
+    for fname in ['output.h5', 'checkpoint.dat', 'checkpoint.dat.idx',
+                  'last_step.dat']:
+        try:
+            shutil.move(scr_path + '/' + fname, odir)
+        except IOError:
+            pass
+
+    # move timings exports
+    for tfile in glob.glob(scr_path + '/timings.*'):
+        shutil.move(tfile, odir)
 
 
 def rm_timer(exc):
     """Removes the timer lines from an Exception traceback."""
     tb = exc.split('\n')
-    regex = re.compile('.*timings\.py.*in (hooked|_run_func)')
+    regex = re.compile('.*timings\.py.*in timed_func')
     i = 0
     while i < len(tb):
         if re.match(regex, tb[i]):
@@ -36,7 +36,14 @@ mpi = dict(
     parallel               = False,
     comm                   = None,
     rank                   = 0,
-    nproc                  = 1
+    nproc                  = 1,
+    # MPI window of the counter of pes tasks (allocated on first use if
+    # None; an ensemble allocates it before its runs start)
+    task_win               = None,
+    # number of processes evaluating the pes on a single node (w/o MPI)
+    pes_workers            = 0,
+    # number of chunks of pes evaluations handed out per MPI rank
+    task_chunks            = 4
            )
 
 # input related to initial conditions
@@ -62,15 +69,21 @@ propagate = dict(
     integrals              = 'saddle_point',
     integral_order          = 1,
     propagator             = 'velocity_verlet',
+    amp_propagator         = 'expm',
     energy_jump_toler      = 0.0001,
+    # not used: the jumps of the (normalized) populations are checked
+    # through the norm, norm_thresh
     pop_jump_toler         = 0.0001,
     pot_shift              = 0.,
     renorm                 = False,
     sinv_thrsh             = -1.0,
+    sinv_method            = 'pinv',
+    sinv_cond_max          = 1.e10,
     norm_thresh            = 1.,
     auto                   = False,
     phase_prop             = True,
     sij_thresh             = 0.7,
+    snuc_thresh            = 0.,
     hij_coup_thresh        = 0.001,
     matching_pursuit       = False
                  )
@@ -90,6 +103,13 @@ interface = dict(
     # pertain to all interfaces
     interface              = 'vibronic',
     coupling_order         = 1,
+    # memory (MB) allowed for the cache of computed surfaces (disabled
+    # if 0)
+    pes_cache_mb           = 0.,
+    # file (relative to the input directory) of the store of computed
+    # surfaces shared between runs (none if empty), and its size (MB)
+    pes_store              = '',
+    pes_store_mb           = 1000.,
 
     # parameters that apply to the COLUMBUS interface
     mem_per_core           = 100,
@@ -97,6 +117,9 @@ interface = dict(
 
     # parameters that apply to vibronic interface
     opfile                 = 'fms.op',
+    # keep the compiled Hamiltonian in a binary file next to the operator
+    # file, which later runs map instead of parsing the operator file
+    op_cache               = True,
     # highest polynomial order in vibronic expansion
     ordr_max               = 1
                  )
@@ -121,7 +144,38 @@ printing = dict(
     print_traj             = True,
     print_es               = True,
     print_matrices         = True,
-    print_chkpt            = True
+    print_chkpt            = True,
+    print_chkpt_text       = False,
+    # backend of the trajectory and bundle logs: text or hdf5
+    output_format          = 'text',
+    # write the text logs of all trajectories to one file per quantity
+    traj_columnar          = False,
+    # the logs are written out once log_flush_kb kB are buffered, or
+    # log_flush_time seconds after the last write
+    log_flush_kb           = 1024.,
+    log_flush_time         = 60.,
+    # write the timings as JSON and in the speedscope format
+    timings_export         = False,
+    # warn whenever the surface data of a trajectory (centroid) is read
+    # at a geometry other than the one it was computed at (slow)
+    debug_checks           = False
+                )
+
+# input related to ensembles of independent runs (ensemble.py)
+ensemble = dict(
+    # number of runs
+    n_runs                 = 1,
+    # seed of each run (run k uses seed + k if not given)
+    seeds                  = [],
+    # geometry files the runs cycle through, each is copied to the
+    # geomfile of its run (the geomfile of the input if empty)
+    geomfiles              = [],
+    # number of runs executed at the same time (without MPI)
+    ensemble_workers       = 1,
+    # number of MPI ranks executing each run
+    group_size             = 1,
+    # directory holding the runs and the ensemble averages
+    ensemble_dir           = 'ensemble'
                 )
 
 # this is a list of valid dictionary names. groups of input need to be added to
@@ -133,7 +187,8 @@ input_groups = dict(
     spawning               = spawning,
     nuclear_basis          = nuclear_basis,
     interface              = interface,
-    printing               = printing
+    printing               = printing,
+    ensemble               = ensemble
                     )
 
 # lists keywords, the datatype of the keyword and the dimension
@@ -152,6 +207,8 @@ keyword_type = dict(
     comm                   = [None,0],
     rank                   = [int,0],
     nproc                  = [int,0],
+    pes_workers            = [int,0],
+    task_chunks            = [int,0],
     restart                = [bool,0],
     init_sampling          = [str,0],
     n_init_traj            = [int,0],
@@ -171,15 +228,19 @@ keyword_type = dict(
     integrals              = [str,0],
     integral_order         = [int,0],
     propagator             = [str,0],
+    amp_propagator         = [str,0],
     energy_jump_toler      = [float,0],
     pop_jump_toler         = [float,0],
     pot_shift              = [float,0],
     renorm                 = [bool,0],
     sinv_thrsh             = [float,0],
+    sinv_method            = [str,0],
+    sinv_cond_max          = [float,0],
     norm_thresh            = [float,0],
     auto                   = [bool,0],
     phase_prop             = [bool,0],
     sij_thresh             = [float,0],
+    snuc_thresh            = [float,0],
     hij_coup_thresh        = [float,0],
     spawning               = [str,0],
     spawn_pop_thresh       = [float,0],
@@ -188,9 +249,13 @@ keyword_type = dict(
     continuous_min_overlap = [float,0],
     interface              = [str,0],
     coupling_order         = [int,0],
+    pes_cache_mb           = [float,0],
+    pes_store              = [str,0],
+    pes_store_mb           = [float,0],
     mem_per_core           = [float,0],
     coup_de_thresh         = [float,0],
     opfile                 = [str,0],
+    op_cache               = [bool,0],
     ordr_max               = [int,0],
     use_atom_lib           = [bool,0],
     init_amp_overlap       = [bool,0],
@@ -208,5 +273,18 @@ keyword_type = dict(
     print_traj             = [bool,0],
     print_es               = [bool,0],
     print_matrices         = [bool,0],
-    print_chkpt            = [bool,0]
+    print_chkpt            = [bool,0],
+    print_chkpt_text       = [bool,0],
+    output_format          = [str,0],
+    traj_columnar          = [bool,0],
+    log_flush_kb           = [float,0],
+    log_flush_time         = [float,0],
+    timings_export         = [bool,0],
+    debug_checks           = [bool,0],
+    n_runs                 = [int,0],
+    seeds                  = [int,1],
+    geomfiles              = [str,1],
+    ensemble_workers       = [int,0],
+    group_size             = [int,0],
+    ensemble_dir           = [str,0]
                     )
@@ -0,0 +1,68 @@
+"""
+The LogWriter object: buffered writing of the trajectory and bundle logs.
+
+Rows are collected in memory, per file, and written out when the buffered
+text exceeds a given size, when a given time has passed since the last
+write, or when flush() is called (at a checkpoint and at the end of the
+run). Files are kept open between writes; if more than max_open files
+are open, the least recently written ones are closed.
+"""
+import os
+import time
+import collections
+
+
+class LogWriter:
+    """Class constructor for the LogWriter object. The buffers are
+    written out once they hold more than flush_size characters, or
+    flush_time seconds after the last write."""
+    def __init__(self, flush_size, flush_time, max_open=256):
+        self.flush_size = flush_size
+        self.flush_time = flush_time
+        self.max_open   = max_open
+        # buffered text of each file, in the order first written
+        self.buffers    = collections.OrderedDict()
+        self.size       = 0
+        self.last_flush = time.time()
+        # open file handles, least recently written first
+        self.files      = collections.OrderedDict()
+
+    def write(self, filename, text, header=None):
+        """Appends text to file 'filename'. If the file does not exist
+        yet, it is started with header."""
+        if filename not in self.buffers:
+            self.buffers[filename] = []
+            if header is not None and filename not in self.files and \
+                    not os.path.isfile(filename):
+                self.buffers[filename].append(header)
+                self.size += len(header)
+        self.buffers[filename].append(text)
+        self.size += len(text)
+
+        if (self.size > self.flush_size or
+                time.time() - self.last_flush > self.flush_time):
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered text to the files."""
+        for filename, text in self.buffers.items():
+            outfile = self.files.pop(filename, None)
+            if outfile is None:
+                outfile = open(filename, 'a')
+            outfile.write(''.join(text))
+            outfile.flush()
+            self.files[filename] = outfile
+
+        while len(self.files) > self.max_open:
+            self.files.popitem(last=False)[1].close()
+
+        self.buffers.clear()
+        self.size       = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        """Writes the buffered text and closes all files."""
+        self.flush()
+        for outfile in self.files.values():
+            outfile.close()
+        self.files.clear()
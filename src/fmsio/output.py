@@ -0,0 +1,232 @@
+"""
+Output backends for the trajectory and bundle logs.
+
+A backend receives the rows of the trajectory logs (trajectory, poten,
+gradient, coupling, ...), of the bundle logs (n.dat, e.dat, spawn.dat,
+...) and the bundle matrices (s.dat, h.dat, ...). The backend is chosen
+with the output_format keyword:
+
+  text : fixed-width text files, one per log (and per trajectory)
+  hdf5 : a single HDF5 file, output.h5, with chunked, compressed and
+         appendable datasets for each quantity (requires h5py)
+"""
+import time
+import numpy as np
+import scipy.sparse as sp_sparse
+import src.fmsio.glbl as glbl
+import src.fmsio.logwriter as logwriter
+
+
+def init_output(path, file_names, headers, formats, layouts):
+    """Returns the output backend selected by output_format, writing
+    to directory 'path'."""
+    flush_size = glbl.printing['log_flush_kb'] * 1024
+    flush_time = glbl.printing['log_flush_time']
+
+    if glbl.printing['output_format'] == 'text':
+        return TextOutput(path, file_names, headers, formats,
+                          flush_size, flush_time)
+    elif glbl.printing['output_format'] == 'hdf5':
+        return HDF5Output(path + '/output.h5', file_names, layouts,
+                          flush_size, flush_time)
+    else:
+        raise ValueError('output_format=' + str(glbl.printing['output_format']) +
+                         ' not recognized')
+
+
+class TextOutput:
+    """Class constructor for the TextOutput object: the logs are written
+    to text files, through a LogWriter."""
+    def __init__(self, path, file_names, headers, formats, flush_size, flush_time):
+        self.path       = path
+        self.file_names = file_names
+        self.headers    = headers
+        self.formats    = formats
+        self.writer     = logwriter.LogWriter(flush_size, flush_time)
+
+    def traj_row(self, key, label, data):
+        """Appends a row to the log 'key' of trajectory 'label'.
+
+        If traj_columnar is set, the rows of all trajectories go to a
+        single file, with the trajectory label in the column after the
+        time.
+        """
+        header = self.headers[key]
+        row    = self.formats[key].format(*data)
+        if glbl.printing['traj_columnar']:
+            filename = self.path + '/' + self.file_names[key] + '.dat'
+            # the time takes the first 12 characters
+            header   = header[:12] + 'Traj'.rjust(8) + header[12:]
+            row      = row[:12] + '{:8d}'.format(label) + row[12:]
+        else:
+            filename = self.path + '/' + self.file_names[key] + '.' + str(label)
+
+        self.writer.write(filename, row, header=header)
+
+    def bund_row(self, key, data):
+        """Appends a row to the bundle log 'key'."""
+        self.writer.write(self.path + '/' + self.file_names[key],
+                          self.formats[key].format(*data), header=self.headers[key])
+
+    def bund_mat(self, t_mat, fname, mat):
+        """Appends a matrix with a time label to file 'fname'."""
+        if sp_sparse.issparse(mat):
+            mat = mat.toarray()
+
+        self.writer.write(self.path + '/' + fname, '{:9.2f}\n'.format(t_mat) +
+                          np.array2string(mat,
+                          formatter={'complex_kind':lambda x: '{: 15.8e}'.format(x)})+'\n')
+
+    def flush(self):
+        """Writes out the buffered rows."""
+        self.writer.flush()
+
+    def close(self):
+        """Writes out the buffered rows and closes the files."""
+        self.writer.close()
+
+
+class HDF5Output:
+    """Class constructor for the HDF5Output object: the logs are written
+    to datasets of an HDF5 file.
+
+    Trajectory log 'name' of trajectory 'label' goes to group
+    /traj/label/name, bundle log 'name' to /bundle/name and matrix 'name'
+    to /bundle/matrices/name. The columns of a row are split into
+    datasets (time, x, p, ...) following the layout of the log. A matrix
+    group holds the time, the size and the (zero padded) matrix of each
+    step. Rows are buffered and appended to the datasets on the same
+    policy as the text logs, the file is synced at most every flush_time
+    seconds. The file is only opened at the first write.
+    """
+    def __init__(self, filename, file_names, layouts, flush_size, flush_time):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('output_format = hdf5 requires the h5py package')
+        self.h5py       = h5py
+        self.filename   = filename
+        self.file_names = file_names
+        self.layouts    = layouts
+        self.flush_size = flush_size
+        self.flush_time = flush_time
+        self.h5file     = None
+        self.datasets   = dict()
+        # buffered rows of each group, and matrices of each matrix group
+        self.rows       = dict()
+        self.mats       = dict()
+        self.size       = 0
+        self.last_flush = time.time()
+        self.last_sync  = time.time()
+
+    def group_name(self, key):
+        """Returns the name of the group of log 'key'."""
+        name = self.file_names.get(key, key)
+        return name[:-4] if name.endswith('.dat') else name
+
+    def traj_row(self, key, label, data):
+        """Appends a row to the log 'key' of trajectory 'label'."""
+        self.add_row('traj/' + str(label) + '/' + self.group_name(key), key, data)
+
+    def bund_row(self, key, data):
+        """Appends a row to the bundle log 'key'."""
+        self.add_row('bundle/' + self.group_name(key), key, data)
+
+    def bund_mat(self, t_mat, fname, mat):
+        """Appends a matrix with a time label to matrix group 'fname'."""
+        if sp_sparse.issparse(mat):
+            mat = mat.toarray()
+        group = 'bundle/matrices/' + self.group_name(fname)
+        self.mats.setdefault(group, []).append((t_mat, np.array(mat, dtype=complex)))
+        self.check_flush(mat.nbytes)
+
+    def add_row(self, group, key, data):
+        """Buffers a row of group 'group', with the layout of log 'key'."""
+        if group not in self.rows:
+            self.rows[group] = (key, [])
+        self.rows[group][1].append(data)
+        self.check_flush(8 * len(data))
+
+    def check_flush(self, nbytes):
+        """Writes out the buffers if they are full, or if the flush time
+        has passed."""
+        self.size += nbytes
+        if (self.size > self.flush_size or
+                time.time() - self.last_flush > self.flush_time):
+            self.flush()
+
+    def dataset(self, path, values):
+        """Returns dataset 'path', creating it (empty, with the shape and
+        type of the rows of values) if need be. The datasets are kept, so
+        that they are only looked up once."""
+        dset = self.datasets.get(path)
+        if dset is None:
+            if path in self.h5file:
+                dset = self.h5file[path]
+            else:
+                dset = self.h5file.create_dataset(path, dtype=values.dtype,
+                                                  shape=(0,) + values.shape[1:],
+                                                  maxshape=(None,)*values.ndim,
+                                                  chunks=True, compression='gzip')
+            self.datasets[path] = dset
+        return dset
+
+    def append(self, path, values):
+        """Appends values along the first axis of dataset 'path'. The
+        other axes are enlarged if need be (values are zero padded)."""
+        dset  = self.dataset(path, values)
+        shape = (dset.shape[0] + len(values),) + tuple(
+                 max(n_old, n_new) for n_old, n_new in zip(dset.shape[1:],
+                                                           values.shape[1:]))
+        dset.resize(shape)
+        dset[(slice(dset.shape[0] - len(values), None),) +
+             tuple(slice(0, n) for n in values.shape[1:])] = values
+
+    def flush(self):
+        """Appends the buffered rows and matrices to the datasets."""
+        if len(self.rows) > 0 or len(self.mats) > 0:
+            if self.h5file is None:
+                self.h5file = self.h5py.File(self.filename, 'a')
+
+            for group, (key, rows) in self.rows.items():
+                rows  = np.array(rows, dtype=float)
+                col   = 0
+                for name, ncol, dtype in self.layouts[key]:
+                    width  = max(ncol, 1) * (2 if dtype is complex else 1)
+                    values = rows[:, col:col+width]
+                    col   += width
+                    if name is None:
+                        continue
+                    if dtype is complex:
+                        values = values[:, 0::2] + 1j * values[:, 1::2]
+                    values = values.astype(dtype)
+                    self.append(group + '/' + name,
+                                values if ncol > 0 else values[:, 0])
+
+            for group, mats in self.mats.items():
+                size   = max(len(mat) for t_mat, mat in mats)
+                values = np.zeros((len(mats), size, size), dtype=complex)
+                for k, (t_mat, mat) in enumerate(mats):
+                    values[k, :len(mat), :len(mat)] = mat
+                self.append(group + '/time', np.array([t_mat for t_mat, mat in mats]))
+                self.append(group + '/size', np.array([len(mat) for t_mat, mat in mats]))
+                self.append(group + '/matrix', values)
+
+            # syncing the file is slow, it is done at most every
+            # flush_time seconds
+            if time.time() - self.last_sync > self.flush_time:
+                self.h5file.flush()
+                self.last_sync = time.time()
+
+        self.rows.clear()
+        self.mats.clear()
+        self.size       = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        """Writes out the buffers and closes the file."""
+        self.flush()
+        if self.h5file is not None:
+            self.h5file.close()
+            self.h5file   = None
+            self.datasets = dict()
@@ -7,6 +7,7 @@ import math
 import numpy as np
 import src.fmsio.glbl as glbl
 import src.integrals.nuclear_gaussian as nuclear
+import src.integrals.nuclear_gaussian_batch as nuclear_batch
 
 # Let FMS know if overlap matrix elements require PES info
 overlap_requires_pes = False
@@ -152,3 +153,100 @@ def sdot_integral(t1, t2, Snuc=None, e_only=False, nuc_only=False):
                 1j * t2.phase_dot() * Snuc)
 
         return sdot
+
+
+def batch_integrals(bra, ket, cent=None, Snuc=None):
+    """Returns the trajectory overlap, T, V, S, Snuc and Sdot matrix
+    elements between every bra and ket in the (broadcast) TrajBlocks
+    bra and ket."""
+    if Snuc is None:
+        Snuc = batch_nuc_overlap(bra, ket)
+
+    kecoeff = glbl.pes.kecoeff
+    args    = (bra.widths, bra.x, bra.p, ket.widths, ket.x, ket.p)
+    same    = bra.state == ket.state
+
+    # overlap of trajectories (including electronic component)
+    S = np.where(same, Snuc, 0j)
+
+    # time-derivative of the overlap
+    deldx = nuclear_batch.deldx(Snuc, *args)
+    Sdot  = _batch_sdot(bra, ket, Snuc, deldx,
+                        nuclear_batch.deldp(Snuc, *args))
+
+    # kinetic energy
+    T = -np.dot(nuclear_batch.deld2x(Snuc, *args), kecoeff)
+    T = np.where(same, T, 0j)
+
+    # potential energy: average of the expansions about the bra and the ket
+    vij = _batch_v_expansion(bra, ket, Snuc, deldx)
+    vji = _batch_v_expansion(ket, bra, Snuc.conjugate(),
+                             nuclear_batch.deldx(Snuc.conjugate(),
+                                                 ket.widths, ket.x, ket.p,
+                                                 bra.widths, bra.x, bra.p))
+    V = 0.5*(vij + vji.conjugate())
+
+    return S, T, V, S, Snuc, Sdot
+
+def batch_sdot(bra, ket, Snuc=None):
+    """Returns the Sdot matrix elements between every bra and ket in the
+    (broadcast) TrajBlocks bra and ket."""
+    if Snuc is None:
+        Snuc = batch_nuc_overlap(bra, ket)
+
+    args = (bra.widths, bra.x, bra.p, ket.widths, ket.x, ket.p)
+    return _batch_sdot(bra, ket, Snuc, nuclear_batch.deldx(Snuc, *args),
+                       nuclear_batch.deldp(Snuc, *args))
+
+def _batch_sdot(bra, ket, Snuc, deldx, deldp):
+    """Returns <bra | d/dt | ket> from the derivatives of the nuclear
+    overlap with respect to x and p."""
+    Sdot = (np.sum(deldx * ket.velocity, axis=-1) +
+            np.sum(deldp * ket.force, axis=-1) + 1j * ket.phase_dot * Snuc)
+    return np.where(bra.state == ket.state, Sdot, 0j)
+
+def batch_nuc_overlap(bra, ket):
+    """Returns the nuclear overlap between every bra and ket in the
+    (broadcast) TrajBlocks bra and ket."""
+    return nuclear_batch.overlap(bra.phase, bra.widths, bra.x, bra.p,
+                                 ket.phase, ket.widths, ket.x, ket.p)
+
+def _batch_v_expansion(t1, t2, Sij, deldx):
+    """Returns the potential matrix elements <t1|V|t2> with the potential
+    expanded about the t1 trajectories (see v_integral)."""
+    if glbl.propagate['integral_order'] > 2:
+        raise ValueError('Integral_order > 2 not implemented for bra_ket_averaged')
+
+    s1, s2 = np.broadcast_arrays(t1.state, t2.state)
+    same   = s1 == s2
+    args   = (t1.widths, t1.x, t1.p, t2.widths, t2.x, t2.p)
+
+    # Adiabatic energy
+    v_same = t1.state_elem('potential', s1) * Sij
+
+    if glbl.propagate['integral_order'] > 0:
+        o1_ij   = nuclear_batch.ordr1_vec(*args)
+        v_same += np.sum((o1_ij - t1.x*Sij[..., np.newaxis]) *
+                         t1.state_elem('deriv', s1, s1), axis=-1)
+
+    if glbl.propagate['integral_order'] > 1:
+        xcen  = (t1.widths*t1.x + t2.widths*t2.x) / (t1.widths+t2.widths)
+        o2_ij = nuclear_batch.ordr2_vec(*args)
+        x1    = np.broadcast_to(t1.x, o1_ij.shape)
+        hess  = t1.hessian
+        v_same += 0.5*np.sum(o2_ij * np.diagonal(hess, axis1=-2, axis2=-1),
+                             axis=-1)
+        # only the lower triangle of the hessian enters the expansion
+        hlow  = np.tril(hess, k=-1)
+        def quad(u, v):
+            return np.einsum('...k,...kl,...l->...', u, hlow, v)
+        v_same += 0.5 * (2.*quad(o1_ij, o1_ij) -
+                         quad(xcen, o1_ij) - quad(o1_ij, xcen) -
+                         quad(o1_ij, x1) - quad(x1, o1_ij) +
+                         (quad(x1, xcen) + quad(xcen, x1))*Sij)
+
+    # Derivative coupling
+    fij    = t1.state_elem('deriv', s1, s2)
+    v_diff = 2.*np.sum(fij * glbl.pes.kecoeff * deldx, axis=-1)
+
+    return np.where(same, v_same, v_diff)
@@ -8,6 +8,8 @@ import numpy as np
 import src.fmsio.glbl as glbl
 import src.integrals.nuclear_dirac as dirac 
 import src.integrals.nuclear_gaussian as gauss
+import src.integrals.nuclear_dirac_batch as dirac_batch
+import src.integrals.nuclear_gaussian_batch as gauss_batch
 
 # Let FMS know if overlap matrix elements require PES info
 overlap_requires_pes = False
@@ -112,3 +114,48 @@ def sdot_integral(traj1, traj2, Snuc=None):
                 1j * traj2.phase_dot() * Snuc)
 
         return sdot
+
+# all matrix elements over a (broadcast) block of trajectory pairs
+def batch_integrals(bra, ket, cent=None, Snuc=None):
+    """Returns the trajectory overlap, T, V, S, Snuc and Sdot matrix
+    elements between every bra (dirac delta) and ket in the (broadcast)
+    TrajBlocks bra and ket."""
+    if Snuc is None:
+        Snuc = batch_nuc_overlap(bra, ket)
+
+    kecoeff = glbl.pes.kecoeff
+    args    = (bra.x, ket.phase, ket.widths, ket.x, ket.p)
+    s1, s2  = np.broadcast_arrays(bra.state, ket.state)
+    same    = s1 == s2
+
+    # overlap of the trajectories
+    t_ovrlp = gauss_batch.overlap(bra.phase, bra.widths, bra.x, bra.p,
+                                  ket.phase, ket.widths, ket.x, ket.p)
+    t_ovrlp = np.where(same, t_ovrlp, 0j)
+
+    # overlap under the pseudospectral projection
+    S = np.where(same, Snuc, 0j)
+
+    # time-derivative of the overlap
+    deldx = dirac_batch.deldx(Snuc, *args)
+    deldp = dirac_batch.deldp(Snuc, *args)
+    Sdot  = (np.sum(ket.velocity * deldx, axis=-1) +
+             np.sum(ket.force * deldp, axis=-1) + 1j * ket.phase_dot * Snuc)
+    Sdot  = np.where(same, Sdot, 0j)
+
+    # kinetic energy
+    T = -np.sum(dirac_batch.deld2x(Snuc, *args) * kecoeff, axis=-1)
+    T = np.where(same, T, 0j)
+
+    # potential energy
+    v_same = bra.state_elem('potential', s1) * Snuc
+    fij    = bra.state_elem('deriv', s1, s2)
+    v_diff = np.sum(fij * 2.*kecoeff * deldx, axis=-1) * Snuc
+    V      = np.where(same, v_same, v_diff)
+
+    return t_ovrlp, T, V, S, Snuc, Sdot
+
+def batch_nuc_overlap(bra, ket):
+    """Returns the overlap of every bra (dirac delta) with every ket in
+    the (broadcast) TrajBlocks bra and ket."""
+    return dirac_batch.overlap(bra.x, ket.phase, ket.widths, ket.x, ket.p)
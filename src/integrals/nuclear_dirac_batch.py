@@ -0,0 +1,37 @@
+"""
+Mathematical functions for matrix elements between a Dirac delta
+function and a primitive Gaussian function.
+
+These are array versions of the routines in nuclear_dirac: every
+argument carries the degrees of freedom along its last axis and any
+leading axes are broadcast against each other.
+"""
+import numpy as np
+
+
+def overlap(x1, g2, a2, x2, p2):
+    """Returns the overlap of a Dirac delta function and a primitive
+    Gaussian function."""
+    dx        = x1 - x2
+    prefactor = np.prod(np.sqrt(np.sqrt(2. * a2 / np.pi)), axis=-1)
+    real_part = np.sum(a2 * dx**2, axis=-1)
+    imag_part = np.sum(p2 * dx, axis=-1)
+    return prefactor * np.exp(-real_part + 1j*(imag_part + g2))
+
+
+def deldp(S, x1, g2, a2, x2, p2):
+    """Returns the d/dp[i] matrix element between a Dirac delta function
+    and a primitive Gaussian. Returns a vector for each p[i]"""
+    return (x1 - x2) * 1j * S[..., np.newaxis]
+
+
+def deldx(S, x1, g2, a2, x2, p2):
+    """Returns the d/dx[i] matrix element between a Dirac delta function
+    and a primitive Gaussian. Returns a vector for each x[i]"""
+    return (2. * a2 * (x1 - x2) - 1j * p2) * S[..., np.newaxis]
+
+
+def deld2x(S, x1, g2, a2, x2, p2):
+    """Returns the d^2/dx[i]^2 matrix element between a Dirac delta function
+    and a primitive Gaussian. Returns a vector for each x[i]"""
+    return (-2. * a2 + (-2. * a2 * (x1 - x2) + 1j * p2)**2) * S[..., np.newaxis]
@@ -0,0 +1,101 @@
+"""
+Computes matrix elements over the nuclear component of the trajectory
+basis function, assumes bra is also product of frozen gaussians.
+
+These are array versions of the routines in nuclear_gaussian: every
+argument carries the degrees of freedom along its last axis and any
+leading axes are broadcast against each other. Passing bra arrays of
+shape (n1, 1, dim) and ket arrays of shape (1, n2, dim) returns the
+full (n1, n2) block of matrix elements in a single call.
+"""
+import math
+import numpy as np
+
+
+def overlap(g1, a1, x1, p1, g2, a2, x2, p2):
+    """Returns overlap of the nuclear component between two trajectories."""
+    dx        = x1 - x2
+    dp        = p1 - p2
+    prefactor = np.prod(np.sqrt(2. * np.sqrt(a1 * a2) / (a1 + a2)), axis=-1)
+    x_center  = (a1 * x1 + a2 * x2) / (a1 + a2)
+    real_part = np.sum((a1*a2*dx**2 + 0.25*dp**2) / (a1 + a2), axis=-1)
+    imag_part = np.sum((p1*x1 - p2*x2) - x_center * dp, axis=-1)
+    return prefactor * np.exp(-real_part + 1j*(imag_part + g2 - g1))
+
+
+def deldp(S, a1, x1, p1, a2, x2, p2):
+    """Returns the del/dp matrix element between the nuclear component
+       of two trajectories for each componet of 'p' (does not sum over terms)"""
+    dx    = x1 - x2
+    dp    = p1 - p2
+    dpval = (dp + 2. * 1j * a1 * dx) / (2. * (a1 + a2))
+    return dpval * S[..., np.newaxis]
+
+
+def deldx(S, a1, x1, p1, a2, x2, p2):
+    """Returns the del/dx matrix element between the nuclear component
+       of two trajectories for each componet of 'x' (does not sum over terms)"""
+    dx    = x1 - x2
+    psum  = a1*p2 + a2*p1
+    dxval = (2. * a1 * a2 * dx - 1j * psum) / (a1 + a2)
+    return dxval * S[..., np.newaxis]
+
+
+def deld2x(S, a1, x1, p1, a2, x2, p2):
+    """Returns the del^2/d^2x matrix element between the nuclear component
+       of two trajectories for each componet of 'x' (does not sum over terms)"""
+    dx     = x1 - x2
+    psum   = a1*p2 + a2*p1
+    d2xval = -(1j * 4. * a1 * a2 * dx * psum + 2. * a1 * a2 * (a1 + a2) -
+               4. * dx**2 * a1**2 * a2**2 + psum**2) / (a1 + a2)**2
+    return d2xval * S[..., np.newaxis]
+
+
+def prim_v_integral(N, a1, x1, p1, a2, x2, p2):
+    """Returns the matrix element <cmplx_gaus(q,p)| q^N |cmplx_gaus(q,p)>
+     -- up to an overlap integral --
+
+    N is a (scalar) integer power, the remaining arguments are the
+    widths, positions and momenta of a single coordinate.
+    """
+    N = int(N)
+    a = a1 + a2
+    b = 2.*(a1*x1 + a2*x2) - 1j*(p1 - p2)
+
+    # generally these should be 1D harmonic oscillators. If
+    # multi-dimensional, the final result is a direct product of
+    # each dimension
+    v_int = np.zeros(np.shape(b), dtype=complex)
+    for i in range(N//2 + 1):
+        v_int += ((a**(i-N)) * (b**(N-2*i)) /
+                  (math.factorial(i) * math.factorial(N-2*i)))
+
+    # avoid weird issues associated with 0^0==1, occurs when N==2*i:
+    small = np.abs(b) < np.finfo(float).eps
+    if np.any(small):
+        if N % 2 != 0:
+            v_small = np.zeros(np.shape(b))
+        else:
+            v_small = (a**(-(N//2))) / math.factorial(N//2)
+        v_int = np.where(small, v_small, v_int)
+
+    # refer to appendix for derivation of these relations
+    return v_int * math.factorial(N) / (2.**N)
+
+
+def ordr1_vec(a1, x1, p1, a2, x2, p2):
+    """Returns the matrix element <cmplx_gaus(q,p)| q |cmplx_gaus(q,p)>
+     -- up to an overlap integral -- for each component of q
+    """
+    a = a1 + a2
+    b = 2.*(a1*x1 + a2*x2) - 1j*(p1 - p2)
+    return b / (2.*a)
+
+
+def ordr2_vec(a1, x1, p1, a2, x2, p2):
+    """Returns the matrix element <cmplx_gaus(q,p)| q^2 |cmplx_gaus(q,p)>
+     -- up to an overlap integral -- for each component of q
+    """
+    a = a1 + a2
+    b = 2.*(a1*x1 + a2*x2) - 1j*(p1 - p2)
+    return 0.5 * (b**2 / (2 * a**2) + (1/a))
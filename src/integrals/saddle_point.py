@@ -9,6 +9,7 @@ import math
 import numpy as np
 import src.fmsio.glbl as glbl
 import src.integrals.nuclear_gaussian as nuclear
+import src.integrals.nuclear_gaussian_batch as nuclear_batch
 
 # Let FMS know if overlap matrix elements require PES info
 overlap_requires_pes = False
@@ -127,3 +128,52 @@ def sdot_integral(t1, t2, Snuc=None, e_only=False, nuc_only=False):
                 +1j * t2.phase_dot() * Snuc)
 
         return sdot
+
+# all matrix elements over a (broadcast) block of trajectory pairs
+def batch_integrals(bra, ket, cent=None, Snuc=None):
+    """Returns the trajectory overlap, T, V, S, Snuc and Sdot matrix
+    elements between every bra and ket in the (broadcast) TrajBlocks
+    bra and ket. cent is a CentBlock holding the centroid of each pair."""
+    if Snuc is None:
+        Snuc = batch_nuc_overlap(bra, ket)
+
+    kecoeff = glbl.pes.kecoeff
+    args    = (bra.widths, bra.x, bra.p, ket.widths, ket.x, ket.p)
+    s1, s2  = np.broadcast_arrays(bra.state, ket.state)
+    same    = s1 == s2
+    diag    = bra.label == ket.label
+
+    # overlap of trajectories (including electronic component)
+    S = np.where(same, Snuc, 0j)
+
+    # time-derivative of the overlap
+    deldx = nuclear_batch.deldx(Snuc, *args)
+    deldp = nuclear_batch.deldp(Snuc, *args)
+    Sdot  = (np.sum(deldx * ket.velocity, axis=-1) +
+             np.sum(deldp * ket.force, axis=-1) + 1j * ket.phase_dot * Snuc)
+    Sdot  = np.where(same, Sdot, 0j)
+
+    # kinetic energy
+    T = -np.dot(nuclear_batch.deld2x(Snuc, *args), kecoeff)
+    T = np.where(same, T, 0j)
+
+    # potential energy: the diagonal is the adiabatic energy of the
+    # trajectory, off-diagonal elements are evaluated at the centroid
+    v_diag = bra.state_elem('potential', s1)
+    v_same = cent.state_elem('potential', s1) * Snuc
+    fij    = cent.state_elem('deriv', s1, s2)
+    v_diff = 2.*np.sum(fij * kecoeff * deldx, axis=-1)
+    if glbl.interface['coupling_order'] == 3:
+        v_diag = v_diag + bra.state_elem('scalar_coup', s1, s2)
+        v_same = v_same + cent.state_elem('scalar_coup', s1, s2) * Snuc
+    if glbl.interface['coupling_order'] > 1:
+        v_diff = v_diff + cent.state_elem('scalar_coup', s1, s2) * Snuc
+    V = np.where(same, np.where(diag, v_diag, v_same), v_diff)
+
+    return S, T, V, S, Snuc, Sdot
+
+def batch_nuc_overlap(bra, ket):
+    """Returns the nuclear overlap between every bra and ket in the
+    (broadcast) TrajBlocks bra and ket."""
+    return nuclear_batch.overlap(bra.phase, bra.widths, bra.x, bra.p,
+                                 ket.phase, ket.widths, ket.x, ket.p)
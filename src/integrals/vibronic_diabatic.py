@@ -3,7 +3,9 @@ Compute integrals over trajectories traveling on vibronic potentials
 """
 import math
 import numpy as np
+import src.fmsio.glbl as glbl
 import src.integrals.nuclear_gaussian as nuclear
+import src.integrals.nuclear_gaussian_batch as nuclear_batch
 
 # Let FMS know if overlap matrix elements require PES info
 overlap_requires_pes = False
@@ -97,3 +99,75 @@ def sdot_integral(t1, t2, Snuc=None):
                  1.j*t2.phase_dot()*Snuc )
 
         return sdot
+
+# all matrix elements over a (broadcast) block of trajectory pairs
+def batch_integrals(bra, ket, cent=None, Snuc=None):
+    """Returns the trajectory overlap, T, V, S, Snuc and Sdot matrix
+    elements between every bra and ket in the (broadcast) TrajBlocks
+    bra and ket."""
+    if Snuc is None:
+        Snuc = batch_nuc_overlap(bra, ket)
+
+    ham    = glbl.pes.ham
+    args   = (bra.widths, bra.x, bra.p, ket.widths, ket.x, ket.p)
+    s1, s2 = np.broadcast_arrays(bra.state, ket.state)
+    same   = s1 == s2
+
+    # overlap of trajectories (including electronic component)
+    S = np.where(same, Snuc, 0j)
+
+    # time-derivative of the overlap
+    deldx = nuclear_batch.deldx(Snuc, *args)
+    Sdot  = _batch_sdot(bra, ket, Snuc, deldx,
+                        nuclear_batch.deldp(Snuc, *args))
+
+    # kinetic energy
+    T = -np.sum(nuclear_batch.deld2x(Snuc, *args) * glbl.pes.kecoeff, axis=-1)
+    T = np.where(same, T, 0j)
+
+    # potential energy: roll through the terms in the hamiltonian, each
+    # primitive integral <q_i^N> is evaluated once for all pairs
+    st_lo = np.minimum(s1, s2)
+    st_hi = np.maximum(s1, s2)
+    prim  = dict()
+    V     = np.zeros(s1.shape, dtype=complex)
+    for i in range(ham.nterms):
+        s_lo, s_hi = ham.stalbl[i,:] - 1
+        mask       = (st_lo == s_lo) & (st_hi == s_hi)
+        if not np.any(mask):
+            continue
+        v_term = complex(1.,0.) * ham.coe[i]
+        for q in range(len(ham.order[i])):
+            qi  = ham.mode[i][q]
+            key = (qi, ham.order[i][q])
+            if key not in prim:
+                prim[key] = nuclear_batch.prim_v_integral(ham.order[i][q],
+                                    bra.widths[...,qi], bra.x[...,qi], bra.p[...,qi],
+                                    ket.widths[...,qi], ket.x[...,qi], ket.p[...,qi])
+            v_term = v_term * prim[key]
+        V += np.where(mask, v_term, 0j)
+
+    return S, T, V * Snuc, S, Snuc, Sdot
+
+def batch_sdot(bra, ket, Snuc=None):
+    """Returns the Sdot matrix elements between every bra and ket in the
+    (broadcast) TrajBlocks bra and ket."""
+    if Snuc is None:
+        Snuc = batch_nuc_overlap(bra, ket)
+
+    args = (bra.widths, bra.x, bra.p, ket.widths, ket.x, ket.p)
+    return _batch_sdot(bra, ket, Snuc, nuclear_batch.deldx(Snuc, *args),
+                       nuclear_batch.deldp(Snuc, *args))
+
+def _batch_sdot(bra, ket, Snuc, deldx, deldp):
+    """Returns <bra | d/dt | ket> from the derivatives of the nuclear
+    overlap with respect to x and p."""
+    Sdot = (np.sum(deldx * ket.velocity, axis=-1) +
+            np.sum(deldp * ket.force, axis=-1) + 1j * ket.phase_dot * Snuc)
+    return np.where(bra.state == ket.state, Sdot, 0j)
+
+def batch_nuc_overlap(bra, ket):
+    """Returns the nuclear overlap between every bra and ket in the
+    (broadcast) TrajBlocks bra and ket."""
+    return nuclear_batch.overlap(bra.phase, bra.widths, bra.x, bra.p,
+                                 ket.phase, ket.widths, ket.x, ket.p)
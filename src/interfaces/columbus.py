@@ -209,6 +209,28 @@ def init_interface():
     make_one_time_input()
 
 
+def init_worker(worker_id):
+    """Sets up the work directory of a pes worker process."""
+    global work_path
+
+    # each worker needs a work directory of its own: start from a copy
+    # of the work directory of the main process, which holds the one
+    # time input
+    main_path = work_path
+    work_path = main_path + '.' + str(worker_id)
+
+    if os.path.exists(work_path):
+        shutil.rmtree(work_path)
+    shutil.copytree(main_path, work_path, symlinks=True)
+
+
+def input_files():
+    """Returns the files of the COLUMBUS input directory, which determine
+    the surfaces."""
+    home_input = os.path.join(fileio.home_path, 'input')
+    return [os.path.join(home_input, item) for item in os.listdir(home_input)]
+
+
 def evaluate_trajectory(traj, t=None):
     """Computes MCSCF/MRCI energy and computes all couplings.
 
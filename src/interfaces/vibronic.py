@@ -1,10 +1,13 @@
 """
 Routines for running a vibronic coupling calculation.
 """
+import os
 import sys
 import copy
+import json
+import hashlib
 import numpy as np
-import scipy.linalg as sp_linalg
+import scipy.sparse as sp_sparse
 import src.fmsio.glbl as glbl
 import src.fmsio.fileio as fileio
 
@@ -13,6 +16,12 @@ ham = None
 nsta = glbl.propagate['n_states']
 data_cache = dict()
 
+# layout of the binary cache of the compiled Hamiltonian: the version is
+# part of the key, so that older cache files are rewritten
+cache_version = 1
+cache_magic   = b'FMSVHAM\0'
+cache_align   = 64
+
 
 class Surface:
     """Object containing potential energy surface data."""
@@ -106,6 +115,9 @@ class VibHam:
         self.freqmap      = dict()
         self.mrange       = None
 
+        # the Hamiltonian compiled into a PolyOperator
+        self.poly         = None
+
     def rdgeomfile(self, fname):
         """Reads the labels of the geometry.dat file for ordering purposes."""
         with open(fname, 'r') as infile:
@@ -192,11 +204,105 @@ class VibHam:
         self.nterms = sum(active)
         self.coe    = coe[active]
         self.stalbl = stalbl[active]
-        self.mode   = np.array(mode)[active]
-        self.order  = np.array(order)[active]
+        # terms have different numbers of modes, keep these as lists
+        self.mode   = [mode[i] for i in range(nterms) if active[i]]
+        self.order  = [order[i] for i in range(nterms) if active[i]]
         self.mrange = [self.mlbl_total.index(i) for i in self.mlbl_active]
 
 
+class PolyOperator:
+    """The terms of a vibronic Hamiltonian compiled into a monomial table.
+
+    The diabatic potential matrix and its first and second derivatives
+    are all linear combinations of monomials in q: the terms of the
+    Hamiltonian and their derivatives. Each distinct monomial is stored
+    once, as the modes and powers of its factors (padded with zero
+    powers to the same number of factors). For each of V, dV/dq and
+    d2V/dq2 a sparse coefficient table maps the values of the monomials
+    to the elements of the (flattened) matrix. The powers of q are then
+    computed once per geometry and shared by all the monomials.
+    """
+    def __init__(self, vham, nstates):
+        self.nstates = int(nstates)
+        self.nmode   = vham.nmode_total
+        nmode        = self.nmode
+        nst          = self.nstates
+
+        # monomials, indexed by their ((mode, power), ...) factors
+        monos = dict()
+        # entries (monomial, element, coefficient) of the coefficient
+        # tables for V, dV/dq and d2V/dq2
+        table = [([], [], []) for i in range(3)]
+
+        def add_entry(order, factors, elems, coeff):
+            """Adds coeff * monomial to elems of derivative order 'order'."""
+            key = tuple(sorted((m, o) for m, o in factors.items() if o > 0))
+            if key not in monos:
+                monos[key] = len(monos)
+            for elem in elems:
+                table[order][0].append(monos[key])
+                table[order][1].append(elem)
+                table[order][2].append(coeff)
+
+        for i in range(vham.nterms):
+            s1, s2 = vham.stalbl[i] - 1
+            # the terms contribute to the lower triangle, and by symmetry
+            # to the upper triangle
+            blocks = [s1*nst + s2] if s1 == s2 else [s1*nst + s2, s2*nst + s1]
+            factors = dict()
+            for m, o in zip(vham.mode[i], vham.order[i]):
+                factors[m] = factors.get(m, 0) + o
+
+            add_entry(0, factors, blocks, vham.coe[i])
+            for m, o in factors.items():
+                dfac     = dict(factors)
+                dfac[m] -= 1
+                add_entry(1, dfac, [m*nst*nst + b for b in blocks],
+                          vham.coe[i] * o)
+                for n, o2 in dfac.items():
+                    if o2 == 0:
+                        continue
+                    d2fac     = dict(dfac)
+                    d2fac[n] -= 1
+                    add_entry(2, d2fac, [(m*nmode + n)*nst*nst + b for b in blocks],
+                              vham.coe[i] * o * o2)
+
+        nfac = max([1] + [len(key) for key in monos])
+        self.mono_mode  = np.zeros((len(monos), nfac), dtype=int)
+        self.mono_power = np.zeros((len(monos), nfac), dtype=int)
+        for key, ind in monos.items():
+            for k, (m, o) in enumerate(key):
+                self.mono_mode[ind, k]  = m
+                self.mono_power[ind, k] = o
+        self.max_power = int(self.mono_power.max(initial=0))
+
+        nelem = [nst*nst, nmode*nst*nst, nmode*nmode*nst*nst]
+        self.coeff = [sp_sparse.csr_matrix((table[k][2], (table[k][0], table[k][1])),
+                                           shape=(len(monos), nelem[k]))
+                      for k in range(3)]
+
+    def monomials(self, q):
+        """Returns the values of the monomials at the geometries q (one
+        per row)."""
+        ngeom  = len(q)
+        powers = np.ones((ngeom, self.nmode, self.max_power + 1))
+        if self.max_power > 0:
+            powers[:, :, 1:] = np.cumprod(np.repeat(q[:, :, np.newaxis],
+                                                    self.max_power, axis=2), axis=2)
+        return np.prod(powers[:, self.mono_mode, self.mono_power], axis=2)
+
+    def evaluate(self, q, nderiv=2):
+        """Returns the diabatic potential matrix, and its derivatives up to
+        order nderiv, at the geometries q (one per row)."""
+        q     = np.atleast_2d(q)
+        mono  = self.monomials(q)
+        shape = [(self.nstates, self.nstates),
+                 (self.nmode, self.nstates, self.nstates),
+                 (self.nmode, self.nmode, self.nstates, self.nstates)]
+        return tuple(self.coeff[k].T.dot(mono.T).T.reshape((len(q),) + shape[k])
+                     for k in range(nderiv + 1))
+
+
 def init_interface():
     """Reads geometry.dat, freq.dat and the operator file.
 
@@ -205,7 +311,11 @@ def init_interface():
     As such, we must read the labels in geometry.dat followed by
     freq.dat file BEFORE reading the operator file.
     """
-    global kecoeff, ham
+    global kecoeff, ham, nsta
+
+    # the number of states is read from the input after this module
+    # may have been imported
+    nsta = glbl.propagate['n_states']
 
     # Read in geometry labels, frequency and operator files
     ham = VibHam()
@@ -227,8 +337,22 @@ def init_interface():
     for i in range(len(ham.freq)):
         ham.freqmap[ham.mlbl_active[i]] = ham.freq[i]
 
-    # operator file will always be a separate file
-    ham.rdoperfile(fileio.home_path + '/' + glbl.interface['opfile'])
+    # operator file will always be a separate file. The compiled
+    # Hamiltonian is mapped from the cache next to it if it is up to date
+    opname = os.path.join(fileio.home_path, glbl.interface['opfile'])
+    cname  = opname + '.cache'
+    cached = False
+    if glbl.interface['op_cache']:
+        key    = op_cache_key(opname)
+        cached = read_op_cache(cname, key)
+    if not cached:
+        ham.rdoperfile(opname)
+        ham.poly = PolyOperator(ham, nsta)
+        if glbl.interface['op_cache']:
+            try:
+                write_op_cache(cname, key)
+            except OSError:
+                cname = None
 
     # KE operator coefficients, mass- and frequency-scaled normal mode
     # coordinates, a_i = 0.5*omega_i
@@ -242,6 +366,10 @@ def init_interface():
     fileio.print_fms_logfile('string', ['*'*72])
     fileio.print_fms_logfile('string',
                              ['Operator file: ' + glbl.interface['opfile']])
+    if glbl.interface['op_cache']:
+        string = ('Operator cache: ' + str(cname) +
+                  (' (read)' if cached else ' (written)' if cname else ' (not writable)'))
+        fileio.print_fms_logfile('string', [string])
     fileio.print_fms_logfile('string',
                              ['Number of Hamiltonian terms: ' + str(ham.nterms)])
     string = 'Total no. modes: ' + str(ham.nmode_total)
@@ -263,45 +391,43 @@ def init_interface():
 
 def evaluate_trajectory(traj, t=None):
     """Evaluates the trajectory."""
-    global data_cache
+    return evaluate_batch(np.array([traj.x()]), [traj.label], t)[0]
 
-    label = traj.label
-    geom  = traj.x()
-
-    # Calculation of the diabatic potential matrix
-    diabpot = calc_diabpot(geom)
+def evaluate_centroid(traj, t=None):
+    """Evaluates the centroid.
 
-    # Calculation of the nuclear derivatives of the diabatic potential
-    diabderiv1 = calc_diabderiv1(geom)
+    At the moment, this function is just evaluate_trajectory.
+    """
+    return evaluate_trajectory(traj, t)
 
-    # Calculatoin of the hessian matrix for each sub-block of the diabatic potential 
-    # matrix
-    diabderiv2 = calc_diabderiv2(geom)
+def evaluate_batch(geoms, labels, t=None):
+    """Evaluates the surfaces at a stack of geometries.
 
-    # Calculation of the Laplacian of the diabatic potential wrt the
-    # nuclear DOFs
-    diablap = calc_diablap(geom)
+    geoms has one geometry per row, labels gives the label of the
+    trajectory (or centroid) at each geometry. Returns a list of
+    Surface objects.
+    """
+    global data_cache
 
-    #** load the data into the pes object to pass to trajectory **
+    geoms  = np.atleast_2d(np.asarray(geoms, dtype=float))
+    ngeom  = len(geoms)
 
-    t_data           = Surface(label, nsta, ham.nmode_active)
-    t_data.geom      = geom
+    # Calculation of the diabatic potential matrix and its first and
+    # second derivatives wrt the nuclear DOFs
+    diabpot, diabderiv1, diabderiv2 = calc_diab(geoms)
 
-    t_data.diabat_pot     = diabpot
-    t_data.diabat_deriv   = diabderiv1
-    t_data.diabat_deriv2  = diabderiv2
+    # Calculation of the adiabatic potential vector and ADT matrix
+    adiabpot, datmat = calc_dat(labels, diabpot)
 
-    t_data.data_keys     = ['geom','poten','deriv','deriv2','coupling','nac',
-                            'diabat_pot','diabat_deriv','diabat_deriv2']
+    # Calculation of the NACT matrix
+    nactmat = calc_nacts(adiabpot, datmat, diabderiv1)
 
     if glbl.variables['surface_rep'] == 'adiabatic':
-        # Calculation of the adiabatic potential vector and ADT matrix
-        adiabpot, datmat = calc_dat(label, diabpot)
-
-        # Calculation of the NACT matrix
-        nactmat = calc_nacts(adiabpot, datmat, diabderiv1)
+        # Calculation of the Laplacian of the diabatic potential wrt the
+        # nuclear DOFs
+        diablap = np.einsum('nmmij->nij', diabderiv2)
 
-        # Calculation of the gradients (for diagonal elements) and derivative 
+        # Calculation of the gradients (for diagonal elements) and derivative
         # couplings (off-diagonal elements)
         adiabderiv1 = calc_adiabderiv1(datmat, diabderiv1)
 
@@ -310,52 +436,187 @@ def evaluate_trajectory(traj, t=None):
         adiabderiv2 = calc_adiabderiv2(datmat, diabderiv2)
 
         # Calculation of the scalar couplings terms (SCTs)
-        # Note that in order to calculate the SCTs, we get the gradients of the
-        # diagonal Born-Oppenheimer corrections (DBOCs). Consequently, we
-        # save these as a matter of course.
-        sctmat, dbocderiv1 = calc_scts(adiabpot, datmat, diabderiv1,
-                                   nactmat, adiabderiv1, diablap)
-
-        t_data.potential   = adiabpot
-        t_data.deriv       = [np.diag(adiabderiv1[m]) for m in
-                             range(ham.nmode_total)] + nactmat
-        t_data.deriv2      = adiabderiv2
-        t_data.coupling    = nactmat
-        t_data.nac         = nactmat
-        t_data.scalar_coup = 0.5*sctmat #account for the 1/2 prefactor in the EOMs
-
-        # adiabatic -> diabatic and diabatic -> adiabatic transformation matrices
-        t_data.dat_mat        = datmat
-        t_data.adt_mat        = datmat.T
-        t_data.adiabat_pot    = adiabpot
-        t_data.adiabat_deriv  = adiabderiv1
-        t_data.adiabat_deriv2 = adiabderiv2
-
-        t_data.data_keys.extend(['adiabat_pot','adiabat_deriv'])
-
+        sctmat = calc_scts(adiabpot, datmat, diabderiv1, nactmat,
+                           adiabderiv1, diablap)
     else:
-        # Calculation of the adiabatic potential vector and ADT matrix
-        adiabpot, datmat = calc_dat(label, diabpot)
-        # Calculation of the NACT matrix
-        nactmat = calc_nacts(adiabpot, datmat, diabderiv1)
         # determine the effective diabatic coupling: Hij / (Ei - Ej)
-        diab_effcoup     = calc_diabeffcoup(diabpot)
+        diab_effcoup = calc_diabeffcoup(diabpot)
+
+    #** load the data into the pes objects to pass to the trajectories **
+    surf_list = []
+    for n in range(ngeom):
+        t_data           = Surface(labels[n], nsta, ham.nmode_active)
+        t_data.geom      = geoms[n].copy()
+
+        t_data.diabat_pot     = diabpot[n].copy()
+        t_data.diabat_deriv   = diabderiv1[n].copy()
+        t_data.diabat_deriv2  = diabderiv2[n].copy()
+
+        t_data.data_keys     = ['geom','poten','deriv','deriv2','coupling','nac',
+                                'diabat_pot','diabat_deriv','diabat_deriv2']
+
+        if glbl.variables['surface_rep'] == 'adiabatic':
+            t_data.potential   = adiabpot[n].copy()
+            t_data.deriv       = (adiabderiv1[n][:,:,np.newaxis] *
+                                  np.eye(nsta) + nactmat[n])
+            t_data.deriv2      = adiabderiv2[n].copy()
+            t_data.coupling    = nactmat[n].copy()
+            t_data.nac         = nactmat[n].copy()
+            #account for the 1/2 prefactor in the EOMs
+            t_data.scalar_coup = 0.5*sctmat[n]
+
+            # adiabatic -> diabatic and diabatic -> adiabatic transformation matrices
+            t_data.dat_mat        = datmat[n].copy()
+            t_data.adt_mat        = datmat[n].T.copy()
+            t_data.adiabat_pot    = adiabpot[n].copy()
+            t_data.adiabat_deriv  = adiabderiv1[n].copy()
+            t_data.adiabat_deriv2 = adiabderiv2[n].copy()
+
+            t_data.data_keys.extend(['adiabat_pot','adiabat_deriv'])
 
-        t_data.potential = np.array([diabpot[i,i] for i in range(nsta)])
-        t_data.deriv     = diabderiv1 
-        t_data.deriv2    = diabderiv2
-        t_data.coupling  = diab_effcoup
-        t_data.nac       = nactmat
+        else:
+            t_data.potential = diabpot[n].diagonal().copy()
+            t_data.deriv     = diabderiv1[n].copy()
+            t_data.deriv2    = diabderiv2[n].copy()
+            t_data.coupling  = diab_effcoup[n].copy()
+            t_data.nac       = nactmat[n].copy()
 
-    data_cache[label] = t_data
-    return t_data
+        cache_surface(t_data)
+        surf_list.append(t_data)
 
-def evaluate_centroid(traj, t=None):
-    """Evaluates the centroid.
+    return surf_list
 
-    At the moment, this function is just evaluate_trajectory.
+
+def cache_surface(surf):
+    """Keeps the adiabatic-to-diabatic transformation of surf, which fixes
+    the phase of the adiabatic states at the next evaluation for the same
+    label."""
+    global data_cache
+
+    data_cache[surf.tag] = surf.dat_mat
+
+
+def input_files():
+    """Returns the files read by init_interface, which determine the
+    surfaces."""
+    files = [os.path.join(fileio.home_path, glbl.interface['opfile'])]
+    if glbl.nuclear_basis['geomfile'] != '':
+        files.append(fileio.home_path + '/geometry.dat')
+    return files
+
+
+#----------------------------------------------------------------------
+#
+# Binary cache of the compiled Hamiltonian
+#
+#----------------------------------------------------------------------
+def op_cache_key(opname):
+    """Returns a hash of what the compiled Hamiltonian depends on: the
+    operator file, the mode labels and the number of states."""
+    sha = hashlib.sha1()
+    sha.update(repr([cache_version, nsta, ham.mlbl_total,
+                     ham.mlbl_active]).encode())
+    with open(opname, 'rb') as infile:
+        sha.update(infile.read())
+    return sha.hexdigest()
+
+
+def write_op_cache(fname, key):
+    """Writes the Hamiltonian terms and the tables of its PolyOperator to
+    the binary file fname.
+
+    The file holds a magic string, the length of a JSON header, the
+    header (the key, the sizes and the type, shape and offset of each
+    array) and the arrays, aligned so that they can be mapped in place.
+    It is written to a temporary file and renamed, so that runs mapping
+    the old file are not disturbed.
     """
-    return evaluate_trajectory(traj, t)
+    arrays = dict(coe        = ham.coe,
+                  stalbl     = ham.stalbl,
+                  term_ptr   = np.cumsum([0] + [len(m) for m in ham.mode]),
+                  term_mode  = np.array([m for modes in ham.mode for m in modes],
+                                        dtype=int),
+                  term_order = np.array([o for ords in ham.order for o in ords],
+                                        dtype=int),
+                  mrange     = np.array(ham.mrange, dtype=int),
+                  mono_mode  = ham.poly.mono_mode,
+                  mono_power = ham.poly.mono_power)
+    for k, coeff in enumerate(ham.poly.coeff):
+        arrays['coeff' + str(k) + '_data']    = coeff.data
+        arrays['coeff' + str(k) + '_indices'] = coeff.indices
+        arrays['coeff' + str(k) + '_indptr']  = coeff.indptr
+
+    layout = dict()
+    offset = 0
+    for name, val in arrays.items():
+        layout[name] = (val.dtype.str, val.shape, offset)
+        offset      += -(-val.nbytes // cache_align) * cache_align
+    header = json.dumps(dict(key         = key,
+                             nterms      = int(ham.nterms),
+                             nstates     = ham.poly.nstates,
+                             nmode       = ham.poly.nmode,
+                             max_power   = ham.poly.max_power,
+                             coeff_shape = [coeff.shape for coeff in ham.poly.coeff],
+                             layout      = layout)).encode()
+    start  = -(-(len(cache_magic) + 8 + len(header)) // cache_align) * cache_align
+
+    tmpname = fname + '.' + str(os.getpid())
+    with open(tmpname, 'wb') as outfile:
+        outfile.write(cache_magic + len(header).to_bytes(8, 'little') + header)
+        for name, val in arrays.items():
+            outfile.seek(start + layout[name][2])
+            outfile.write(np.ascontiguousarray(val).tobytes())
+        outfile.truncate(start + offset)
+    os.replace(tmpname, fname)
+
+
+def read_op_cache(fname, key):
+    """Maps the binary file fname written by write_op_cache into the
+    Hamiltonian. The arrays are read-only views of the file, shared by
+    all the processes that map it. Returns False if the file is missing
+    or was written for a different key."""
+    try:
+        with open(fname, 'rb') as infile:
+            if infile.read(len(cache_magic)) != cache_magic:
+                return False
+            hlen   = int.from_bytes(infile.read(8), 'little')
+            header = json.loads(infile.read(hlen).decode())
+            if header['key'] != key:
+                return False
+            # the file object is mapped, a file renamed over fname in the
+            # mean time is not seen
+            start = -(-(len(cache_magic) + 8 + hlen) // cache_align) * cache_align
+            buf   = np.memmap(infile, dtype=np.uint8, mode='r')
+    except (OSError, ValueError, KeyError):
+        return False
+
+    arrays = dict()
+    for name, (dtype, shape, offset) in header['layout'].items():
+        dtype = np.dtype(dtype)
+        nbyte = int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = buf[start+offset:start+offset+nbyte].view(dtype).reshape(shape)
+
+    ptr = arrays['term_ptr']
+    ham.nterms = header['nterms']
+    ham.coe    = arrays['coe']
+    ham.stalbl = arrays['stalbl']
+    ham.mode   = [arrays['term_mode'][ptr[i]:ptr[i+1]] for i in range(ham.nterms)]
+    ham.order  = [arrays['term_order'][ptr[i]:ptr[i+1]] for i in range(ham.nterms)]
+    ham.mrange = arrays['mrange']
+
+    ham.poly            = PolyOperator.__new__(PolyOperator)
+    ham.poly.nstates    = header['nstates']
+    ham.poly.nmode      = header['nmode']
+    ham.poly.max_power  = header['max_power']
+    ham.poly.mono_mode  = arrays['mono_mode']
+    ham.poly.mono_power = arrays['mono_power']
+    ham.poly.coeff      = [sp_sparse.csr_matrix((arrays['coeff' + str(k) + '_data'],
+                                                 arrays['coeff' + str(k) + '_indices'],
+                                                 arrays['coeff' + str(k) + '_indptr']),
+                                                shape=tuple(header['coeff_shape'][k]),
+                                                copy=False)
+                           for k in range(3)]
+    return True
 
 
 #----------------------------------------------------------------------
@@ -427,138 +688,44 @@ def get_coe(val_list):
     return coeff
 
 
-def calc_diabpot(q):
-    """Constructs the diabatic potential matrix for a given nuclear
-    geometry q.
-
-    N.B. the terms held in the coe, ord and stalbl contribute only
-    to the lower-triangle of the diabatic potential matrix.
-    """
-    diabpot = np.zeros((nsta, nsta))
+def calc_diab(q):
+    """Constructs the diabatic potential matrix and its 1st and 2nd
+    derivatives wrt the nuclear DOFs for a stack of nuclear geometries q
+    (one per row)."""
+    return ham.poly.evaluate(q)
 
-    # Fill in the lower-triangle
-    for i in range(ham.nterms):
-        s1, s2 = ham.stalbl[i] - 1
-        if ham.mode[i] == []:
-            diabpot[s1,s2] += ham.coe[i]
-        else:
-            diabpot[s1,s2] += ham.coe[i] * np.prod(q[ham.mode[i]]**ham.order[i])
 
-    # Fill in the upper-triangle
-    diabpot += diabpot.T - np.diag(diabpot.diagonal())
-    return diabpot
+def calc_dat(labels, diabpot):
+    """Diagonalises the diabatic potential matrices to yield the adiabatic
+    potentials and the adiabatic-to-diabatic transformation matrices."""
+    adiabpot, datmat = np.linalg.eigh(diabpot)
 
+    # Set phase convention that the greatest abs element in dat column
+    # vector is positive
+    ngeom = len(diabpot)
+    imax  = np.argmax(np.abs(datmat), axis=1)
+    sign  = np.sign(np.take_along_axis(datmat, imax[:, :, np.newaxis], axis=2)[:, :, 0])
 
-def calc_dat(label, diabpot):
-    """Diagonalises the diabatic potential matrix to yield the adiabatic
-    potentials and the adiabatic-to-diabatic transformation matrix."""
-    adiabpot, datmat = sp_linalg.eigh(diabpot)
+    # Ensure phase continuity from geometry to another
+    cached = [n for n in range(ngeom) if labels[n] in data_cache]
+    if len(cached) > 0:
+        old_dat      = np.array([data_cache[labels[n]] for n in cached])
+        sign[cached] = np.sign(np.einsum('nki,nki->ni', datmat[cached], old_dat))
 
-    if label in data_cache:
-        # Ensure phase continuity from geometry to another
-        datmat *= np.sign(np.dot(datmat.T, data_cache[label].dat_mat).diagonal())
-    else:
-        # Set phase convention that the greatest abs element in dat column
-        # vector is positive
-        datmat *= np.sign(datmat[range(len(adiabpot)),
-                                 np.argmax(np.abs(datmat), axis=0)])
+    datmat *= sign[:, np.newaxis, :]
     return adiabpot, datmat
 
-def calc_ddat(label, q, diabpot, dat_mat):
-    """Returns the derviative of the diabatic to adiabatic transformation 
-       matrix via numerical differentiation"""
-    ddat_mat = np.zeros((ham.nmode_total,nsta,nsta))
-    dx = 0.001
-
-    return ddat_mat
-
-def calc_diabderiv1(q):
-    """Calculates the 1st derivatives of the elements of the diabatic
-    potential matrix wrt the nuclear DOFs."""
-    diabderiv1 = np.zeros((ham.nmode_total, nsta, nsta))
-
-    # Fill in the lower-triangle
-    for i in range(ham.nterms):
-        nmodes = len(ham.mode[i])
-        s1, s2 = ham.stalbl[i] - 1
-        if nmodes == 1:
-            m = ham.mode[i][0]
-            o = ham.order[i][0]
-            diabderiv1[m,s1,s2] += ham.coe[i] * o * q[m]**(o - 1)
-        elif nmodes > 1:
-            m = ham.mode[i]
-            o = np.array(ham.order[i])
-            qcol = np.repeat(q[m], nmodes).reshape(nmodes, nmodes)
-            fac = np.prod((qcol - np.diag(q[m]) + np.diag(o)) *
-                          (q[m]**(o - 1))[:,np.newaxis], axis=0)
-            diabderiv1[m,s1,s2] += ham.coe[i] * fac
-
-    # Fill in the upper-triangle
-    diabderiv1[ham.mrange] += (np.transpose(diabderiv1[ham.mrange], axes=(0,2,1)) -
-                               [np.diag(diabderiv1[m].diagonal()) for m in
-                                ham.mrange])
-    return diabderiv1
-
-def calc_diabderiv2(q):
-    """Calculates the 2nd derivatives of the elements of the diabatic
-    potential matrix wrt the nuclear DOFs."""
-    diabderiv2 = np.zeros((ham.nmode_total, ham.nmode_total, nsta, nsta))
-
-    # Fill in the lower-triangle
-    for i in range(ham.nterms):
-        nmodes = len(ham.mode[i])
-        s1, s2 = ham.stalbl[i] - 1
-        m = ham.mode[i]
-        o = np.array(ham.order[i])
-
-        # first do diagonal d^2/dx^2 terms
-        elem = [ind for ind,val in enumerate(o) if val > 1]
-        nelem = len(elem)
-        if nelem > 0:
-            prim = np.repeat(q[m]**o, nelem).reshape(len(m), nelem)
-            derv = o[elem]*(o[elem]-1)*(q[elem]**(o[elem]-2))
-            for j in range(nelem):
-                prim[j,elem[j]] = derv[j]
-                trm = ham.coe[i] * np.prod(prim[j])
-                diabderiv2[m[elem[j]],m[elem[j]],s1,s2] += trm
-                if s1 != s2:
-                    diabderiv2[m[elem[j]],m[elem[j]],s2,s1] += trm
-
-        #now do bilinear terms
-        elem = [ind for ind,val in enumerate(o) if val > 0]
-        nelem = len(elem)
-        if nelem > 1:
-            nterm = nelem * (nelem-1) / 2
-            prim = np.repeat(q[m]**o, nelem).reshape(len(m), nterm)
-            derv = o[elem]*q[elem]**(o[elem]-1)
-            icnt = 0
-            for j in range(nelem):
-                for k in range(i):
-                    prim[icnt,elem[j]] = derv[j]
-                    prim[icnt,elem[k]] = derv[k]
-                    trm = ham.coe[i] * np.prod(prim[icnt])
-                    diabderiv2[m[elem[j]],m[elem[k]],s1,s2] += trm
-                    if elem[j] != elem[k]:
-                        diabderiv2[m[elem[k]],m[elem[j]],s1,s2] += trm
-                    if s1 != s2:
-                        diabderiv2[m[elem[j]],m[elem[k]],s2,s1] += trm
-                        if elem[j] != elem[k]:
-                            diabderiv2[m[elem[k]],m[elem[j]],s2,s1] += trm
-                    icnt+=1
-
-    return diabderiv2
-
 def calc_diabeffcoup(diabpot):
     """Calculates the effective diabatic coupling between diabatic states i, j via
        eff_coup = Hij / (H[i,i] - H[j,j])
     """
-    eff_coup = np.zeros((1, nsta, nsta))
-
-    demat = np.array([[max([glbl.constants['fpzero'],diabpot[i,i]-diabpot[j,j]],key=abs) 
-                           for i in range(nsta)] for j in range(nsta)])
-    eff_coup[0] = np.divide(diabpot - np.diag(diabpot.diagonal()), demat)
+    diag  = np.diagonal(diabpot, axis1=1, axis2=2)
+    demat = diag[:, np.newaxis, :] - diag[:, :, np.newaxis]
+    demat = np.where(np.abs(demat) > glbl.constants['fpzero'], demat,
+                     glbl.constants['fpzero'])
+    eff_coup = (diabpot - diag[:, :, np.newaxis] * np.eye(nsta)) / demat
 
-    return eff_coup
+    return eff_coup[:, np.newaxis]
 
 
 def calc_nacts(adiabpot, datmat, diabderiv1):
@@ -572,14 +739,12 @@ def calc_nacts(adiabpot, datmat, diabderiv1):
     S^T: matrix of eigenvectors of W
     V: vector of adiabatic energies
     """
-    # Fill in the matrix
-    nactmat = np.zeros((ham.nmode_total, nsta, nsta))
-    fac = -np.subtract.outer(adiabpot, adiabpot) + np.eye(nsta)
-    for m in ham.mrange:
-        nactmat[m] = np.dot(np.dot(datmat.T, diabderiv1[m]), datmat) / fac
-
-    # Subtract the diagonal to make sure it is zero
-    nactmat -= [np.diag(nactmat[m].diagonal()) for m in range(ham.nmode_total)]
+    fac     = (adiabpot[:, np.newaxis, :] - adiabpot[:, :, np.newaxis] +
+               np.eye(nsta))
+    nactmat = rotate(datmat, diabderiv1) / fac[:, np.newaxis]
+
+    # Zero the diagonal
+    nactmat *= 1. - np.eye(nsta)
     return nactmat
 
 def calc_adiabderiv1(datmat, diabderiv1):
@@ -587,56 +752,14 @@ def calc_adiabderiv1(datmat, diabderiv1):
 
     Equation used: d/dX V_ii = (S{d/dX W}S^T)_ii
     """
-    # Get the diagonal elements of the matrix
-    adiabderiv1 = np.zeros((ham.nmode_total, nsta))
-    for m in ham.mrange:
-        adiabderiv1[m] = np.dot(np.dot(datmat.T, diabderiv1[m]),
-                                datmat).diagonal()
-    return adiabderiv1
+    return np.einsum('nki,nmkl,nli->nmi', datmat, diabderiv1, datmat)
 
 def calc_adiabderiv2(datmat, diabderiv2):
     """Calculates the hessians of the adiabatic potentials.
 
-    Equation used: d^2/dXidXj V_ii = (S{d^2/dXidXj W}S^T)_ii 
+    Equation used: d^2/dXidXj V_ii = (S{d^2/dXidXj W}S^T)_ii
     """
-    # Get the diagonal elements of the matrix
-    adiabderiv2 = np.zeros((ham.nmode_total, ham.nmode_total, nsta))
-
-    for m in ham.mrange:
-        for n in range(m+1):
-            adiabderiv2[m,n] = np.dot(np.dot(datmat.T, diabderiv2[m,n]),
-                                             datmat).diagonal()
-            if m != n:
-                adiabderiv2[n,m] = adiabderiv2[m,n]
-
-    return adiabderiv2
-
-
-def calc_diablap(q):
-    """Calculates the Laplacian of the diabatic potential matrix wrt
-    the nuclear DOFs at the point q."""
-    diablap = np.zeros((nsta, nsta))
-
-    # Fill in the lower-triangle
-    for i in range(ham.nterms):
-        nmodes = len(ham.mode[i])
-        s1, s2 = ham.stalbl[i] - 1
-        if nmodes == 1:
-            m = ham.mode[i][0]
-            o = ham.order[i][0]
-            if o > 1:
-                diablap[s1,s2] += ham.coe[i] * o * (o - 1) * q[m]**(o - 2)
-        elif nmodes > 1:
-            m = ham.mode[i]
-            o = np.array(ham.order[i])
-            q2col = np.repeat(q[m]**2, nmodes).reshape(nmodes, nmodes)
-            fac = np.prod((q2col - np.diag(q[m]**2) + np.diag(o * (o - 1))) *
-                          (q[m]**(o - 2))[:,np.newaxis], axis=0)
-            diablap[s1,s2] += ham.coe[i] * np.sum(fac)
-
-    # Fill in the upper-triangle
-    diablap += diablap.T - np.diag(diablap.diagonal())
-    return diablap
+    return np.einsum('nki,nabkl,nli->nabi', datmat, diabderiv2, datmat)
 
 def calc_scts(adiabpot, datmat, diabderiv1, nactmat, adiabderiv1, diablap):
     """Calculates the scalar coupling terms.
@@ -647,9 +770,6 @@ def calc_scts(adiabpot, datmat, diabderiv1, nactmat, adiabderiv1, diablap):
     d/d_X F_ij = d/dX (xi_ij*T_ij), where, xi_ij = (V_j-V_i)^-1
                                            T = S {d/dX W} S^T
 
-    Additionally, the gradients of the on-diagonal SCTs (DBOCs)
-    are calculated
-
     In the following:
 
     ximat      <-> xi
@@ -659,76 +779,52 @@ def calc_scts(adiabpot, datmat, diabderiv1, nactmat, adiabderiv1, diablap):
     delnactmat <-> d/dX F
     fdotf      <-> F.F
     """
+    # frequency of each mode (zero for inactive modes)
+    freq = np.zeros(ham.nmode_total)
+    freq[ham.mrange] = ham.freq
+    offdiag = 1. - np.eye(nsta)
+
     #-------------------------------------------------------------------
     # (1) Construct d/dX F (delnactmat)
     #-------------------------------------------------------------------
+    # (c) tmat
+    tmat = rotate(datmat, diabderiv1)
 
     # (a) deltmat = S {Del^2 W} S^T + -FS{d/dX W}S^T + S{d/dX W}S^TF
     # tmp1 <-> S {Del^2 W} S^T
-    tmp1 = np.dot(np.dot(datmat.T, diablap), datmat)
-
+    tmp1 = rotate(datmat, diablap)
     # tmp2 <-> -F S{d/dX W}S^T
-    mat2 = [np.dot(np.dot(np.dot(nactmat[m], datmat.T), diabderiv1[m]), datmat)
-            for m in ham.mrange]
-    tmp2 = -np.sum(ham.freq[:,np.newaxis,np.newaxis] * mat2, axis=0)
-
+    tmp2 = -np.einsum('m,nmij,nmjk->nik', freq, nactmat, tmat)
     # tmp3 <-> S{d/dX W}S^T F
-    mat3 = [np.dot(np.dot(np.dot(datmat.T, diabderiv1[m]), datmat), nactmat[m])
-            for m in ham.mrange]
-    tmp3 = np.sum(ham.freq[:,np.newaxis,np.newaxis] * mat3, axis=0)
-
+    tmp3 = np.einsum('m,nmij,nmjk->nik', freq, tmat, nactmat)
     # deltmat
     deltmat = tmp1 + tmp2 + tmp3
 
     # (b) delximat
-    ## This is slightly slower for nsta == 2
-    #delximat = np.zeros((ham.nmode_total, nsta, nsta))
-    #for m in ham.mrange:
-    #    delximat[m] = -(np.subtract.outer(adiabderiv1[m], adiabderiv1[m]) /
-    #                    (np.subtract.outer(adiabpot, adiabpot) ** 2 +
-    #                     np.eye(nsta)))
-    delximat = np.zeros((ham.nmode_total, nsta, nsta))
-    for m in ham.mrange:
-        for i in range(nsta):
-            for j in range(nsta):
-                if i != j:
-                    delximat[m,i,j] = ((adiabderiv1[m,i] - adiabderiv1[m,j]) /
-                                       (adiabpot[j] - adiabpot[i])**2)
-
-    # (c) tmat
-    tmat = np.zeros((ham.nmode_total, nsta, nsta))
-    for m in ham.mrange:
-        tmat[m] = np.dot(np.dot(datmat.T, diabderiv1[m]), datmat)
+    dpot     = adiabpot[:, np.newaxis, :] - adiabpot[:, :, np.newaxis]
+    dpot_inv = offdiag / (dpot + np.eye(nsta))
+    delximat = ((adiabderiv1[:, :, :, np.newaxis] -
+                 adiabderiv1[:, :, np.newaxis, :]) * dpot_inv[:, np.newaxis]**2)
 
     # (d) ximat
-    ## This is slightly slower for nsta == 2
-    #ximat = 1. / (-np.subtract.outer(adiabpot, adiabpot) +
-    #              np.eye(nsta)) - np.eye(nsta)
-    ximat = np.zeros((nsta, nsta))
-    for i in range(nsta):
-        for j in range(nsta):
-            if i != j:
-                ximat[i,j] = 1. / (adiabpot[j] - adiabpot[i])
+    ximat = dpot_inv
 
     # (f) delnactmat_ij = delximat_ij*tmat_ij + ximat_ij*deltmat_ij (i.ne.j)
-    delnactmat = np.sum(delximat * tmat, axis=0) + ximat * deltmat
+    delnactmat = np.sum(delximat * tmat, axis=1) + ximat * deltmat
 
     #-------------------------------------------------------------------
     # (2) Construct F.F (fdotf)
     #-------------------------------------------------------------------
-    matf = [np.dot(nactmat[m], nactmat[m]) for m in ham.mrange]
-    fdotf = np.sum(ham.freq[:,np.newaxis,np.newaxis] * matf, axis=0)
+    fdotf = np.einsum('m,nmij,nmjk->nik', freq, nactmat, nactmat)
 
     #-------------------------------------------------------------------
     # (3) Calculate the scalar coupling terms G = (d/dX F) - F.F
     #-------------------------------------------------------------------
-    sctmat = delnactmat - fdotf
-
-    #-------------------------------------------------------------------
-    # (4) Calculation of the 1st derivatives of the DBOCs
-    #-------------------------------------------------------------------
-    dbocderiv1 = np.zeros((ham.nmode_total, nsta))
-    for m in ham.mrange:
-        dbocderiv1[m] = -2.*np.sum(delnactmat * nactmat[m], axis=0)
-
-    return sctmat, dbocderiv1
+    return delnactmat - fdotf
+
+def rotate(datmat, mat):
+    """Returns S^T mat S for each geometry, mat may have any number of
+    axes between the geometry and the state axes."""
+    return np.matmul(np.matmul(np.swapaxes(datmat, -1, -2)[:, np.newaxis],
+                               mat.reshape((len(mat), -1, nsta, nsta))),
+                     datmat[:, np.newaxis]).reshape(mat.shape)
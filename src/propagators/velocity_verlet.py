@@ -9,6 +9,7 @@ import numpy as np
 import src.fmsio.glbl as glbl
 import src.dynamics.timings as timings
 import src.dynamics.surface as surface
+import src.basis.trajectory as trajectory
 
 
 propphase = glbl.propagate['phase_prop']
@@ -16,20 +17,43 @@ propphase = glbl.propagate['phase_prop']
 
 @timings.timed
 def propagate_bundle(master, dt):
-    """Propagates the Bundle object with VV."""
-    # update position
-    for i in range(master.n_traj()):
-        if master.traj[i].active:
-            propagate_position(master.traj[i], dt)
+    """Propagates the Bundle object with VV.
+
+    The positions, momenta and forces of the active trajectories are
+    gathered into arrays with one row per trajectory, updated with the
+    same operations as propagate_position and propagate_momentum, and
+    written back to the store of the bundle.
+    """
+    store = master.store
+    if store is None:
+        surface.update_pes(master)
+        return
+    rows   = np.nonzero(store.active[:master.n_traj()])[0]
+    kecoef = glbl.pes.kecoeff
+
+    # update position, and half update the momentum
+    x = store.x[rows]
+    p = store.p[rows]
+    f = forces(master, rows)
+    if propphase:
+        update_phases(store, rows, x, p)
+    x += (p * (2. * kecoef)) * dt
+    x += 0.5 * (f / store.mass[rows]) * dt**2
+    p += 0.5 * f * dt
+    store.x[rows]     = x
+    store.p[rows]     = p
+    store.stamp[rows] = trajectory.new_stamps(len(rows))
 
     # update electronic structure for all trajectories
     # and centroids (where necessary)
     surface.update_pes(master)
 
     # finish update of momentum and phase
-    for i in range(master.n_traj()):
-        if master.traj[i].active:
-            propagate_momentum(master.traj[i], dt)
+    p += 0.5 * forces(master, rows) * dt
+    store.p[rows] = p
+    if propphase:
+        update_phases(store, rows, x, p)
+    store.stamp[rows] = trajectory.new_stamps(len(rows))
 
 
 @timings.timed
@@ -45,6 +69,20 @@ def propagate_trajectory(traj, dt):
     propagate_momentum(traj, dt)
 
 
+def forces(master, rows):
+    """Returns the forces on the trajectories in rows, one per row."""
+    return -np.array([master.traj[i].pes_data.deriv[:, master.traj[i].state,
+                                                    master.traj[i].state]
+                      for i in rows]).reshape(len(rows), master.store.dim)
+
+
+def update_phases(store, rows, x, p):
+    """Sets the nuclear phases of the trajectories in rows to 0.5 x.p, as
+    Trajectory.update_phase does (the stacked product gives the same
+    result as np.dot for each row)."""
+    store.phase[rows] = 0.5 * np.matmul(x[:, np.newaxis, :], p[:, :, np.newaxis])[:, 0, 0]
+
+
 def propagate_position(traj, dt):
     """Updates the position to end of time step and half-propagate the
     momentum and phase."""
@@ -35,13 +35,15 @@ def spawn(master, dt):
             if st == parent.state:
                 continue
 
+            # overlaps with the trajectories on state st that are close
+            # enough in phase space to exceed the minimum overlap
             s_array = [abs(glbl.integrals.traj_overlap(parent,
                                                   master.traj[j],
                                                   nuc_only=True))
-                       if master.traj[j].state == st
-                       and master.traj[j].alive else 0.
-                       for j in range(master.n_traj())]
-            if max(s_array, key=abs) < glbl.spawning['continuous_min_overlap']:
+                       for j in master.ps_index.query(parent,
+                                   glbl.spawning['continuous_min_overlap'],
+                                   state=st)]
+            if max(s_array, default=0.) < glbl.spawning['continuous_min_overlap']:
                 child           = parent.copy()
                 child.amplitude = 0j
                 child.state     = st
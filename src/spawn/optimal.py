@@ -42,6 +42,9 @@ def spawn(master, dt):
         for i in range(n_add):
             coup_hist.append(np.zeros((master.nstates, 3)))
 
+    # spawn attempts to be run by the pes workers, by trajectory
+    attempts = dict()
+
     #--------------- iterate over all trajectories in bundle ---------------------
     for i in range(master.n_traj()):
         # only live trajectories can spawn
@@ -61,39 +64,99 @@ def spawn(master, dt):
             # if we satisfy spawning conditions, begin spawn process
             if spawn_trajectory(master, i, st, coup_hist[i][st,:],
                                 current_time):
-                # we're going to messing with this trajectory -- mess with a copy
-                parent = master.traj[i].copy()
-
-                # propagate the parent forward in time until coupling maximized
-                [success, child, parent_spawn, spawn_time,
-                 exit_time] = spawn_forward(parent, st, current_time, dt)
-
-                # set the spawn attempt in master, even if spawn failed (avoid repeated fails)
-                master.traj[i].last_spawn[st] = spawn_time
-                master.traj[i].exit_time[st]  = exit_time
-
-                if success:
-                    # at this point, child is at the spawn point. Propagate
-                    # backwards in time until we reach the current time
-                    child_spawn = child.copy()
-                    # need electronic structure at current geometry -- on correct state
-                    surface.update_pes_traj(child)
-                    spawn_backward(child, spawn_time, current_time, -dt)
-                    bundle_overlap = utils.overlap_with_bundle(child, master)
-                    if not bundle_overlap:
+                if surface.pool is None:
+                    # we're going to messing with this trajectory -- mess with a copy
+                    attempt = spawn_attempt(master.traj[i].copy(), st,
+                                            current_time, dt)
+                    if add_child(master, i, st, attempt, current_time):
                         basis_grown = True
-                        master.add_trajectory(child)
-                        child_spawn.label = master.traj[-1].label # a little hacky...
-                        utils.write_spawn_log(current_time, spawn_time, exit_time,
-                                                  parent_spawn, child_spawn)
-                    else:
-                        fileio.print_fms_logfile('spawn_bad_step',
-                                                 ['overlap with bundle too large'])
+                else:
+                    attempts.setdefault(i, []).append(st)
+
+    # the spawn attempts of different trajectories are independent: run
+    # them on the pes workers, then add the children in the order above
+    if len(attempts) > 0:
+        traj_ind = sorted(attempts)
+        results  = surface.pool_map(spawn_attempts,
+                                    [(master.traj[i].copy(), attempts[i],
+                                      current_time, dt) for i in traj_ind],
+                                    [[master.traj[i].label] for i in traj_ind])
+        for i, traj_results in zip(traj_ind, results):
+            for st, (attempt, log) in zip(attempts[i], traj_results):
+                # a child added in the meantime may overlap the spawn state
+                if not spawn_trajectory(master, i, st, coup_hist[i][st,:],
+                                        current_time):
+                    continue
+                for otype, data in log:
+                    fileio.print_fms_logfile(otype, data)
+                if add_child(master, i, st, attempt, current_time):
+                    basis_grown = True
 
     # let caller known if the basis has been changed
     return basis_grown
 
 
+def spawn_attempt(parent, child_state, current_time, dt):
+    """Propagates the parent forward to the point of maximum coupling and,
+    if a child was created there, propagates the child back to the
+    current time."""
+    # propagate the parent forward in time until coupling maximized
+    [success, child, parent_spawn, spawn_time,
+     exit_time] = spawn_forward(parent, child_state, current_time, dt)
+
+    child_spawn = None
+    if success:
+        # at this point, child is at the spawn point. Propagate
+        # backwards in time until we reach the current time
+        child_spawn = child.copy()
+        # need electronic structure at current geometry -- on correct state
+        surface.update_pes_traj(child)
+        spawn_backward(child, spawn_time, current_time, -dt)
+
+    return success, child, child_spawn, parent_spawn, spawn_time, exit_time
+
+
+def spawn_attempts(parent, child_states, current_time, dt):
+    """Runs the spawn attempts of a trajectory to each of child_states,
+    in turn, on a pes worker. Returns the result and the log file
+    entries of each attempt."""
+    results = []
+    for st in child_states:
+        fileio.log_buffer = []
+        attempt = spawn_attempt(parent.copy(), st, current_time, dt)
+        results.append((attempt, fileio.log_buffer))
+        parent.last_spawn[st] = attempt[4]
+        parent.exit_time[st]  = attempt[5]
+    fileio.log_buffer = None
+
+    return results
+
+
+def add_child(master, traj_index, child_state, attempt, current_time):
+    """Adds the child of a spawn attempt to the bundle unless it overlaps
+    with the bundle. Returns True if the child was added."""
+    success, child, child_spawn, parent_spawn, spawn_time, exit_time = attempt
+
+    # set the spawn attempt in master, even if spawn failed (avoid repeated fails)
+    master.traj[traj_index].last_spawn[child_state] = spawn_time
+    master.traj[traj_index].exit_time[child_state]  = exit_time
+
+    if not success:
+        return False
+
+    bundle_overlap = utils.overlap_with_bundle(child, master)
+    if bundle_overlap:
+        fileio.print_fms_logfile('spawn_bad_step',
+                                 ['overlap with bundle too large'])
+        return False
+
+    master.add_trajectory(child)
+    child_spawn.label = master.traj[-1].label # a little hacky...
+    utils.write_spawn_log(current_time, spawn_time, exit_time,
+                          parent_spawn, child_spawn)
+    return True
+
+
 def spawn_forward(parent, child_state, initial_time, dt):
     """Propagates the parent forward (into the future) until the coupling
     decreases."""
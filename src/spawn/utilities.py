@@ -77,16 +77,13 @@ def overlap_with_bundle(traj, bundle):
     already in the bundle."""
     t_overlap_bundle = False
 
-    for i in range(bundle.n_traj()):
-        if bundle.traj[i].alive:
-
-            if traj.state != bundle.traj[i].state:
-                sij = 0j
-            else:
-                sij = glbl.integrals.traj_overlap(traj, bundle.traj[i])
-            if abs(sij) > glbl.propagate['sij_thresh']:
-                t_overlap_bundle = True
-                break
+    # only trajectories close in phase space can have a large overlap
+    for i in bundle.ps_index.query(traj, glbl.propagate['sij_thresh'],
+                                   state=traj.state):
+        sij = glbl.integrals.traj_overlap(traj, bundle.traj[i])
+        if abs(sij) > glbl.propagate['sij_thresh']:
+            t_overlap_bundle = True
+            break
 
     return t_overlap_bundle
 
@@ -98,12 +95,12 @@ def max_nuc_overlap(bundle, overlap_traj, overlap_state=None):
        overlap_state"""
 
     max_sij = 0.
-    for j in range(bundle.n_traj()):
-        if bundle.traj[j].alive and j != overlap_traj:
-            if overlap_state is None or bundle.traj[j].state == overlap_state:
-                max_sij = max(max_sij, abs(glbl.integrals.traj_overlap(
-                                                 bundle.traj[overlap_traj],
-                                                 bundle.traj[j], nuc_only=True)))
+    # the largest overlap is with the nearest trajectory in phase space
+    for j in bundle.ps_index.nearest(bundle.traj[overlap_traj],
+                                     state=overlap_state, exclude=overlap_traj):
+        max_sij = max(max_sij, abs(glbl.integrals.traj_overlap(
+                                         bundle.traj[overlap_traj],
+                                         bundle.traj[j], nuc_only=True)))
 
     return max_sij
 
@@ -4,6 +4,9 @@ Linear algebra library routines.
 
 import sys
 import numpy as np
+import scipy.linalg as sp_linalg
+import scipy.sparse as sp_sparse
+import scipy.sparse.linalg as sp_sparse_linalg
 import src.dynamics.timings as timings
 import src.fmsio.glbl as glbl
 
@@ -81,3 +84,328 @@ def pseudo_inverse2(mat):
                                                   np.transpose(u)))
 
     return invmat, cond
+
+class OverlapInverse:
+    """Applies the inverse of the overlap matrix of a set of labelled basis
+    functions, updating (rather than recomputing) the factorization as
+    functions are added to or removed from the set.
+
+    The method is set by the sinv_method keyword:
+      'inverse': S^-1 is stored explicitly. Removed functions are
+                 eliminated with a Schur complement of S^-1 and new
+                 functions are added by block bordering.
+      'solve':   a Cholesky (LU if S is not hermitian) factorization of S
+                 is stored and S^-1 is applied by back-substitution. New
+                 functions extend the Cholesky factor by bordering, any
+                 other change refactorizes.
+    Functions whose overlap elements have changed are treated as removed
+    and added again. S is refactorized when more than a fraction
+    max_update of the basis has changed. If the (1-norm) condition number
+    of S exceeds sinv_cond_max, the regularized pseudo-inverse is used
+    instead, and S is refactorized at the next update.
+
+    Note that a change to any overlap element marks both functions as
+    changed. In a run every trajectory moves at each time step, so after
+    a normal step the whole basis has changed and S is refactorized; the
+    cost is then that of a Cholesky/LU factorization rather than of the
+    SVD of the 'pinv' method. The Schur complement and bordering updates
+    are only used when functions are added or removed while the others
+    have not moved. There is no rule to keep a factorization until the
+    condition number drifts past a limit: sinv_cond_max only switches to
+    the pseudo-inverse.
+    """
+    max_update = 0.25
+
+    def __init__(self):
+        # labels of the basis functions in the order of the factorization
+        self.labels      = []
+        # position of each of these functions in the caller's matrices
+        self.order       = np.zeros(0, dtype=int)
+        # overlap matrix in the order of the factorization
+        self.smat        = np.zeros((0, 0), dtype=complex)
+        self.method      = None
+        self.hermitian   = True
+        # explicit (pseudo-)inverse, or ('chol'/'lu', factorization)
+        self.sinv        = None
+        self.factor      = None
+        self.cond        = 1.
+        self.regularized = False
+
+    def copy(self):
+        """Copys an OverlapInverse object with new references."""
+        new_inv             = OverlapInverse()
+        new_inv.labels      = list(self.labels)
+        new_inv.order       = self.order.copy()
+        new_inv.smat        = self.smat.copy()
+        new_inv.method      = self.method
+        new_inv.hermitian   = self.hermitian
+        if self.sinv is not None:
+            new_inv.sinv    = self.sinv.copy()
+        if self.factor is not None:
+            new_inv.factor  = (self.factor[0],
+                               tuple(np.copy(f) for f in self.factor[1]))
+        new_inv.cond        = self.cond
+        new_inv.regularized = self.regularized
+        return new_inv
+
+    @timings.timed
+    def update(self, smat, labels, hermitian=True):
+        """Updates the factorization for the overlap matrix smat between
+        the basis functions labels."""
+        method = glbl.propagate['sinv_method']
+        if method not in ['inverse', 'solve']:
+            raise ValueError('sinv_method='+str(method)+' not recognized')
+
+        pos   = {label: i for i, label in enumerate(labels)}
+        old_i = [i for i, label in enumerate(self.labels) if label in pos]
+        new_i = [pos[self.labels[i]] for i in old_i]
+
+        # functions whose overlap elements have changed are removed
+        diff    = (smat[np.ix_(new_i, new_i)] !=
+                   self.smat[np.ix_(old_i, old_i)])
+        changed = np.any(diff, axis=0) | np.any(diff, axis=1)
+        keep    = [i for i, c in zip(old_i, changed) if not c]
+        kept    = set(self.labels[i] for i in keep)
+        add     = [i for i, label in enumerate(labels) if label not in kept]
+        remove  = len(self.labels) - len(keep)
+
+        if remove + len(add) == 0:
+            self.order = np.array(new_i, dtype=int)
+            return
+
+        if (method != self.method or hermitian != self.hermitian or
+                self.regularized or len(keep) == 0 or
+                remove + len(add) > self.max_update * len(labels) or
+                (method == 'solve' and (remove > 0 or not hermitian))):
+            self.refactor(smat, labels, method, hermitian)
+            return
+
+        keep_pos = [pos[self.labels[i]] for i in keep]
+        try:
+            if remove > 0:
+                self.downdate(keep)
+            self.border(smat, keep_pos, add, labels)
+        except np.linalg.LinAlgError:
+            self.cond = np.inf
+
+        # if the updated matrix has become ill-conditioned, start over
+        if self.cond > glbl.propagate['sinv_cond_max']:
+            self.refactor(smat, labels, method, hermitian)
+
+    def solve(self, rhs):
+        """Returns S^-1 rhs, where the rows of rhs are in the order of the
+        last call to update."""
+        x = np.zeros(rhs.shape, dtype=complex)
+        if self.sinv is not None:
+            x[self.order] = np.dot(self.sinv, rhs[self.order])
+        elif self.factor[0] == 'chol':
+            x[self.order] = sp_linalg.cho_solve(self.factor[1], rhs[self.order])
+        else:
+            x[self.order] = sp_linalg.lu_solve(self.factor[1], rhs[self.order])
+        return x
+
+    @timings.timed
+    def refactor(self, smat, labels, method, hermitian):
+        """Factorizes the full overlap matrix."""
+        self.labels      = list(labels)
+        self.order       = np.arange(len(labels))
+        self.smat        = smat.copy()
+        self.method      = method
+        self.hermitian   = hermitian
+        self.sinv        = None
+        self.factor      = None
+        self.regularized = False
+
+        anorm = np.linalg.norm(smat, 1)
+        try:
+            if hermitian:
+                self.factor = ('chol', sp_linalg.cho_factor(smat, lower=True))
+                self.cond   = chol_cond(self.factor[1][0], anorm)
+            else:
+                self.factor = ('lu', sp_linalg.lu_factor(smat))
+                self.cond   = lu_cond(self.factor[1][0], anorm)
+        except (np.linalg.LinAlgError, ValueError):
+            self.cond = np.inf
+
+        if self.cond > glbl.propagate['sinv_cond_max']:
+            # regularized pseudo-inverse
+            self.factor      = None
+            self.regularized = True
+            if hermitian:
+                self.sinv = sp_linalg.pinvh(smat)
+            else:
+                self.sinv, cond = pseudo_inverse(smat)
+        elif method == 'inverse':
+            self.sinv   = self.solve(np.identity(len(labels), dtype=complex))
+            self.factor = None
+
+    def downdate(self, keep):
+        """Removes all but the basis functions keep (indices into the
+        current factorization) from S^-1."""
+        rem = sorted(set(range(len(self.labels))) - set(keep))
+        b11 = self.sinv[np.ix_(keep, keep)]
+        b12 = self.sinv[np.ix_(keep, rem)]
+        b21 = self.sinv[np.ix_(rem, keep)]
+        b22 = self.sinv[np.ix_(rem, rem)]
+
+        self.sinv   = b11 - np.dot(b12, np.linalg.solve(b22, b21))
+        self.smat   = self.smat[np.ix_(keep, keep)]
+        self.labels = [self.labels[i] for i in keep]
+
+    def border(self, smat, keep, add, labels):
+        """Adds the basis functions add to the factorization. keep and
+        add are indices into smat and labels, and keep must be in the
+        order of the current factorization."""
+        s12 = smat[np.ix_(keep, add)]
+        s21 = smat[np.ix_(add, keep)]
+        s22 = smat[np.ix_(add, add)]
+
+        if self.method == 'solve':
+            lmat = self.factor[1][0]
+            w    = sp_linalg.solve_triangular(lmat, s12, lower=True)
+            l22  = np.linalg.cholesky(s22 - np.dot(w.conj().T, w))
+            lmat = np.block([[lmat, np.zeros(s12.shape, dtype=complex)],
+                             [w.conj().T, l22]])
+            self.factor = ('chol', (lmat, True))
+        else:
+            # S^-1 of the bordered matrix from the Schur complement
+            x    = np.dot(self.sinv, s12)
+            y    = np.dot(s21, self.sinv)
+            schur_inv = np.linalg.inv(s22 - np.dot(s21, x))
+            self.sinv = np.block([[self.sinv + np.dot(x, np.dot(schur_inv, y)),
+                                   -np.dot(x, schur_inv)],
+                                  [-np.dot(schur_inv, y), schur_inv]])
+
+        index       = keep + add
+        self.order  = np.array(index, dtype=int)
+        self.smat   = smat[np.ix_(index, index)]
+        self.labels = [labels[i] for i in index]
+
+        anorm = np.linalg.norm(self.smat, 1)
+        if self.method == 'solve':
+            self.cond = chol_cond(self.factor[1][0], anorm)
+        else:
+            self.cond = anorm * np.linalg.norm(self.sinv, 1)
+
+def chol_cond(lmat, anorm):
+    """Returns the estimated 1-norm condition number of a matrix from its
+    (lower) Cholesky factor."""
+    pocon, = sp_linalg.lapack.get_lapack_funcs(('pocon',), (lmat,))
+    rcond, info = pocon(lmat, anorm, uplo='L')
+    return np.inf if rcond == 0. else 1. / rcond
+
+def lu_cond(lu, anorm):
+    """Returns the estimated 1-norm condition number of a matrix from its
+    LU factorization."""
+    gecon, = sp_linalg.lapack.get_lapack_funcs(('gecon',), (lu,))
+    rcond, info = gecon(lu, anorm, norm='1')
+    return np.inf if rcond == 0. else 1. / rcond
+
+#----------------------------------------------------------------------
+#
+# Action of the propagator exp(-i H dt) on a vector
+#
+#----------------------------------------------------------------------
+# eigen-decomposition of the last matrix propagated by eig_expm_vec
+eig_cache = dict(hmat=None, evals=None, evecs=None, evecs_inv=None)
+
+def expm_vec(hmat, vec, dt):
+    """Returns exp(-i hmat dt) vec using the method set by the
+    amp_propagator keyword. hmat may be a scipy.sparse matrix, which is
+    only converted to a dense matrix by the expm and eig methods."""
+    method = glbl.propagate['amp_propagator']
+    if len(vec) == 0:
+        return np.zeros(0, dtype=complex)
+    if sp_sparse.issparse(hmat) and method in ['expm', 'eig']:
+        hmat = hmat.toarray()
+
+    if method == 'expm':
+        # dense Pade approximation of the full matrix exponential
+        return np.dot(sp_linalg.expm(-1j * hmat * dt), vec)
+    elif method == 'eig':
+        return eig_expm_vec(hmat, vec, dt)
+    elif method == 'krylov':
+        return krylov_expm_vec(hmat, vec, dt)
+    elif method == 'expm_multiply':
+        return sp_sparse_linalg.expm_multiply(-1j * dt * hmat, vec)
+    else:
+        raise ValueError('amp_propagator='+str(method)+' not recognized')
+
+def eig_expm_vec(hmat, vec, dt):
+    """Returns exp(-i hmat dt) vec from the eigen-decomposition of hmat.
+
+    The decomposition is kept and reused as long as hmat does not
+    change, e.g. for the two half-steps of the amplitudes that use
+    the same effective Hamiltonian.
+    """
+    global eig_cache
+
+    if (eig_cache['hmat'] is None or eig_cache['hmat'].shape != hmat.shape or
+            not np.array_equal(eig_cache['hmat'], hmat)):
+        evals, evecs           = sp_linalg.eig(hmat)
+        eig_cache['hmat']      = hmat.copy()
+        eig_cache['evals']     = evals
+        eig_cache['evecs']     = evecs
+        eig_cache['evecs_inv'] = sp_linalg.inv(evecs)
+
+    coef = np.exp(-1j * eig_cache['evals'] * dt) * np.dot(eig_cache['evecs_inv'],
+                                                          vec)
+    return np.dot(eig_cache['evecs'], coef)
+
+def krylov_expm_vec(hmat, vec, dt, tol=1.e-12, max_dim=30):
+    """Returns exp(-i hmat dt) vec using a short iterative Arnoldi
+    (Krylov subspace) propagator.
+
+    The Arnoldi iteration does not assume hmat is hermitian. If the
+    (estimated) error of a single Krylov step exceeds tol, the time step
+    is subdivided. Each step costs max_dim matrix-vector products.
+    """
+    n_dim   = len(vec)
+    max_dim = min(max_dim, n_dim)
+    amat    = -1j * hmat
+    t_sign  = np.sign(dt)
+    t_end   = abs(dt)
+    t_now   = 0.
+    tau     = t_end
+    w       = np.array(vec, dtype=complex)
+
+    while t_now < t_end:
+        beta = np.linalg.norm(w)
+        if beta == 0.:
+            break
+
+        # Arnoldi iteration: orthonormal basis of the Krylov subspace
+        vmat      = np.zeros((max_dim + 1, n_dim), dtype=complex)
+        hess      = np.zeros((max_dim + 1, max_dim), dtype=complex)
+        vmat[0]   = w / beta
+        k_dim     = max_dim
+        breakdown = False
+        for j in range(max_dim):
+            u = amat.dot(vmat[j])
+            for i in range(j + 1):
+                hess[i, j] = np.vdot(vmat[i], u)
+                u         -= hess[i, j] * vmat[i]
+            hess[j+1, j] = np.linalg.norm(u)
+            if hess[j+1, j] < tol * beta:
+                # the Krylov subspace is invariant: the result is exact
+                k_dim     = j + 1
+                breakdown = True
+                break
+            vmat[j+1] = u / hess[j+1, j]
+
+        # shorten the step until the error estimate is below tol
+        tau = min(tau, t_end - t_now)
+        while True:
+            emat = sp_linalg.expm(t_sign * tau * hess[:k_dim, :k_dim])
+            if breakdown:
+                break
+            err = beta * abs(hess[k_dim, k_dim-1] * tau * emat[k_dim-1, 0])
+            if err <= tol * max(beta, 1.):
+                break
+            tau *= 0.5
+
+        w      = beta * np.dot(vmat[:k_dim].T, emat[:, 0])
+        t_now += tau
+        tau   *= 2.
+
+    return w
@@ -0,0 +1,96 @@
+"""
+Tests of the ensemble driver under MPI, with the ranks split into two
+groups that execute runs at the same time.
+
+The ensemble is started with mpirun in a temporary copy of the
+butatriene example. The tests are skipped if mpirun or mpi4py is not
+available.
+"""
+import os
+import sys
+import shutil
+import subprocess
+import pytest
+
+# root of the repository and the example the ensemble is set up from
+repo    = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+example = os.path.join(repo, 'examples', 'butatriene_vibronic')
+
+mpirun = shutil.which('mpirun')
+try:
+    import mpi4py
+except ImportError:
+    mpi4py = None
+
+pytestmark = pytest.mark.skipif(mpirun is None or mpi4py is None,
+                                reason='requires mpirun and mpi4py')
+
+
+def setup_ensemble(path, n_runs, group_size, overrides=None):
+    """Copies the example to path, with a short simulation time and the
+    ensemble-section appended to fms.input."""
+    for fname in ['butatriene.op', 'geometry.dat']:
+        shutil.copy(os.path.join(example, fname), path)
+
+    with open(os.path.join(example, 'fms.input'), 'r') as infile:
+        lines = infile.readlines()
+    values = dict(simulation_time='40.')
+    if overrides is not None:
+        values.update(overrides)
+    with open(os.path.join(path, 'fms.input'), 'w') as outfile:
+        for line in lines:
+            words = line.split()
+            if len(words) > 2 and words[0] in values and words[1] == '=':
+                line = '    ' + words[0] + ' = ' + values[words[0]] + '\n'
+            outfile.write(line)
+        outfile.write('begin ensemble-section\n' +
+                      '    n_runs = ' + str(n_runs) + '\n' +
+                      '    group_size = ' + str(group_size) + '\n' +
+                      'end ensemble-section\n')
+
+
+def run_ensemble(path, nproc):
+    """Runs ensemble.py on nproc MPI ranks in path, returns the completed
+    process and the status of each run from ensemble.log."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo] + [p for p in
+                                        [env.get('PYTHONPATH')] if p])
+    # Open MPI refuses more ranks than cores, or running as root, by default
+    env.setdefault('OMPI_MCA_rmaps_base_oversubscribe', '1')
+    env.setdefault('OMPI_ALLOW_RUN_AS_ROOT', '1')
+    env.setdefault('OMPI_ALLOW_RUN_AS_ROOT_CONFIRM', '1')
+    env.pop('TMPDIR', None)
+
+    proc = subprocess.run([mpirun, '-np', str(nproc), sys.executable,
+                           os.path.join(repo, 'ensemble.py'), '-mpi'],
+                          cwd=str(path), env=env, timeout=900,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    status = dict()
+    log    = os.path.join(str(path), 'ensemble', 'ensemble.log')
+    if os.path.isfile(log):
+        with open(log, 'r') as infile:
+            for line in infile:
+                words = line.split()
+                status[int(words[1])] = words[4]
+    return proc, status
+
+
+def test_two_groups(tmp_path):
+    setup_ensemble(str(tmp_path), n_runs=3, group_size=2)
+    proc, status = run_ensemble(tmp_path, 4)
+
+    assert proc.returncode == 0, proc.stdout.decode(errors='replace')
+    assert status == {0:'done', 1:'done', 2:'done'}
+    for name in ['n.dat', 'e.dat']:
+        assert os.path.isfile(os.path.join(str(tmp_path), 'ensemble', name))
+
+
+def test_failed_runs(tmp_path):
+    setup_ensemble(str(tmp_path), n_runs=3, group_size=2,
+                   overrides=dict(integrals='no_such_integrals'))
+    proc, status = run_ensemble(tmp_path, 4)
+
+    # all runs are logged as failed, and the exit status reports them
+    assert proc.returncode != 0
+    assert status == {0:'failed', 1:'failed', 2:'failed'}
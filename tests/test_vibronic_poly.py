@@ -0,0 +1,189 @@
+"""
+Tests of the compiled polynomial operator of the vibronic interface.
+
+PolyOperator.evaluate is checked against reference values from the
+term-by-term evaluators it replaced (calc_diabpot, calc_diabderiv1,
+calc_diabderiv2 and calc_diablap) for the butatriene and pyrazine
+example operators. The baseline calc_diabderiv2 mishandled bilinear
+terms, so the mixed-mode Hessian elements below are the analytic
+second derivatives of those terms.
+"""
+import os
+import pytest
+import numpy as np
+import src.interfaces.vibronic as vibronic
+
+# location of the example operator files
+examples = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'examples')
+
+# operator file and mode labels for each example
+operators = {
+    'butatriene': ('butatriene_vibronic', 'butatriene.op',
+                   ['q5', 'q8', 'q12', 'q14', 'q15']),
+    'pyrazine': ('pyrazine_vibronic', 'pyrazine4d.op',
+                 ['v10a', 'v6a', 'v1', 'v9a'])}
+
+# reference values: geometries, potential matrices, gradients
+# (mode, state, state), Laplacians and the non-zero elements of the
+# constant Hessian, keyed by (mode, mode, state, state)
+reference = {
+    'butatriene': dict(
+        geoms = [[0.31, -0.72, 0.15, 0.48, -0.27],
+                 [-1.1, 0.4, 0.9, -0.35, 0.6]],
+        pot = [[[0.331111117403412, 0.003280979628047268],
+                [0.003280979628047268, 0.3427418006420074]],
+               [[0.3350990305434674, -0.01164218577694192],
+                [-0.01164218577694192, 0.3600363866814637]]],
+        grad = [[[[0.0010389768822149684, 0.010583805251765381],
+                  [0.010583805251765381, 0.0010389768822149684]],
+                 [[-0.0009300518864988826, 0.0],
+                  [0.0, -0.000698531146616515]],
+                 [[0.0013999654898125076, 0.0],
+                  [0.0, 0.0013448415041262295]],
+                 [[0.0105302982363259, 0.0],
+                  [0.0, -0.00802811027805437]],
+                 [[-0.00220315871058537, 0.0],
+                  [0.0, -0.004863809753043056]]],
+                [[[-0.003686692162698275, 0.010583805251765381],
+                  [0.010583805251765381, -0.003686692162698275]],
+                 [[0.0035521896376237566, 0.0],
+                  [0.0, 0.003783710377506124]],
+                 [[0.006286706820901056, 0.0],
+                  [0.0, 0.006231582835214778]],
+                 [[0.002666898427502132, 0.0],
+                  [0.0, -0.015891510086878138]],
+                 [[0.009668012102897349, 0.0],
+                  [0.0, 0.007007361060439663]]]],
+        lap = [[[0.03698819439549256, 0.0],
+                [0.0, 0.03698819439549256]],
+               [[0.03698819439549256, 0.0],
+                [0.0, 0.03698819439549256]]],
+        hess = {(0, 0, 0, 0): 0.0033515383297257045,
+                (0, 0, 1, 1): 0.0033515383297257045,
+                (1, 1, 0, 0): 0.004002001360823785,
+                (1, 1, 1, 1): 0.004002001360823785,
+                (2, 2, 0, 0): 0.0065156551081180635,
+                (2, 2, 1, 1): 0.0065156551081180635,
+                (3, 3, 0, 0): 0.00947397567328165,
+                (3, 3, 1, 1): 0.00947397567328165,
+                (4, 4, 0, 0): 0.013645023923543356,
+                (4, 4, 1, 1): 0.013645023923543356}),
+    'pyrazine': dict(
+        geoms = [[0.42, -0.61, 0.27, 0.83],
+                 [-0.9, 0.35, -0.44, 0.12]],
+        pot = [[[-0.010083444466197796, 0.003101109180769172],
+                [0.003101109180769172, 0.02425911142659752]],
+               [[-0.012440245888916996, -0.006961365606783033],
+                [-0.006961365606783033, 0.013252959904001651]]],
+        grad = [[[[0.0014002374348085602, 0.007383593287545649],
+                  [0.007383593287545649, 0.0014002374348085602]],
+                 [[0.002092896039483297, 0.00030869431984315693],
+                  [0.00030869431984315693, -0.006578158358021544]],
+                 [[0.0027602417099308954, 0.00017070795887326579],
+                  [0.00017070795887326579, 0.0075714117315759345]],
+                 [[0.009802389680270978, 3.889548430023778e-05],
+                  [3.889548430023778e-05, 0.005912679553222521]]],
+                [[[-0.0030005087888754856, 0.007734850674203371],
+                  [0.007734850674203371, -0.0030005087888754856]],
+                 [[0.004537225862378511, -0.0006614878282353363],
+                  [-0.0006614878282353363, -0.003914133727639857]],
+                 [[-0.00019857864603624784, -0.00036580276901414103],
+                  [-0.00036580276901414103, 0.00415965595988654]],
+                 [[0.006214648746811952, -8.334746635765238e-05],
+                  [-8.334746635765238e-05, 0.0021478877276039274]]]],
+        lap = [[[0.016277010493444176, 0.0],
+                [0.0, 0.016277010493444176]],
+               [[0.016277010493444176, 0.0],
+                [0.0, 0.016277010493444176]]],
+        hess = {(0, 0, 0, 0): 0.0033338986543060955,
+                (0, 0, 1, 1): 0.0033338986543060955,
+                (0, 1, 0, 1): 0.0007349864758170404,
+                (0, 1, 1, 0): 0.0007349864758170404,
+                (0, 2, 0, 1): 0.00040644752112682333,
+                (0, 2, 1, 0): 0.00040644752112682333,
+                (0, 3, 0, 1): 9.260829595294709e-05,
+                (0, 3, 1, 0): 9.260829595294709e-05,
+                (1, 0, 0, 1): 0.0007349864758170404,
+                (1, 0, 1, 0): 0.0007349864758170404,
+                (1, 1, 0, 0): 0.002715775028143964,
+                (1, 1, 1, 1): 0.002715775028143964,
+                (1, 2, 0, 0): 7.937853938824037e-05,
+                (1, 2, 1, 1): -0.00021902596979347805,
+                (1, 3, 0, 0): 0.00014993724106667625,
+                (1, 3, 1, 1): 0.00013891244392942064,
+                (2, 0, 0, 1): 0.00040644752112682333,
+                (2, 0, 1, 0): 0.00040644752112682333,
+                (2, 1, 0, 0): 7.937853938824037e-05,
+                (2, 1, 1, 1): -0.00021902596979347805,
+                (2, 2, 0, 0): 0.004623064932889184,
+                (2, 2, 1, 1): 0.004623064932889184,
+                (2, 3, 0, 0): -0.0003483835895372772,
+                (2, 3, 1, 1): -0.00011392290375164126,
+                (3, 0, 0, 1): 9.260829595294709e-05,
+                (3, 0, 1, 0): 9.260829595294709e-05,
+                (3, 1, 0, 0): 0.00014993724106667625,
+                (3, 1, 1, 1): 0.00013891244392942064,
+                (3, 2, 0, 0): -0.0003483835895372772,
+                (3, 2, 1, 1): -0.00011392290375164126,
+                (3, 3, 0, 0): 0.005604271878104933,
+                (3, 3, 1, 1): 0.005604271878104933}),
+    }
+
+
+def build_operator(name, monkeypatch):
+    """Reads an example operator file and compiles it."""
+    example, opfile, labels = operators[name]
+    ham = vibronic.VibHam()
+    monkeypatch.setattr(vibronic, 'ham', ham)
+    ham.mlbl_total   = labels
+    ham.mlbl_active  = labels
+    ham.nmode_total  = len(labels)
+    ham.nmode_active = len(labels)
+    ham.rdoperfile(os.path.join(examples, example, opfile))
+    return vibronic.PolyOperator(ham, 2)
+
+
+def evaluate(name, monkeypatch):
+    """Evaluates an example operator at the reference geometries."""
+    op = build_operator(name, monkeypatch)
+    q  = np.array(reference[name]['geoms'])
+    return op.evaluate(q, nderiv=2)
+
+
+def hessian(name, ngeom):
+    """Expands the non-zero reference Hessian elements."""
+    nmode = len(operators[name][2])
+    d2    = np.zeros((ngeom, nmode, nmode, 2, 2))
+    for (m1, m2, s1, s2), val in reference[name]['hess'].items():
+        d2[:, m1, m2, s1, s2] = val
+    return d2
+
+
+@pytest.mark.parametrize('name', sorted(operators))
+def test_potential(name, monkeypatch):
+    pot, d1, d2 = evaluate(name, monkeypatch)
+    np.testing.assert_allclose(pot, reference[name]['pot'],
+                               rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize('name', sorted(operators))
+def test_gradient(name, monkeypatch):
+    pot, d1, d2 = evaluate(name, monkeypatch)
+    np.testing.assert_allclose(d1, reference[name]['grad'],
+                               rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize('name', sorted(operators))
+def test_hessian(name, monkeypatch):
+    pot, d1, d2 = evaluate(name, monkeypatch)
+    np.testing.assert_allclose(d2, hessian(name, d2.shape[0]),
+                               rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize('name', sorted(operators))
+def test_laplacian(name, monkeypatch):
+    pot, d1, d2 = evaluate(name, monkeypatch)
+    lap = np.trace(d2, axis1=1, axis2=2)
+    np.testing.assert_allclose(lap, reference[name]['lap'],
+                               rtol=1e-12, atol=1e-15)